@@ -18,6 +18,7 @@
 from contextlib import closing, suppress
 from datetime import datetime
 from functools import partial
+from threading import Lock
 
 import apsw
 
@@ -111,9 +112,12 @@ def __init__(self, db):
         self.db = db
         self.defaults = {}
         self.disable_setting = False
+        # Incremented every time a preference is changed
+        self.change_count = 0
         self.load_from_db()
 
     def load_from_db(self):
+        self.change_count += 1
         self.clear()
         for key, val in self.db.conn.get('SELECT key,val FROM preferences'):
             try:
@@ -144,6 +148,7 @@ def __getitem__(self, key):
 
     def __delitem__(self, key):
         dict.__delitem__(self, key)
+        self.change_count += 1
         self.db.execute('DELETE FROM preferences WHERE key=?', (key,))
 
     def __setitem__(self, key, val):
@@ -163,6 +168,7 @@ def __setitem__(self, key, val):
                     do_set = True
             if do_set:
                 dict.__setitem__(self, key, val)
+                self.change_count += 1
 
     def set(self, key, val):
         self.__setitem__(key, val)
@@ -1602,21 +1608,43 @@ def last_modified(self):
         ''' Return last modified time as a UTC datetime object '''
         return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
 
-    def read_tables(self):
+    def read_tables(self, lazy=False, tables=None):
         '''
-        Read all data from the db into the python in-memory tables
+        Read all data from the db into the python in-memory tables. If lazy is
+        True, the data for each table is read only when it is first used, see
+        :meth:`read_lazy_table`. If tables is not None, only those tables are
+        read.
         '''
-
+        tables = self.tables.values() if tables is None else tables
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
-            for table in self.tables.values():
+            if lazy:
+                self.lazy_tables_lock = Lock()
+            for table in tables:
                 try:
-                    table.read(self)
+                    if lazy:
+                        table.read_lazily(self)
+                    else:
+                        table.read(self)
                 except Exception:
                     prints('Failed to read table:', table.name)
                     import pprint
                     pprint.pprint(table.metadata)
                     raise
 
+    def read_lazy_table(self, table):
+        '''
+        Read the data of a table that is being read lazily. This happens on
+        first use, usually under the read lock, so the db is not changed by
+        this process. If another process has changed the db since the other
+        tables were read, the table reflects those changes while the others
+        do not, in the same way as the in-memory tables do not reflect changes
+        by other processes in general.
+        '''
+        with self.lazy_tables_lock:
+            if not table.is_read:
+                with self.conn:
+                    table.read_in_copy(self)
+
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
         for author_dir in os.scandir(self.library_path):
@@ -19,6 +19,7 @@
 from datetime import datetime
 from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
+from itertools import filterfalse
 from queue import Queue, ShutDown
 from threading import Lock
 from time import mktime, monotonic, time
@@ -29,11 +30,11 @@
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd, run_plugins_on_postdelete, run_plugins_on_postimport
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
-from calibre.db.categories import get_categories
+from calibre.db.categories import CategoriesCache, get_categories
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, NOTES_DIR_NAME, Pages
 from calibre.db.errors import NoSuchBook, NoSuchFormat
 from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
-from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
+from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata, proxy_metadata_for_books
 from calibre.db.listeners import EventDispatcher, EventType
 from calibre.db.locking import DowngradeLockError, LockingError, SafeReadLock, create_locks, try_lock
 from calibre.db.notes.connect import copy_marked_up_text
@@ -44,18 +45,20 @@
 from calibre.db.write import get_series_values, sqlite_datetime, uniq
 from calibre.ebooks import check_ebook_format
 from calibre.ebooks.metadata import author_to_author_sort, string_to_authors, title_sort
+from calibre.ebooks.metadata.book import TOP_LEVEL_IDENTIFIERS
 from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ebooks.metadata.book.formatter import SafeFormat
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.ptempfile import PersistentTemporaryFile, SpooledTemporaryFile, base_dir
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.date import UNDEFINED_DATE, is_date_undefined, timestampfromdt, utcnow
 from calibre.utils.date import now as nowf
 from calibre.utils.filenames import make_long_path_useable
+from calibre.utils.formatter import TEMPLATE_ERROR, template_field_references
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import sort_key
 from calibre.utils.iso8601 import parse_iso8601
 from calibre.utils.localization import canonicalize_lang
-from polyglot.builtins import cmp
 
 
 class ExtraFile(NamedTuple):
@@ -137,6 +140,28 @@ def _add_default_custom_column_values(mi, fm):
 
 dynamic_category_preferences = frozenset({'grouped_search_make_user_categories', 'grouped_search_terms', 'user_categories'})
 
+# Names used by templates, that are not field names, mapped to the fields they
+# read, see calibre.db.lazy.getters
+template_name_fields = {
+    'application_id': (), 'id': (),
+    'author_sort_map': ('authors', 'author_sort'),
+    'book_size': ('size',),
+    'db_approx_formats': ('formats',),
+    'format_metadata': ('formats', 'format_metadata'),
+    'formats': ('formats', 'format_metadata'),
+    'has_cover': ('cover',),
+    'language': ('languages',),
+    'ondevice_col': ('ondevice',),
+    'series_index': ('series', 'series_index'),
+    'title_sort': ('sort',),
+}
+template_name_fields.update(dict.fromkeys(TOP_LEVEL_IDENTIFIERS, ('identifiers',)))
+
+# Fields whose values can change without the last modified date of the book
+# changing. format_metadata is the size and modification time of the format
+# files.
+volatile_fields = frozenset(('ondevice', 'pages', 'format_metadata'))
+
 
 class Cache:
     '''
@@ -170,12 +195,17 @@ def __init__(self, backend, library_database_instance=None):
         self.dirtied_cache = {}
         self.link_maps_cache = {}
         self.extra_files_cache = {}
+        self.sort_keys_cache = {}
+        self.table_snapshot = None
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
         self.vls_cache_lock = Lock()
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        self.categories_cache = CategoriesCache()
+        self.composite_dependencies = None
+        self.composite_cache_path = None
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -276,16 +306,73 @@ def initialize_template_cache(self):
     @write_api
     def set_user_template_functions(self, user_template_functions):
         self.backend.set_user_template_functions(user_template_functions)
+        self.composite_dependencies = None
+        self._clear_composite_caches()
+
+    def _composite_dependencies(self):
+        # Map of composite column to the set of fields its template reads,
+        # directly or via other composite columns, or None if not known
+        if self.composite_dependencies is not None:
+            return self.composite_dependencies
+        fm = self.field_metadata
+
+        def fields_for(name):
+            ans = template_name_fields.get(name)
+            if ans is None:
+                name = fm.search_term_to_field_key(name)
+                f = self.fields.get(name)
+                if f is None:
+                    raise KeyError(name)
+                index_field = getattr(f, 'index_field', None)
+                ans = (name,) if index_field is None else (name, index_field.name)
+            return ans
+
+        ans = {}
+        for name, field in self.composites.items():
+            refs = field.field_references()
+            try:
+                ans[name] = None if refs is None else frozenset(x for ref in refs for x in fields_for(ref))
+            except KeyError:
+                ans[name] = None
+        changed = True
+        while changed:
+            changed = False
+            for name, deps in ans.items():
+                if deps is None:
+                    continue
+                for c in deps.intersection(ans):
+                    cdeps = ans[c]
+                    if cdeps is None or not cdeps <= deps:
+                        ans[name] = deps = None if cdeps is None else deps | cdeps
+                        changed = True
+                        if deps is None:
+                            break
+        self.composite_dependencies = ans
+        return ans
 
     @write_api
-    def clear_composite_caches(self, book_ids=None):
-        for field in self.composites.values():
-            field.clear_caches(book_ids=book_ids)
+    def clear_composite_caches(self, book_ids=None, fields=None):
+        ''' Clear the cached values of composite columns. If fields is
+        specified, only the columns whose templates might read one of the
+        fields are cleared. '''
+        if fields is None:
+            cleared = tuple(self.composites)
+        else:
+            fields = frozenset(fields)
+            cleared = tuple(name for name, deps in self._composite_dependencies().items()
+                            if deps is None or not fields.isdisjoint(deps))
+        for name in cleared:
+            self.composites[name].clear_caches(book_ids=book_ids)
+        # Composite values can change without the data generation changing,
+        # for example when templates change, so drop their categories. The
+        # categories of other fields are kept, they depend only on the change
+        # counts of the fields they are computed from.
+        self.categories_cache.discard(cleared)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, fields)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
@@ -300,6 +387,18 @@ def clear_extra_files_cache(self, book_id=None):
     def last_modified(self):
         return self.backend.last_modified()
 
+    @read_api
+    def data_generation(self):
+        '''
+        Return a value that changes whenever books are added or removed, their
+        metadata is changed or the library preferences are changed. Unlike
+        :meth:`last_modified` it is not affected by changes such as reading
+        positions or annotations. Useful for invalidating caches of data
+        derived from the library, such as the Tag browser. Only changes made
+        through this object are tracked.
+        '''
+        return self.event_dispatcher.change_count, self.backend.prefs.change_count, self.clear_search_cache_count
+
     def __enter__(self):
         self.backend.__enter__()
 
@@ -311,8 +410,11 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if template_cache:
             self._initialize_template_cache()  # Clear the formatter template cache
         for field in self.fields.values():
-            if hasattr(field, 'clear_caches'):
-                field.clear_caches(book_ids=book_ids)  # Clear the composite cache and ondevice caches
+            if hasattr(field, 'clear_caches') and not field.is_composite:
+                field.clear_caches(book_ids=book_ids)  # Clear the ondevice caches
+        # Changes to the fields of books clear the composite columns that use
+        # them, so only clear the columns that could have changed otherwise
+        self._clear_composite_caches(book_ids, volatile_fields)
         if book_ids:
             for book_id in book_ids:
                 self.format_metadata_cache.pop(book_id, None)
@@ -321,6 +423,28 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if search_cache:
             self._clear_search_caches(book_ids)
         self._clear_link_map_cache(book_ids)
+        self._clear_sort_keys_cache(book_ids)
+        self.categories_cache.clear()
+
+    @write_api
+    def clear_sort_keys_cache(self, book_ids=None, fields=None):
+        ''' Clear the cached sort keys used by :meth:`multisort` for the
+        specified books (all books if None) and fields (all fields if None). '''
+        if fields is None:
+            names = tuple(self.sort_keys_cache)
+        else:
+            fields = frozenset(fields)
+            # The sort keys for series depend on the language of the book
+            languages_changed = 'languages' in fields
+            names = tuple(name for name in self.sort_keys_cache if name in fields or name + '_index' in fields or (
+                languages_changed and self.fields[name].metadata['datatype'] == 'series'))
+        for name in names:
+            if book_ids is None:
+                del self.sort_keys_cache[name]
+            else:
+                keys = self.sort_keys_cache[name]
+                for book_id in book_ids:
+                    keys.pop(book_id, None)
 
     @write_api
     def clear_link_map_cache(self, book_ids=None):
@@ -334,12 +458,17 @@ def clear_link_map_cache(self, book_ids=None):
     def reload_from_db(self, clear_caches=True):
         if clear_caches:
             self._clear_caches()
+            self._clear_composite_caches()
+        self.table_snapshot = None
         with self.backend.conn:  # Prevent other processes, such as calibredb from interrupting the reload by locking the db
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
+            self._search_api.clear_plan_cache()
             for field in self.fields.values():
                 if hasattr(field, 'table'):
                     field.table.read(self.backend)  # Reread data from metadata.db
+                    field.table.lazy_db = None  # The table is no longer read lazily
+        self.event_dispatcher.record_change()
 
     @property
     def field_metadata(self):
@@ -437,12 +566,40 @@ def _get_metadata(self, book_id, get_user_categories=True):  # {{{
     # }}}
 
     @api
-    def init(self):
+    def init(self, table_snapshot=False, lazy_tables=False, compact_tables=False, composite_cache=False):
         '''
         Initialize this cache with data from the backend.
+
+        :param table_snapshot: If True, or the path to a file, the tables are
+            loaded from a snapshot saved when the library was last closed, if
+            metadata.db has not been changed since then, and a snapshot is
+            saved when the library is closed. Useful for processes that open
+            large libraries often, such as calibredb and the server.
+
+        :param lazy_tables: If True, the data for each table is read from
+            metadata.db only when it is first used, instead of reading all
+            tables now. Useful for short lived processes that use only a few
+            fields, such as calibredb.
+
+        :param compact_tables: If True, the data for many-to-many fields such
+            as tags and authors is stored in a compact form that uses much less
+            memory, at the cost of slightly slower access. Useful for
+            processes that keep many large libraries open, such as the server.
+
+        :param composite_cache: If True, or the path to a file, the values of
+            composite columns are saved when the library is closed and used
+            for the books that have not been modified since then. Only columns
+            whose templates read a known set of fields are saved.
         '''
         with self.write_lock:
-            self.backend.read_tables()
+            if compact_tables:
+                for table in self.backend.tables.values():
+                    if table.supports_compact_maps:
+                        table.use_compact_maps = True
+            if table_snapshot:
+                self._read_tables_with_snapshot(table_snapshot, lazy_tables)
+            else:
+                self.backend.read_tables(lazy=lazy_tables)
             bools_are_tristate = self.backend.prefs['bools_are_tristate']
 
             for field, table in self.backend.tables.items():
@@ -467,10 +624,99 @@ def init(self):
                     field.title_sort_field = self.fields['sort']
             if self.backend.prefs.get('full_page_scan_requested'):
                 self._queue_pages_scan(by_user=False)
+            if composite_cache and self.composites:
+                self._load_composite_cache(composite_cache)
         if self.backend.prefs['update_all_last_mod_dates_on_start']:
             self.update_last_modified(self.all_book_ids())
             self.backend.prefs.set('update_all_last_mod_dates_on_start', False)
 
+    def _read_tables_with_snapshot(self, path, lazy=False):
+        from calibre.db.snapshot import db_file_signature, load_snapshot, snapshot_key, snapshot_path
+        b = self.backend
+        if not isinstance(path, str):
+            path = snapshot_path(b.library_id)
+        key = snapshot_key(b, b.user_version, db_file_signature(b.dbpath))
+        state = None if key[-1] is None else load_snapshot(path, key)
+        if state is None:
+            b.read_tables(lazy=lazy)
+        else:
+            # The snapshot contains only the tables that were read, when
+            # tables are read lazily
+            for name, table in b.tables.items():
+                if name in state:
+                    table.restore(state[name])
+            b.read_tables(lazy=lazy, tables=tuple(t for name, t in b.tables.items() if name not in state))
+        # data_version changes only when some other connection changes the
+        # database, in which case the in-memory tables are stale
+        self.table_snapshot = {
+            'path': path, 'key': key, 'loaded': state is not None, 'tables': frozenset(state or ()),
+            'conn': b.conn, 'data_version': b.conn.get('PRAGMA main.data_version', all=False),
+        }
+
+    def _table_snapshot_is_current(self):
+        ts, b = self.table_snapshot, self.backend
+        return ts is not None and getattr(b, '_conn', None) is ts['conn'] and (
+            b.conn.get('PRAGMA main.data_version', all=False) == ts['data_version'])
+
+    def _save_table_snapshot(self, user_version, signature):
+        # Must be called after the backend is closed, with the signature of
+        # the database file taken when the in-memory tables were known to be
+        # current. If the file has changed since, some other process has
+        # changed the database and the tables are stale.
+        from calibre.db.snapshot import db_file_signature, save_snapshot, snapshot_key
+        ts, b = self.table_snapshot, self.backend
+        if db_file_signature(b.dbpath) != signature:
+            return
+        key = snapshot_key(b, user_version, signature)
+        # Tables being read lazily that were never used are not saved
+        tables = {name: table for name, table in b.tables.items() if table.snapshot_attrs and table.is_read}
+        if key[-1] is None or (ts['loaded'] and key == ts['key'] and ts['tables'].issuperset(tables)):
+            return
+        state = {name: table.snapshot() for name, table in tables.items()}
+        try:
+            save_snapshot(ts['path'], key, state)
+        except Exception:
+            traceback.print_exc()
+
+    def _persistent_composites(self):
+        # Map of the composite columns whose values can be saved to a key that
+        # changes when their template or the fields they read change
+        fm, ans = self.field_metadata, {}
+        for name, deps in self._composite_dependencies().items():
+            if deps is not None and deps.isdisjoint(volatile_fields):
+                ans[name] = (self.composites[name].metadata['display']['composite_template'], tuple(
+                    (dep, repr({k: fm[dep].get(k) for k in ('datatype', 'display', 'is_multiple')}) if dep in fm else None)
+                    for dep in sorted(deps)))
+        return ans
+
+    def _load_composite_cache(self, path):
+        from calibre.db.snapshot import composite_cache_key, composite_cache_path, load_snapshot
+        if not isinstance(path, str):
+            path = composite_cache_path(self.backend.library_id)
+        self.composite_cache_path = path
+        state = load_snapshot(path, composite_cache_key(self.backend))
+        if not state:
+            return
+        last_modified = self.fields['last_modified'].table.book_col_map
+        for name, key in self._persistent_composites().items():
+            saved_key, vals = state.get(name, (None, None))
+            if saved_key == key:
+                self.composites[name].restore_cached_values({
+                    book_id: val for book_id, (lm, val) in vals.items() if last_modified.get(book_id) == lm})
+
+    def _save_composite_cache(self):
+        from calibre.db.snapshot import composite_cache_key, save_snapshot
+        last_modified = self.fields['last_modified'].table.book_col_map
+        state = {}
+        for name, key in self._persistent_composites().items():
+            state[name] = key, {
+                book_id: (last_modified[book_id], val) for book_id, val in self.composites[name].cached_values().items()
+                if book_id in last_modified}
+        try:
+            save_snapshot(self.composite_cache_path, composite_cache_key(self.backend), state)
+        except Exception:
+            traceback.print_exc()
+
     # FTS API {{{
     def initialize_fts(self):
         self.fts_queue_thread = None
@@ -998,7 +1244,9 @@ def get_usage_count_by_id(self, field):
         ''' Return a mapping of id to usage count for all values of the specified
         field, which must be a many-one or many-many field. '''
         try:
-            return {k:len(v) for k, v in self.fields[field].table.col_book_map.items()}
+            cbm = self.fields[field].table.col_book_map
+            # Compact maps can count the books without copying them
+            return {k:len(v) for k, v in getattr(cbm, 'raw_items', cbm.items)()}
         except AttributeError:
             raise ValueError(f'{field} is not a many-one or many-many field')
 
@@ -1168,6 +1416,8 @@ def set_pref(self, name, val, namespace=None):
             self.backend.prefs.set_namespaced(namespace, name, val)
             return
         self.backend.prefs.set(name, val)
+        if name in ('grouped_search_terms', 'saved_searches'):
+            self._search_api.clear_plan_cache()
         if name in ('grouped_search_terms', 'virtual_libraries'):
             self._clear_search_caches()
         if name in dynamic_category_preferences:
@@ -1195,7 +1445,7 @@ def get_metadata(self, book_id,
                 composite_cache_needs_to_be_cleared = True
         if composite_cache_needs_to_be_cleared:
             try:
-                self.clear_composite_caches()
+                self.clear_composite_caches(fields=('virtual_libraries',))
             except LockingError:
                 # We can't clear the composite caches because a read lock is set.
                 # As a consequence the value of a composite column that calls
@@ -1221,6 +1471,43 @@ def get_proxy_metadata(self, book_id):
         accessed from the returned metadata object. '''
         return ProxyMetadata(self, book_id)
 
+    def _proxy_metadata_for_books(self, book_ids, names=(), formatter=None):
+        return proxy_metadata_for_books(self, book_ids, names or (), formatter)
+
+    @read_api
+    def evaluate_template_for_books(self, template, book_ids, error_value=TEMPLATE_ERROR,
+        column_name=None, template_cache=None, template_functions=None, global_vars=None, formatter=None
+    ):
+        '''
+        Evaluate the template for every book in book_ids, returning a map of
+        book_id to result. This gives the same results as calling
+        formatter.safe_format() with the ProxyMetadata of each book, but is
+        much faster for many books: the template is parsed only once, a single
+        formatter is used and the values of the fields the template uses are
+        read a column at a time.
+
+        :param column_name: The name used to cache the parsed template in
+            template_cache. If None, the template is cached only for the
+            duration of this call.
+        :param global_vars: A dict of global variables, copied for every book.
+        :param formatter: The formatter to use, a SafeFormat if None.
+        '''
+        if column_name is None or template_cache is None:
+            # An empty column name makes the formatter cache the parsed
+            # template without being used in error messages
+            template_cache = {}
+            column_name = column_name or ''
+        formatter = SafeFormat() if formatter is None else formatter
+        pm_map = self._proxy_metadata_for_books(
+            book_ids, template_field_references(template, template_functions), formatter)
+        db = self.database_instance()
+        ans = {}
+        for book_id, mi in pm_map.items():
+            ans[book_id] = formatter.safe_format(
+                template, mi, error_value, mi, column_name=column_name, template_cache=template_cache,
+                template_functions=template_functions, global_vars=dict(global_vars or {}), database=db)
+        return ans
+
     @api
     def cover(self, book_id,
             as_file=False, as_image=False, as_path=False, as_pixmap=False):
@@ -1536,15 +1823,18 @@ def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
         ascending=True or False). The most significant field is the first
         2-tuple.
         '''
-        ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
+        ids_to_sort = tuple(self._all_book_ids() if ids_to_sort is None else ids_to_sort)
         get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
+        lang_map = None
         virtual_fields = virtual_fields or {}
 
         fm = {'title':'sort', 'authors':'author_sort'}
 
         def sort_key_func(field):
             'Handle series type fields, virtual fields and the id field'
+            nonlocal lang_map
+            if lang_map is None:
+                lang_map = self.fields['languages'].book_value_map
             idx = field + '_index'
             is_series = idx in self.fields
             try:
@@ -1562,64 +1852,51 @@ def skf(book_id):
                 return skf
             return func
 
-        # Sort only once on any given field
-        fields = uniq(fields, operator.itemgetter(0))
-
-        if len(fields) == 1:
-            keyfunc = sort_key_func(fields[0][0])
-            reverse = not fields[0][1]
+        def cached_sort_key_func(field):
+            ''' Sort keys for fields whose values are stored in the database are
+            cached, so they are only calculated for books whose values have
+            changed since the last sort '''
+            name = fm.get(field, field)
+            f = self.fields.get(name)
+            if f is not None and f.is_composite:
+                f.render_books(ids_to_sort)
+            if f is None or f.is_composite or name == 'ondevice':
+                return sort_key_func(field)
+            keys = self.sort_keys_cache.get(name)
+            if keys is None:
+                keys = self.sort_keys_cache[name] = {}
+            missing = tuple(filterfalse(keys.__contains__, ids_to_sort))
+            if missing:
+                keys.update(zip(missing, map(sort_key_func(field), missing)))
+            return keys.__getitem__
+
+        def sort_on_field(book_ids, field, ascending):
+            keyfunc = None
+            reverse = not ascending
             try:
-                return sorted(ids_to_sort, key=keyfunc, reverse=reverse)
+                # The sort keys are calculated here, so that errors in them
+                # are handled by the fallbacks below
+                keyfunc = cached_sort_key_func(field)
+                return sorted(book_ids, key=keyfunc, reverse=reverse)
             except Exception as err:
-                print('Failed to sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
+                print('Failed to sort database on field:', field, 'with error:', err, file=sys.stderr)
                 try:
-                    return sorted(ids_to_sort, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
+                    if keyfunc is None:
+                        keyfunc = sort_key_func(field)
+                    return sorted(book_ids, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
                 except Exception as err:
-                    print('Failed to type-safe sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
-                    return sorted(ids_to_sort, reverse=reverse)
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
-
-        class SortKey:
-
-            __slots__ = 'book_id', 'sort_key'
-
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
-
-            def compare_to_other(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
-
-            def __eq__(self, other):
-                return self.compare_to_other(other) == 0
-
-            def __ne__(self, other):
-                return self.compare_to_other(other) != 0
-
-            def __lt__(self, other):
-                return self.compare_to_other(other) < 0
-
-            def __le__(self, other):
-                return self.compare_to_other(other) <= 0
+                    print('Failed to type-safe sort database on field:', field, 'with error:', err, file=sys.stderr)
+                    return sorted(book_ids, reverse=reverse)
 
-            def __gt__(self, other):
-                return self.compare_to_other(other) > 0
-
-            def __ge__(self, other):
-                return self.compare_to_other(other) >= 0
-
-        return sorted(ids_to_sort, key=SortKey)
+        # Sort only once on any given field
+        fields = uniq(fields, operator.itemgetter(0))
+        ans = list(ids_to_sort)
+        # Since sorting is stable, sorting on each field in turn, starting with
+        # the least significant, is the same as sorting on all fields at once,
+        # but uses only the fast builtin comparison of sort keys.
+        for field, ascending in reversed(fields):
+            ans = sort_on_field(ans, field, ascending)
+        return ans
 
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None, allow_templates=True):
@@ -1671,22 +1948,26 @@ def get_categories(self, sort='name', book_ids=None, already_fixed=None,
                 raise
             with self.write_lock:
                 self.fields[bad_field].table.fix_link_table(self.backend)
+                self.event_dispatcher.record_change(bad_field)
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
+            if changed_fields is not None:
+                changed_fields = frozenset(changed_fields) | {'last_modified'}
             if self.composites:
-                self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+                self._clear_composite_caches(book_ids, changed_fields)
+            self._clear_search_caches(book_ids, changed_fields)
+            self._clear_sort_keys_cache(book_ids, changed_fields)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1727,12 +2008,89 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
             both have the tag ``tag1``.
         :param do_path_update: Used internally, you should never change it.
         '''
+        dirtied, changed_fields = self._write_field(name, book_id_to_val_map, allow_case_change)
+        if dirtied:
+            if name in {'title', 'authors'} and do_path_update:
+                self._update_path(dirtied, mark_as_dirtied=False)
+            self._mark_as_dirty(dirtied, changed_fields=changed_fields)
+            self._clear_link_map_cache(dirtied)
+            self.event_dispatcher(EventType.metadata_changed, name, dirtied)
+        return dirtied
+
+    @write_api
+    def bulk_update(self, field_map, allow_case_change=True):
+        '''
+        Set the values of many fields for many books at once. Equivalent to
+        calling :meth:`set_field` for every field, but much faster for large
+        numbers of books, as all changes are made in a single transaction and
+        books are marked as dirty and caches are cleared only once. Returns the
+        set of all book ids that were affected by the changes. If an error
+        occurs, no changes are made.
+
+        :param field_map: Mapping of field names to mappings of book_ids to
+            values, as accepted by :meth:`set_field`. Fields are set in the order
+            they appear in the mapping.
+        :param allow_case_change: See :meth:`set_field`.
+        '''
+        dirtied, changed_fields, path_changed, field_dirtied = set(), set(), set(), {}
+        if iswindows:
+            # Check all books whose paths will change before changing anything
+            self._check_files_not_in_use({book_id for name in ('title', 'authors') for book_id in field_map.get(name, ())})
+        try:
+            with self.backend.conn:
+                for name, book_id_to_val_map in field_map.items():
+                    d, cf = self._write_field(name, book_id_to_val_map, allow_case_change, check_files_in_use=False)
+                    if d:
+                        field_dirtied[name] = d
+                        dirtied |= d
+                        changed_fields |= cf
+                        if name in {'title', 'authors'}:
+                            path_changed |= d
+                if dirtied:
+                    self._mark_as_dirty(dirtied, changed_fields=changed_fields)
+        except Exception:
+            # The changes to the db have been rolled back, so re-read the
+            # in-memory tables that could have been changed
+            names = {'last_modified'}
+            for name in field_map:
+                names |= self._fields_changed_by(name)
+            with self.backend.conn:
+                for name in names:
+                    self.fields[name].table.read(self.backend)
+            self._clear_caches()
+            self._clear_composite_caches(fields=names)
+            raise
+        if path_changed:
+            self._update_path(path_changed, mark_as_dirtied=False)
+        if dirtied:
+            self._clear_link_map_cache(dirtied)
+            for name, d in field_dirtied.items():
+                self.event_dispatcher(EventType.metadata_changed, name, d)
+        return dirtied
+
+    def _fields_changed_by(self, name):
+        # The fields whose values are changed when writing the specified field
+        ans = {name}
+        if self.fields[name].metadata['datatype'] == 'series':
+            ans.add(name + '_index')
+        elif name == 'title':
+            ans.add('sort')
+        elif name == 'authors':
+            ans.add('author_sort')
+        return ans
+
+    def _check_files_not_in_use(self, book_ids):
+        paths = (x for x in (self._get_book_path(book_id, sep='/', unsafe=True) for book_id in book_ids) if x)
+        self.backend.windows_check_if_files_in_use(paths)
+
+    def _write_field(self, name, book_id_to_val_map, allow_case_change, check_files_in_use=True):
+        # Write the values to the db and the in-memory table, returning the
+        # affected books and the fields that changed, without marking
+        # the books as dirty
         f = self.fields[name]
         is_series = f.metadata['datatype'] == 'series'
-        update_path = name in {'title', 'authors'}
-        if update_path and iswindows:
-            paths = (x for x in (self._get_book_path(book_id, sep='/', unsafe=True) for book_id in book_id_to_val_map) if x)
-            self.backend.windows_check_if_files_in_use(paths)
+        if name in {'title', 'authors'} and iswindows and check_files_in_use:
+            self._check_files_not_in_use(book_id_to_val_map)
 
         if is_series:
             bimap, simap = {}, {}
@@ -1757,13 +2115,7 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
             sf = self.fields[f.name+'_index']
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
 
-        if dirtied:
-            if update_path and do_path_update:
-                self._update_path(dirtied, mark_as_dirtied=False)
-            self._mark_as_dirty(dirtied)
-            self._clear_link_map_cache(dirtied)
-            self.event_dispatcher(EventType.metadata_changed, name, dirtied)
-        return dirtied
+        return dirtied, self._fields_changed_by(name)
 
     # Page counts {{{
     @read_api
@@ -1849,7 +2201,8 @@ def set_pages(
                 timestamp = excluded.timestamp, needs_scan = excluded.needs_scan;
         ''', (book_id, int(pages), int(algorithm), format, int(format_size), now))
         self.fields['pages'].table.book_col_map[book_id] = pages
-        self._clear_composite_caches((book_id,))
+        self._clear_composite_caches((book_id,), ('pages',))
+        self._clear_sort_keys_cache((book_id,), ('pages',))
     # }}}
 
     @write_api
@@ -2378,6 +2731,10 @@ def create_book_entry(self, mi, cover=None, add_duplicates=True, force_id=None,
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        # The new book has to be checked against all cached searches, not just
+        # those for the fields that were set
+        self._clear_search_caches((book_id,))
+        self._clear_sort_keys_cache((book_id,))
 
         return book_id
 
@@ -2622,12 +2979,14 @@ def set_conversion_options(self, options, fmt='PIPE'):
     def refresh_format_cache(self):
         self.fields['formats'].table.read(self.backend)
         self.format_metadata_cache.clear()
+        self.sort_keys_cache.pop('formats', None)
+        self.event_dispatcher.record_change('formats')
 
     @write_api
     def refresh_ondevice(self):
         self.fields['ondevice'].clear_caches()
         self.clear_search_caches()
-        self.clear_composite_caches()
+        self.clear_composite_caches(fields=('ondevice',))
 
     @read_api
     def books_matching_device_book(self, lpath):
@@ -2688,6 +3047,8 @@ def tags_older_than(self, tag, delta=None, must_have_tag=None, must_have_authors
     @write_api
     def set_sort_for_authors(self, author_id_to_sort_map, update_books=True):
         sort_map = self.fields['authors'].table.set_sort_names(author_id_to_sort_map, self.backend)
+        if sort_map:
+            self.event_dispatcher.record_change('authors')
         changed_books = set()
         if update_books:
             val_map = {}
@@ -2850,6 +3211,8 @@ def set_custom_column_metadata(self, num, name=None, label=None, is_editable=Non
                                    display=None, update_last_modified=False):
         changed = self.backend.set_custom_column_metadata(num, name=name, label=label, is_editable=is_editable, display=display)
         if changed:
+            self.composite_dependencies = None
+            self._clear_composite_caches()
             if update_last_modified:
                 self._update_last_modified(self._all_book_ids())
             else:
@@ -2980,6 +3343,8 @@ def saved_search_delete(self, name):
     @write_api
     def saved_search_add(self, name, val):
         self._search_api.saved_searches.add(name, val)
+        # An existing saved search could have been replaced
+        self._clear_search_caches()
 
     @write_api
     def saved_search_rename(self, old_name, new_name):
@@ -3050,7 +3415,21 @@ def close(self):
         if m is not None:
             m.wait_for_worker_shutdown()
         with self.write_lock:
+            # The signature of the database file is taken before checking
+            # data_version, so that changes by other processes after it is
+            # taken are either detected by the check or change the signature
+            signature = None
+            if self.table_snapshot is not None:
+                from calibre.db.snapshot import db_file_signature
+                signature = db_file_signature(self.backend.dbpath)
+            save_snapshot = signature is not None and self._table_snapshot_is_current()
+            if save_snapshot:
+                user_version = self.backend.user_version
+            if self.composite_cache_path is not None:
+                self._save_composite_cache()
             self.backend.close()
+            if save_snapshot:
+                self._save_table_snapshot(user_version, signature)
 
     @property
     def is_closed(self):
@@ -8,6 +8,7 @@
 import copy
 from collections import OrderedDict
 from functools import partial
+from threading import Lock
 
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.config_base import prefs, tweaks
@@ -57,6 +58,13 @@ def __init__(self, name, id=None, count=0, state=0, avg=0, sort=None,
         self.search_expression = search_expression
         self.original_categories = None
 
+    def copy(self):
+        ' A shallow copy, note that the id_set is shared with the copy '
+        ans = Tag.__new__(Tag)
+        for k in self.__slots__:
+            setattr(ans, k, getattr(self, k))
+        return ans
+
     @property
     def string_representation(self):
         return f'{self.name}:{self.count}:{self.id}:{self.state}:{self.category}:{self.original_categories}'
@@ -80,6 +88,61 @@ def from_dict(cls, d):
         return ans
 
 
+class CategoriesCache:  # {{{
+
+    '''
+    An LRU cache of the sorted list of Tags for individual categories, so that
+    only the categories whose data has changed are re-computed by
+    get_categories(). Entries are stored along with the generation of the data
+    they were computed from and are re-computed when the generation changes.
+    The cached Tags must never be modified, get_categories() returns copies.
+    '''
+
+    def __init__(self, max_size=256):
+        self.lock = Lock()
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def discard(self, categories):
+        ' Remove the cached entries for the specified categories '
+        categories = frozenset(categories)
+        with self.lock:
+            for key in tuple(self.items):
+                if key[0] in categories:
+                    del self.items[key]
+
+    def __call__(self, key, generation, create):
+        with self.lock:
+            x = self.items.get(key)
+            if x is not None and x[0] == generation:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return x[1]
+        # Create outside the lock, as get_categories() is called with the
+        # shared read lock held, so other threads can compute other categories
+        ans = create()
+        with self.lock:
+            self.misses += 1
+            self.items[key] = generation, ans
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return ans
+# }}}
+
+
+# The fields, other than the field itself, whose data is used for the
+# categories of a field. All fields use rating for the average ratings and
+# languages for series sort, None is for changes that can affect any field.
+CATEGORY_DEPENDENCIES = (None, 'rating', 'languages')
+EXTRA_CATEGORY_DEPENDENCIES = {'authors': ('author_sort',), 'news': ('tags',)}
+
+
 def find_categories(field_metadata):
     for category, cat in field_metadata.iter_items():
         if (cat['is_category'] and cat['kind'] not in {'user', 'search'}):
@@ -235,10 +298,11 @@ def get_metadata(book_id):
     bids = None
     uncollapsed_categories = () if uncollapsed_categories is None else uncollapsed_categories
 
-    for category, is_multiple, is_composite in find_categories(fm):
-        fl_sort = False if category in uncollapsed_categories else bool(first_letter_sort)
-        tag_class = create_tag_class(category, fm)
-        sort_on, reverse = sort, False
+    field_change_counts = dbcache.event_dispatcher.field_change_counts
+    categories_cache = dbcache.categories_cache
+
+    def create_categories(category, is_multiple, is_composite, tag_class, sort_on, reverse, fl_sort):
+        nonlocal bids
         if is_composite:
             if bids is None:
                 bids = dbcache._all_book_ids() if book_ids is None else book_ids
@@ -250,11 +314,8 @@ def get_metadata(book_id):
             cat = fm[category]
             brm = book_rating_map
             dt = cat['datatype']
-            if dt == 'rating':
-                if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
-                if sort_on == 'name':
-                    sort_on, reverse = 'rating', True
+            if dt == 'rating' and category != 'rating':
+                brm = dbcache.fields[category].book_value_map
             cats = dbcache.fields[category].get_categories(
                 tag_class, brm, lang_map, book_ids)
             if (category != 'authors' and dt == 'text' and
@@ -264,14 +325,31 @@ def get_metadata(book_id):
         cats.sort(key=partial(category_sort_keys[fl_sort][sort_on],
                               hierarchical_categories=hierarchical_categories),
                   reverse=reverse)
-        categories[category] = cats
+        return cats
+
+    for category, is_multiple, is_composite in find_categories(fm):
+        fl_sort = False if category in uncollapsed_categories else bool(first_letter_sort)
+        tag_class = create_tag_class(category, fm)
+        sort_on, reverse = sort, False
+        if is_composite:
+            # Composites can depend on any data in the library
+            generation = dbcache._data_generation()
+        else:
+            if sort_on == 'name' and fm[category]['datatype'] == 'rating':
+                sort_on, reverse = 'rating', True
+            generation = tuple(field_change_counts.get(x, 0) for x in (
+                CATEGORY_DEPENDENCIES + EXTRA_CATEGORY_DEPENDENCIES.get(category, ()) + (category,)))
+        key = category, book_ids, sort_on, reverse, fl_sort, hierarchical_categories, tag_class.keywords['use_sort_as_name']
+        cats = categories_cache(key, generation, partial(
+            create_categories, category, is_multiple, is_composite, tag_class, sort_on, reverse, fl_sort))
+        categories[category] = [t.copy() for t in cats]
 
     # Needed for legacy databases that have multiple ratings that
     # map to n stars
     for r in categories['rating']:
         for x in tuple(categories['rating']):
             if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
+                r.id_set = r.id_set | x.id_set
                 r.count = len(r.id_set)
                 categories['rating'].remove(x)
                 break
@@ -177,7 +177,7 @@ def __exit__(self, *a):
     @property
     def db(self):
         if self._db is None:
-            self._db = LibraryDatabase(self.library_path)
+            self._db = LibraryDatabase(self.library_path, table_snapshot=True, lazy_tables=True)
         return self._db
 
     def path(self, path):
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Compact, column store versions of the book_col_map and col_book_map
+dictionaries of many-to-many tables. For large libraries, the dicts of tuples
+and sets use several times more memory than the ids they contain. Here, the
+ids are stored in CSR form: for every key k, its values are
+ids[offsets[k]:offsets[k+1]]. Keys are book or item ids, which are small
+positive integers, so offsets is indexed by the key directly.
+
+Changes are stored in a dict, so the maps support the same operations as the
+dicts they replace. Once the changes are more than a small fraction of the
+total, they are merged back into the CSR arrays, so the maps stay compact.
+'''
+
+from array import array
+from collections.abc import MutableMapping
+from itertools import accumulate
+
+_missing = object()
+_deleted = object()
+# Changes are merged into the CSR arrays when there are more than this many of
+# them and they are more than 1/COMPACT_FRACTION of the keys
+MIN_CHANGES_TO_COMPACT = 1024
+COMPACT_FRACTION = 16
+
+
+class CompactMap(MutableMapping):
+
+    __slots__ = ('changed', 'ids', 'length', 'offsets')
+
+    def __init__(self, data=None):
+        keys = sorted(k for k, v in data.items() if v) if data else ()
+        offsets = array('I', bytes(array('I').itemsize * ((keys[-1] + 2) if keys else 1)))
+        ids = array('I')
+        for k in keys:
+            ids.extend(data[k])
+            offsets[k + 1] = len(ids)
+        # Keys with no values have the same start and end offset
+        self.offsets = array('I', accumulate(offsets, max))
+        self.ids = ids
+        self.changed = {}
+        self.length = len(keys)
+
+    def __reduce__(self):
+        c = self.compacted() if self.changed else self
+        return _restore, (self.__class__, c.offsets, c.ids, c.length)
+
+    def _change(self, k, v):
+        changed = self.changed
+        if k not in changed and len(changed) >= max(MIN_CHANGES_TO_COMPACT, self.length // COMPACT_FRACTION):
+            self.compact()
+            changed = self.changed
+        changed[k] = v
+
+    def _base(self, k):
+        offsets = self.offsets
+        try:
+            if 0 <= k < len(offsets) - 1:
+                s, e = offsets[k], offsets[k + 1]
+                if s != e:
+                    return self.ids[s:e]
+        except TypeError:
+            pass
+
+    def __contains__(self, k):
+        v = self.changed.get(k, _missing)
+        if v is _missing:
+            return self._base(k) is not None
+        return v is not _deleted
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        changed, offsets = self.changed, self.offsets
+        for k in range(len(offsets) - 1):
+            if offsets[k] != offsets[k+1] and k not in changed:
+                yield k
+        for k, v in changed.items():
+            if v is not _deleted:
+                yield k
+
+    def __getitem__(self, k):
+        v = self.changed.get(k, _missing)
+        if v is _missing:
+            b = self._base(k)
+            if b is not None:
+                return self._convert(b)
+        elif v is not _deleted:
+            return v
+        raise KeyError(k)
+
+    def get(self, k, default=None):
+        v = self.changed.get(k, _missing)
+        if v is _missing:
+            b = self._base(k)
+            return default if b is None else self._convert(b)
+        return default if v is _deleted else v
+
+    def pop(self, k, default=_missing):
+        v = self.get(k, _missing)
+        if v is _missing:
+            if default is _missing:
+                raise KeyError(k)
+            return default
+        del self[k]
+        return v
+
+    def __setitem__(self, k, v):
+        is_new = k not in self
+        self._change(k, v)
+        if is_new:
+            self.length += 1
+
+    def __delitem__(self, k):
+        if k not in self:
+            raise KeyError(k)
+        if self._base(k) is None:
+            del self.changed[k]
+        else:
+            self._change(k, _deleted)
+        self.length -= 1
+
+    def items(self):
+        c = self._convert
+        for k, v in self.raw_items():
+            yield k, (c(v) if v.__class__ is array else v)
+
+    def raw_items(self):
+        ''' Like items() except that the values of unchanged keys are arrays
+        of ids, avoiding the cost of converting them. The values must not be
+        modified. '''
+        changed, offsets, ids = self.changed, self.offsets, self.ids
+        for k in range(len(offsets) - 1):
+            s, e = offsets[k], offsets[k+1]
+            if s != e and k not in changed:
+                yield k, ids[s:e]
+        for k, v in changed.items():
+            if v is not _deleted:
+                yield k, v
+
+    def values(self):
+        for k, v in self.items():
+            yield v
+
+    def clear(self):
+        self.offsets, self.ids = array('I', (0,)), array('I')
+        self.changed.clear()
+        self.length = 0
+
+    def copy(self):
+        return dict(self.items())
+
+    def compacted(self):
+        ''' Return a copy of this map with all changes merged into the CSR
+        arrays. '''
+        return self.__class__(dict(self.raw_items()))
+
+    def compact(self):
+        ''' Merge all changes into the CSR arrays of this map. As when
+        pickling, keys with no values are dropped. '''
+        c = self.compacted()
+        self.offsets, self.ids, self.changed, self.length = c.offsets, c.ids, {}, c.length
+
+
+def _restore(cls, offsets, ids, length):
+    ans = cls.__new__(cls)
+    ans.offsets, ans.ids, ans.changed, ans.length = offsets, ids, {}, length
+    return ans
+
+
+class BookItemsMap(CompactMap):
+
+    ''' Maps book ids to tuples of item ids, in link order '''
+
+    __slots__ = ()
+
+    _convert = tuple
+
+
+class ItemBooksMap(CompactMap):
+
+    '''
+    Maps item ids to sets of book ids. Like the defaultdict(set) it replaces,
+    indexing returns the (mutable) set for the item, creating it if needed.
+    That set must be modified immediately and not kept, since changes can be
+    merged into the CSR arrays whenever another item is changed. get() and
+    iteration return copies for items that have not been changed, which must
+    not be modified, so use get() to only read the books for an item.
+    '''
+
+    __slots__ = ()
+
+    _convert = set
+
+    def __getitem__(self, k):
+        v = self.changed.get(k, _missing)
+        if v is _missing:
+            b = self._base(k)
+            v = set(() if b is None else b)
+            self._change(k, v)
+            if b is None:
+                self.length += 1
+        elif v is _deleted:
+            v = self.changed[k] = set()
+            self.length += 1
+        return v
+
+    def has_books(self, k):
+        ''' Equivalent to bool(self.get(k)), without copying the book ids '''
+        v = self.changed.get(k, _missing)
+        if v is _missing:
+            return self._base(k) is not None
+        return v is not _deleted and bool(v)
@@ -15,9 +15,10 @@
 from calibre.db.utils import atof, force_to_bool
 from calibre.db.write import Writer
 from calibre.ebooks.metadata import author_to_author_sort, rating_to_stars, title_sort
+from calibre.ebooks.metadata.book.formatter import SafeFormat
 from calibre.utils.config_base import tweaks
 from calibre.utils.date import UNDEFINED_DATE, clean_date_for_sort, parse_date
-from calibre.utils.formatter import TEMPLATE_ERROR
+from calibre.utils.formatter import TEMPLATE_ERROR, template_field_references
 from calibre.utils.icu import sort_key
 from calibre.utils.localization import calibre_langcode_to_name
 
@@ -237,6 +238,7 @@ class CompositeField(OneToOneField):
 
     is_composite = True
     SIZE_SUFFIX_MAP = {suffix:i for i, suffix in enumerate(('', 'K', 'M', 'G', 'T', 'P', 'E'))}
+    RENDER_CHUNK_SIZE = 1000
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions, db_weakref):
         super().__init__(name, table, bools_are_tristate, get_template_functions, db_weakref)
@@ -327,6 +329,22 @@ def clear_caches(self, book_ids=None):
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
 
+    def field_references(self):
+        ''' The lookup names of the fields read by the template of this
+        column, or None if they cannot be determined without evaluating it.
+        See :func:`calibre.utils.formatter.template_field_references`. '''
+        return template_field_references(
+            self.metadata['display']['composite_template'], self.get_template_functions())
+
+    def cached_values(self):
+        with self._lock:
+            return self._render_cache.copy()
+
+    def restore_cached_values(self, book_id_to_val_map):
+        with self._lock:
+            for book_id, val in book_id_to_val_map.items():
+                self._render_cache.setdefault(book_id, val)
+
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
             ans = self._render_cache.get(book_id, None)
@@ -335,6 +353,24 @@ def get_value_with_cache(self, book_id, get_metadata):
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
         return ans
 
+    def render_books(self, book_ids):
+        ''' Render the values for all books in book_ids that are not already
+        cached in one go, reading the fields used by the template a column at a
+        time and sharing a single formatter. Must be called with the read lock
+        held. '''
+        with self._lock:
+            rc = self._render_cache
+            missing = [book_id for book_id in book_ids if book_id not in rc]
+        if len(missing) < 2:
+            return
+        db = self.db_weakref()
+        db = getattr(db, 'new_api', db)
+        names, formatter = self.field_references(), SafeFormat()
+        for i in range(0, len(missing), self.RENDER_CHUNK_SIZE):
+            chunk = missing[i:i+self.RENDER_CHUNK_SIZE]
+            for book_id, mi in db._proxy_metadata_for_books(chunk, names, formatter).items():
+                self.__render_composite(book_id, mi, formatter, mi.template_cache)
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         gv = self.get_value_with_cache
         sk = self._sort_key
@@ -345,6 +381,7 @@ def sort_keys_for_books(self, get_metadata, lang_map):
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         val_map = defaultdict(set)
         splitter = self.splitter
+        self.render_books(candidates)
         for book_id in candidates:
             vals = self.get_value_with_cache(book_id, get_metadata)
             vals = (vv.strip() for vv in vals.split(splitter)) if splitter else (vals,)
@@ -363,6 +400,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
     def iter_counts(self, candidates, get_metadata=None):
         val_map = defaultdict(set)
         splitter = self.splitter
+        self.render_books(candidates)
         for book_id in candidates:
             vals = self.get_value_with_cache(book_id, get_metadata)
             if splitter:
@@ -378,6 +416,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
                                  is_multiple, get_metadata):
         ans = []
         id_map = defaultdict(set)
+        self.render_books(book_ids)
         for book_id in book_ids:
             val = self.get_value_with_cache(book_id, get_metadata)
             vals = [x.strip() for x in val.split(is_multiple)] if is_multiple else [val]
@@ -396,6 +435,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids,
     def get_books_for_val(self, value, get_metadata, book_ids):
         is_multiple = self.table.metadata['is_multiple'].get('cache_to_list', None)
         ans = set()
+        self.render_books(book_ids)
         for book_id in book_ids:
             val = self.get_value_with_cache(book_id, get_metadata)
             vals = {x.strip() for x in val.split(is_multiple)} if is_multiple else [val]
@@ -784,7 +824,7 @@ def get_news_category(self, tag_class, book_ids=None):
         if news_id is None:
             return ans
 
-        news_books = self.table.col_book_map[news_id]
+        news_books = self.table.col_book_map.get(news_id, set())
         if book_ids is not None:
             news_books = news_books.intersection(book_ids)
         if not news_books:
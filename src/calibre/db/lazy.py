@@ -118,6 +118,7 @@ def func(dbref, book_id, cache):
             db = dbref()
             cache[field] = ret = db.field_for(field, book_id, default_value=default_value)
             return ret
+    func.prefetch = field, None, default_value
     return func
 
 
@@ -129,6 +130,7 @@ def func(dbref, book_id, cache):
             db = dbref()
             cache[field] = ret = postprocess(db.field_for(field, book_id, default_value=default_value))
             return ret
+    func.prefetch = field, postprocess, default_value
     return func
 
 
@@ -164,6 +166,7 @@ def func(dbref, book_id, cache):
             db = dbref()
             cache[field] = ret = db.field_for(field, book_id, default_value=utcnow())
             return ret
+    func.prefetch = field, None, utcnow
     return func
 
 
@@ -492,3 +495,35 @@ def smart_update(self, *args, **kwargs):
     @property
     def _proxy_metadata(self):
         return self
+
+
+def proxy_metadata_for_books(db, book_ids, names=(), formatter=None):
+    '''
+    Return a map of book_id to ProxyMetadata for all the books in book_ids,
+    sharing a single formatter. The values of the fields in names are read a
+    column at a time and stored in the returned objects up front, instead of
+    being looked up one book at a time when they are first used. Must be
+    called with the read lock held, db must be a Cache.
+    '''
+    formatter = SafeFormat() if formatter is None else formatter
+    ans = {book_id:ProxyMetadata(db, book_id, formatter=formatter) for book_id in book_ids}
+    um = db.field_metadata
+    for name in names:
+        prefetch = getattr(getters.get(name), 'prefetch', None)
+        if prefetch is None:
+            d = um.get(name) if name.startswith('#') else None
+            if d is None or d['datatype'] == 'composite' or (name.endswith('_index') and d['datatype'] == 'float'):
+                continue
+            prefetch = name, fmt_custom, None
+        field, postprocess, default_value = prefetch
+        field_obj = db.fields.get(field)
+        if field_obj is None or field_obj.is_composite:
+            continue
+        if callable(default_value):
+            default_value = default_value()
+        for book_id, mi in ans.items():
+            cache = ga(mi, '_cache')
+            if field not in cache:
+                val = db._fast_field_for(field_obj, book_id, default_value=default_value)
+                cache[field] = val if postprocess is None else postprocess(val)
+    return ans
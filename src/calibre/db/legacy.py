@@ -180,7 +180,7 @@ def exists_at(cls, path):
     def __init__(self, library_path,
             default_prefs=None, read_only=False, is_second_db=False,
             progress_callback=None, restore_all_prefs=False, row_factory=False,
-            temp_db_path=None):
+            temp_db_path=None, table_snapshot=False, lazy_tables=False, composite_cache=False):
 
         self.is_second_db = is_second_db
         if progress_callback is None:
@@ -194,7 +194,7 @@ def progress_callback(x, y):
                     load_user_formatter_functions=not is_second_db,
                     temp_db_path=temp_db_path)
         cache = self.new_api = Cache(backend, library_database_instance=self)
-        cache.init()
+        cache.init(table_snapshot=table_snapshot, lazy_tables=lazy_tables, composite_cache=composite_cache)
         self.data = View(cache)
         self.id = self.data.index_to_id
         self.row = self.data.id_to_index
@@ -2,6 +2,7 @@
 # License: GPL v3 Copyright: 2021, Kovid Goyal <kovid at kovidgoyal.net>
 
 import weakref
+from collections import defaultdict
 from contextlib import suppress
 from enum import Enum, auto
 from queue import Queue
@@ -50,6 +51,12 @@ class EventType(Enum):
     links_changed = auto()
 
 
+# Events whose first argument is the name of the field that was changed
+FIELD_EVENTS = frozenset((
+    EventType.metadata_changed, EventType.items_renamed, EventType.items_removed, EventType.notes_changed, EventType.links_changed))
+FORMAT_EVENTS = frozenset((EventType.format_added, EventType.formats_removed))
+
+
 class EventDispatcher(Thread):
 
     def __init__(self):
@@ -58,6 +65,11 @@ def __init__(self):
         self.queue = Queue()
         self.activated = False
         self.library_id = ''
+        # The number of changes to data in the library so far, in total and
+        # per field, with None for changes that can affect any field, updated
+        # synchronously
+        self.change_count = 0
+        self.field_change_counts = defaultdict(int)
 
     def add_listener(self, callback):
         # note that we intentionally leak dead weakrefs. To not do so would
@@ -80,7 +92,18 @@ def __contains__(self, callback):
         ref = weakref.ref(callback)
         return ref in self.refs
 
+    def record_change(self, field=None):
+        ' Record a change to data in the library, for changes that do not generate events '
+        self.change_count += 1
+        self.field_change_counts[field] += 1
+
     def __call__(self, event_name, *args):
+        if event_name in FIELD_EVENTS:
+            self.record_change(args[0])
+        elif event_name in FORMAT_EVENTS:
+            self.record_change('formats')
+        elif event_name is not EventType.indexing_progress_changed:
+            self.record_change()
         if self.activated:
             self.queue.put((event_name, self.library_id, args))
 
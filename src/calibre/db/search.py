@@ -10,11 +10,13 @@
 import weakref
 from collections import OrderedDict, deque
 from datetime import timedelta
-from functools import partial
+from functools import lru_cache, partial
+from threading import Lock
 
 import regex
 
 from calibre.constants import DEBUG, preferred_encoding
+from calibre.db.text_index import TextIndexes
 from calibre.db.utils import force_to_bool
 from calibre.utils.config_base import prefs
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
@@ -35,6 +37,7 @@ class TemplatesNotAllowed(ParseException):
 
 # Utils {{{
 
+@lru_cache(maxsize=512)
 def _matchkind(query, case_sensitive=False):
     matchkind = CONTAINS_MATCH
     if (len(query) > 1):
@@ -498,8 +501,10 @@ class Parser(SearchQueryParser):  # {{{
 
     def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
                  bool_search, keypair_search, limit_search_columns, limit_search_columns_to,
-                 locations, virtual_fields, lookup_saved_search, parse_cache, allow_templates=True):
+                 locations, virtual_fields, lookup_saved_search, parse_cache, plan_cache=None, allow_templates=True,
+                 text_indexes=None):
         self.allow_templates = allow_templates
+        self.text_indexes = text_indexes
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
@@ -512,7 +517,7 @@ def __init__(self, dbcache, all_book_ids, gst, date_search, num_search,
             self.virtual_fields['marked'] = self
         if 'in_tag_browser' not in self.virtual_fields:
             self.virtual_fields['in_tag_browser'] = self
-        SearchQueryParser.__init__(self, locations, optimize=True, lookup_saved_search=lookup_saved_search, parse_cache=parse_cache)
+        SearchQueryParser.__init__(self, locations, optimize=True, lookup_saved_search=lookup_saved_search, parse_cache=parse_cache, plan_cache=plan_cache)
 
     @property
     def field_metadata(self):
@@ -534,6 +539,14 @@ def iter_searchable_values(self, *args, **kwargs):
         for x in ():
             yield x, set()
 
+    def narrow_candidates(self, location, query, candidates):
+        ''' Use the text index for location, if any, to remove books that
+        cannot match a contains search for query from candidates. '''
+        field = self.dbcache.fields.get(location)
+        if self.text_indexes is None or field is None:
+            return candidates
+        return self.text_indexes.narrow(field, query, candidates, self.dbcache)
+
     def parse(self, *args, **kwargs):
         self.virtual_field_used = False
         return SearchQueryParser.parse(self, *args, **kwargs)
@@ -799,7 +812,10 @@ def fi(default_value=None):
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
+                c = current_candidates
+                if matchkind in (CONTAINS_MATCH, ACCENT_MATCH):
+                    c = self.narrow_candidates(location, q, c)
+                for val, book_ids in (self.field_iter(location, c) if c else ()):
                     if val is not None:
                         if isinstance(val, (str, bytes)):
                             val = (val,)
@@ -843,12 +859,14 @@ def get_user_category_matches(self, location, query, candidates):
 
 class LRUCache:  # {{{
 
-    'A simple Least-Recently-Used cache'
+    ''' A simple Least-Recently-Used cache. Safe to use from multiple threads
+    holding the read lock, as searches can run concurrently. '''
 
     def __init__(self, limit=50):
         self.item_map = {}
         self.age_map = deque()
         self.limit = limit
+        self.lock = Lock()
 
     def _move_up(self, key):
         if key != self.age_map[-1]:
@@ -856,33 +874,37 @@ def _move_up(self, key):
             self.age_map.append(key)
 
     def add(self, key, val):
-        if key in self.item_map:
-            self._move_up(key)
-            return
+        with self.lock:
+            if key in self.item_map:
+                self._move_up(key)
+                return
 
-        if len(self.age_map) >= self.limit:
-            self.item_map.pop(self.age_map.popleft())
+            if len(self.age_map) >= self.limit:
+                self.item_map.pop(self.age_map.popleft())
 
-        self.item_map[key] = val
-        self.age_map.append(key)
+            self.item_map[key] = val
+            self.age_map.append(key)
     __setitem__  = add
 
     def get(self, key, default=None):
-        ans = self.item_map.get(key, default)
-        if ans is not default:
-            self._move_up(key)
-        return ans
+        with self.lock:
+            ans = self.item_map.get(key, default)
+            if ans is not default:
+                self._move_up(key)
+            return ans
 
     def clear(self):
-        self.item_map.clear()
-        self.age_map.clear()
+        with self.lock:
+            self.item_map.clear()
+            self.age_map.clear()
 
     def pop(self, key, default=None):
-        self.item_map.pop(key, default)
-        try:
-            self.age_map.remove(key)
-        except ValueError:
-            pass
+        with self.lock:
+            self.item_map.pop(key, default)
+            try:
+                self.age_map.remove(key)
+            except ValueError:
+                pass
 
     def __contains__(self, key):
         return key in self.item_map
@@ -910,7 +932,10 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
         self.cache = LRUCache()
+        self.queried_fields = {}
         self.parse_cache = LRUCache(limit=100)
+        self.plan_cache = LRUCache(limit=100)
+        self.text_indexes = TextIndexes()
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -919,21 +944,58 @@ def change_locations(self, newlocs):
         if frozenset(newlocs) != frozenset(self.all_search_locations):
             self.clear_caches()
             self.parse_cache.clear()
+            self.plan_cache.clear()
+            self.text_indexes.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
-        else:
+    def clear_plan_cache(self):
+        ''' Clear the cached query plans, which have saved searches inlined.
+        Must be called whenever saved searches or grouped search terms change. '''
+        self.plan_cache.clear()
+
+    def update_or_clear(self, dbcache, book_ids=None, fields=None):
+        ''' Update the cached search results for the specified books. When
+        fields is not None, it must be the set of fields that were changed, in
+        which case only cached searches that query those fields are updated. '''
+        if not book_ids:
             self.clear_caches()
+            self.text_indexes.clear()
+            return
+        self.text_indexes.invalidate(book_ids, fields)
+        if fields is None:
+            if len(book_ids) * len(self.cache) <= self.MAX_CACHE_UPDATE:
+                self.update_caches(dbcache, book_ids)
+            else:
+                self.clear_caches()
+        else:
+            fields = frozenset(fields)
+            stale, unknown = [], []
+            for query, result in self.cache:
+                qf = self.queried_fields.get(query)
+                if qf is None:
+                    unknown.append(query)
+                elif not qf.isdisjoint(fields):
+                    stale.append(query)
+            # Searches that could depend on any field are handled as before,
+            # searches on specific fields are always updated incrementally as
+            # re-running them on only the changed books is cheap
+            if len(book_ids) * len(unknown) <= self.MAX_CACHE_UPDATE:
+                stale.extend(unknown)
+            else:
+                for query in unknown:
+                    self.cache.pop(query)
+                    self.queried_fields.pop(query, None)
+            if stale:
+                self.update_caches(dbcache, book_ids, stale)
 
     def clear_caches(self):
         self.cache.clear()
+        self.queried_fields.clear()
 
-    def update_caches(self, dbcache, book_ids):
+    def update_caches(self, dbcache, book_ids, queries=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, queries)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
@@ -942,10 +1004,14 @@ def discard_books(self, book_ids):
         for query, result in self.cache:
             result.difference_update(book_ids)
 
-    def _update_caches(self, sqp, book_ids):
+    def _update_caches(self, sqp, book_ids, queries=None):
         book_ids = sqp.all_book_ids = set(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        if queries is None:
+            items = tuple(self.cache)
+        else:
+            items = tuple((query, self.cache.item_map[query]) for query in queries if query in self.cache)
+        for query, result in items:
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -957,6 +1023,42 @@ def _update_caches(self, sqp, book_ids):
                 result.update(matches)
         for query in remove:
             self.cache.pop(query)
+            self.queried_fields.pop(query, None)
+
+    def fields_for_query(self, sqp, dbcache, query):
+        ''' Return the set of fields whose values can change the result of
+        query or None if the result can depend on any field, for example, for
+        searches over all fields, virtual libraries or composite columns. '''
+        fm = dbcache.field_metadata
+        ans = set()
+
+        def add(location, allow_recursion=True):
+            key = fm.search_term_to_field_key(icu_lower(location.strip()))
+            if isinstance(key, list):
+                # grouped search term
+                return allow_recursion and all(add(x, allow_recursion=False) for x in key)
+            field = dbcache.fields.get(key)
+            if field is None or field.is_composite:
+                return False
+            ans.add(key)
+            return True
+
+        for location, value in sqp.get_queried_fields(query):
+            if len(location) > 2 and location.startswith('@') and location[1:] in sqp.grouped_search_terms:
+                location = location[1:]
+            if not add(location):
+                return None
+        return frozenset(ans)
+
+    def cache_result(self, sqp, dbcache, query, result):
+        fields = self.fields_for_query(sqp, dbcache, query)
+        self.cache.add(query, result)
+        # Searches run concurrently from threads holding the read lock
+        with self.cache.lock:
+            self.queried_fields[query] = fields
+            if len(self.queried_fields) > len(self.cache):
+                # Forget the fields for searches that have expired from the cache
+                self.queried_fields = {q: f for q, f in self.queried_fields.items() if q in self.cache}
 
     def create_parser(self, dbcache, virtual_fields=None, allow_templates=True):
         return Parser(
@@ -965,7 +1067,8 @@ def create_parser(self, dbcache, virtual_fields=None, allow_templates=True):
             self.keypair_search,
             prefs['limit_search_columns'],
             prefs['limit_search_columns_to'], self.all_search_locations,
-            virtual_fields, self.saved_searches.lookup, self.parse_cache, allow_templates=allow_templates)
+            virtual_fields, self.saved_searches.lookup, self.parse_cache, self.plan_cache, allow_templates=allow_templates,
+            text_indexes=self.text_indexes)
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None, allow_templates=True):
         '''
@@ -1019,7 +1122,7 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
                 if cached is None:
                     restricted_ids = sqp.parse(sr)
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                        self.cache.add(sr, restricted_ids)
+                        self.cache_result(sqp, dbcache, sr, restricted_ids)
                 else:
                     restricted_ids = cached
                     if book_ids is not None:
@@ -1041,6 +1144,6 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.cache_result(sqp, dbcache, query, result)
 
         return result
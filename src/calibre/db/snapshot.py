@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+Snapshots of the in-memory tables of a library, saved when the library is
+closed, so that the next startup does not have to read every table from
+metadata.db. A snapshot is only used if metadata.db has not been changed since
+the snapshot was saved.
+
+Also, the rendered values of composite columns, which are used if the books
+have not been modified since they were saved.
+'''
+
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+
+from calibre.constants import cache_dir
+from calibre.utils.filenames import atomic_rename
+
+# Increase this when the format of the in-memory tables changes
+SNAPSHOT_VERSION = 1
+# Increase this when the format of the saved composite column values changes
+COMPOSITE_CACHE_VERSION = 1
+
+
+def snapshot_path(library_id):
+    return os.path.join(cache_dir(), 'db-snapshots', f'{library_id}.pickle')
+
+
+def db_file_signature(dbpath):
+    ''' Return a value that changes whenever the database file is changed or
+    None if the database could have uncommitted or un-checkpointed changes. '''
+    try:
+        st = os.stat(dbpath)
+    except OSError:
+        return None
+    for suffix in ('-journal', '-wal'):
+        try:
+            if os.path.getsize(dbpath + suffix) > 0:
+                return None
+        except OSError:
+            pass
+    return st.st_size, st.st_mtime_ns
+
+
+def snapshot_key(backend, user_version, signature):
+    return SNAPSHOT_VERSION, os.path.abspath(backend.dbpath), user_version, tuple(sorted(backend.tables)), signature
+
+
+def composite_cache_path(library_id):
+    return os.path.join(cache_dir(), 'db-snapshots', f'{library_id}-composites.pickle')
+
+
+def composite_cache_key(backend):
+    ''' Besides the data of the books, the values of composite columns depend
+    on the calibre version, the interface language, the timezone and the
+    tweaks. '''
+    from calibre.constants import numeric_version
+    from calibre.utils.config_base import tweaks
+    from calibre.utils.localization import get_lang
+    tweaks_signature = hashlib.sha1(repr(sorted(tweaks.items())).encode('utf-8')).hexdigest()
+    return (COMPOSITE_CACHE_VERSION, numeric_version, os.path.abspath(backend.dbpath), get_lang(),
+            time.tzname, time.timezone, tweaks_signature, backend.prefs['bools_are_tristate'])
+
+
+def load_snapshot(path, key):
+    ''' Return the table states saved in the snapshot at path, or None if
+    there is no snapshot saved for key. '''
+    try:
+        with open(path, 'rb') as f:
+            if pickle.load(f) != key:
+                return None
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def save_snapshot(path, key, state):
+    base = os.path.dirname(path)
+    os.makedirs(base, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=base, suffix='.tmp', delete=False) as f:
+        try:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    atomic_rename(f.name, path)
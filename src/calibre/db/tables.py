@@ -10,6 +10,7 @@
 from collections.abc import Iterable
 from datetime import datetime, timedelta
 
+from calibre.db.compact_maps import BookItemsMap, ItemBooksMap
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
@@ -54,6 +55,17 @@ def c_parse(val):
 class Table:
 
     supports_notes = False
+    # The attributes that hold the data read from the database, saved in
+    # table snapshots. Tables with no such attributes are always read from the
+    # database.
+    snapshot_attrs = ()
+    # If True, the data is stored in the compact representations from
+    # calibre.db.compact_maps, only possible for tables whose keys and values
+    # are integer ids
+    supports_compact_maps = use_compact_maps = False
+    # True when reading into a copy of the table, see read_in_copy(), which
+    # can happen under the read lock, so the database must not be changed
+    reading_in_copy = False
 
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
@@ -77,6 +89,47 @@ def __init__(self, name, metadata, link_table=None):
     def remove_books(self, book_ids, db):
         return set()
 
+    def snapshot(self):
+        return {x: getattr(self, x) for x in self.snapshot_attrs}
+
+    def restore(self, state):
+        for x in self.snapshot_attrs:
+            setattr(self, x, state[x])
+
+    def read_lazily(self, db):
+        ''' Read the data for this table from db on first access, instead of
+        now, see :meth:`calibre.db.backend.DB.read_lazy_table`. Tables that
+        have no data attributes are read immediately. '''
+        if self.snapshot_attrs:
+            self.lazy_db = db
+        else:
+            self.read(db)
+
+    @property
+    def is_read(self):
+        return self.__dict__.get('lazy_db') is None
+
+    def read_in_copy(self, db):
+        ''' Read the data for this table into a copy of it and then replace
+        the data of this table, so that other threads never see partially read
+        data. The database is not changed. '''
+        t = self.__class__.__new__(self.__class__)
+        t.__dict__.update(self.__dict__)
+        t.__dict__.pop('lazy_db', None)
+        t.reading_in_copy = True
+        t.read(db)
+        self.restore(t.snapshot())
+        self.lazy_db = None
+
+    def __getattr__(self, name):
+        # Only called for attributes that do not exist, that is, for the data
+        # of tables being read lazily that have not been read yet
+        db = self.__dict__.get('lazy_db')
+        if db is None or name not in self.snapshot_attrs:
+            raise AttributeError(f'{self.__class__.__name__!r} object has no attribute {name!r}')
+        db.read_lazy_table(self)
+        return self.__dict__[name]
+
     def fix_link_table(self, db):
         pass
 
@@ -107,6 +160,7 @@ class OneToOneTable(Table):
     '''
 
     table_type = ONE_ONE
+    snapshot_attrs = ('book_col_map',)
 
     def read(self, db):
         idcol = 'id' if self.metadata['table'] == 'books' else 'book'
@@ -156,6 +210,8 @@ def update_sizes(self, size_map):
 
 class UUIDTable(OneToOneTable):
 
+    snapshot_attrs = ('book_col_map', 'uuid_to_id_map')
+
     def read(self, db):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v:k for k, v in self.book_col_map.items()}
@@ -180,6 +236,8 @@ def lookup_by_uuid(self, uuid):
 
 class CompositeTable(OneToOneTable):
 
+    snapshot_attrs = ()
+
     def read(self, db):
         self.book_col_map = {}
         d = self.metadata['display']
@@ -203,6 +261,7 @@ class ManyToOneTable(Table):
 
     table_type = MANY_ONE
     supports_notes = True
+    snapshot_attrs = ('id_map', 'link_map', 'col_book_map', 'book_col_map')
 
     def read(self, db):
         self.id_map = {}
@@ -262,6 +321,9 @@ def fix_case_duplicates(self, db):
                     tuple((main_id, x) for x in v))
                 db.delete_category_items(self.name, self.metadata['table'], item_map)
 
+    def item_has_books(self, item_id):
+        return bool(self.col_book_map.get(item_id))
+
     def item_ids_for_names(self, db, item_names: Iterable[str], case_sensitive: bool = False) -> dict[str, int]:
         item_names = tuple(item_names)
         if case_sensitive:
@@ -398,11 +460,22 @@ def read_id_maps(self, db):
         bad_ids = {item_id for item_id, rating in self.id_map.items() if rating == 0}
         if bad_ids:
             self.id_map = {item_id:rating for item_id, rating in self.id_map.items() if rating != 0}
+            if self.reading_in_copy:
+                # The bad records are removed from the database the next time
+                # the table is read normally, for now only ignore them
+                self.ignored_ids = bad_ids
+                return
             db.executemany('DELETE FROM {} WHERE {}=?'.format(self.link_table, self.metadata['link_column']),
                                 tuple((x,) for x in bad_ids))
             db.execute('DELETE FROM {} WHERE {}=0'.format(
                 self.metadata['table'], self.metadata['column']))
 
+    def read_maps(self, db):
+        ManyToOneTable.read_maps(self, db)
+        for item_id in self.__dict__.pop('ignored_ids', ()):
+            for book_id in self.col_book_map.pop(item_id, ()):
+                self.book_col_map.pop(book_id, None)
+
 
 class ManyToManyTable(ManyToOneTable):
     '''
@@ -414,6 +487,7 @@ class ManyToManyTable(ManyToOneTable):
     table_type = MANY_MANY
     selectq = 'SELECT book, {0} FROM {1} ORDER BY id'
     do_clean_on_remove = True
+    supports_compact_maps = True
 
     def read_maps(self, db):
         bcm = defaultdict(list)
@@ -423,7 +497,19 @@ def read_maps(self, db):
             cbm[item_id].add(book)
             bcm[book].append(item_id)
 
-        self.book_col_map = {k:tuple(v) for k, v in bcm.items()}
+        if self.use_compact_maps:
+            self.book_col_map, self.col_book_map = BookItemsMap(bcm), ItemBooksMap(cbm)
+        else:
+            self.book_col_map = {k:tuple(v) for k, v in bcm.items()}
+
+    def restore(self, state):
+        ManyToOneTable.restore(self, state)
+        if self.use_compact_maps and not isinstance(self.book_col_map, BookItemsMap):
+            self.book_col_map, self.col_book_map = BookItemsMap(self.book_col_map), ItemBooksMap(self.col_book_map)
+
+    def item_has_books(self, item_id):
+        cbm = self.col_book_map
+        return cbm.has_books(item_id) if isinstance(cbm, ItemBooksMap) else bool(cbm.get(item_id))
 
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in self.book_col_map.values() for item_id in item_ids}
@@ -575,6 +661,8 @@ def fix_case_duplicates(self, db):
 
 class AuthorsTable(ManyToManyTable):
 
+    snapshot_attrs = ManyToManyTable.snapshot_attrs + ('asort_map',)
+
     def read_id_maps(self, db):
         self.link_map = lm = {}
         self.asort_map = sm = {}
@@ -628,6 +716,8 @@ class FormatsTable(ManyToManyTable):
 
     do_clean_on_remove = False
     supports_notes = False
+    snapshot_attrs = ManyToManyTable.snapshot_attrs + ('fname_map', 'size_map')
+    supports_compact_maps = False
 
     def read_id_maps(self, db):
         pass
@@ -714,6 +804,7 @@ def update_fmt(self, book_id, fmt, fname, size, db):
 class IdentifiersTable(ManyToManyTable):
 
     supports_notes = False
+    supports_compact_maps = False
 
     def read_id_maps(self, db):
         pass
@@ -169,6 +169,25 @@ def test_sorting(self):  # {{{
                 ids_to_sort=order),
                     f'Descending sort of {field} failed')
 
+        # Test that cached sort keys are cleared only for changed fields
+        ae(len(cache.sort_keys_cache['sort']), 3)
+        cache.set_field('publisher', {1:'aaa'})
+        ae(len(cache.sort_keys_cache['sort']), 3)
+        ae(set(cache.sort_keys_cache['publisher']), {2, 3})
+        ae([3, 1, 2], cache.multisort([('publisher', True)], ids_to_sort=(1, 2, 3)))
+
+        # Test that errors calculating sort keys fall back to sorting on book id
+        def failing_sort_keys(get_metadata, lang_map):
+            return lambda book_id: 1 / 0
+        cache.sort_keys_cache.pop('publisher')
+        f = cache.fields['publisher']
+        f.sort_keys_for_books = failing_sort_keys
+        try:
+            ae([1, 2, 3], cache.multisort([('publisher', True)], ids_to_sort=(3, 1, 2)))
+        finally:
+            del f.sort_keys_for_books
+        ae([3, 1, 2], cache.multisort([('publisher', True)], ids_to_sort=(1, 2, 3)))
+
         # Test sorting of is_multiple fields.
 
         # Author like fields should be sorted by generating sort names from the
@@ -565,6 +584,7 @@ def test_restrictions(self):  # {{{
     def test_search_caching(self):  # {{{
         ' Test caching of searches '
         from calibre.db.search import LRUCache
+        from calibre.utils.search_query_parser import ParseException
 
         class TestCache(LRUCache):
             hit_counter = 0
@@ -616,6 +636,242 @@ def test(hit, result, *args, **kw):
         cache.set_field('publisher', {3:'ppppp', 2:'other'})
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+
+        # Test that only searches on the changed fields are updated
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        test(False, {3}, 'publisher:=ppppp')
+        test(False, {3}, 'Unknown')
+        cache.set_field('tags', {1:'newtag'})
+        test(True, {3}, 'publisher:=ppppp')
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        test(False, {3}, 'Unknown')  # searches over all fields are cleared
+        cache.set_field('publisher', {1:'ppppp'})
+        test(True, {1, 3}, 'publisher:=ppppp')
+        ae(c.item_map['publisher:=ppppp'], {1, 3})
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+
+        # Test that saved searches are inlined into cached query plans and
+        # that the plans are invalidated when saved searches change
+        cache.saved_search_add('ss', 'publisher:=ppppp')
+        test(False, {1, 3}, 'search:ss')
+        test(True, {1, 3}, 'search:ss')
+        ae(cache._search_api.plan_cache['search:ss'], ['token', 'publisher', '=ppppp'])
+        cache.saved_search_add('ss', 'title:=xxx')
+        test(False, {3}, 'search:ss')
+        ae(cache._search_api.plan_cache['search:ss'], ['token', 'title', '=xxx'])
+        cache.saved_search_add('ss', 'search:ss')
+        self.assertRaises(ParseException, cache.search, 'search:ss')
+    # }}}
+
+    def test_text_index(self):  # {{{
+        ' Test the trigram index used to speed up contains searches '
+        import sys
+        cache = self.init_cache()
+        ti = cache._search_api.text_indexes
+        cache.set_field('title', {1:'Straße Cafés', 2:'The-Quick brown fox', 3:'日本語 title'})
+        cache.set_field('tags', {1:('Science fiction', 'Ærø'), 2:('FANTASY',)})
+        queries = (
+            'fox', 'quick brown', 'quickbrown', 'cafe', 'strasse', 'title:^cafe', 'title', 'fiction',
+            'tags:fan', 'tags:ero', 'tags:"=fantasy"', '語 ti', 'xyzzy', 'ab', 'author', 'languages:german',
+        )
+
+        def results():
+            cache.clear_search_caches()
+            return {q: cache.search(q) for q in queries}
+
+        ti.min_candidates = sys.maxsize
+        expected = results()
+        ti.min_candidates = 0
+        self.assertEqual(expected, results())
+        self.assertIn('title', ti.indexes)
+        self.assertEqual(ti.indexes['title'].unindexed, {3})
+        # Test that changed books are always checked
+        cache.set_field('title', {1:'A quick fox'})
+        self.assertEqual(ti.indexes['title'].unindexed, {1, 3})
+        self.assertEqual(cache.search('title:quick'), {1, 2})
+        self.assertEqual(cache.search('title:strasse'), set())
+    # }}}
+
+    def test_table_snapshot(self):  # {{{
+        ' Test starting up from a snapshot of the in-memory tables '
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        path = os.path.join(self.mkdtemp(), 'snapshot.pickle')
+
+        def init(loaded):
+            cache = Cache(DB(self.library_path))
+            cache.init(table_snapshot=path)
+            self.assertEqual(cache.table_snapshot['loaded'], loaded)
+            return cache
+
+        def data(cache):
+            return {field: {book_id: cache.field_for(field, book_id) for book_id in cache.all_book_ids()}
+                    for field in cache.fields if field != 'ondevice'}
+
+        cache = init(False)
+        expected = data(cache)
+        cache.close()
+        self.assertTrue(os.path.exists(path))
+        cache = init(True)
+        self.assertEqual(expected, data(cache))
+        cache.set_field('tags', {1:('snapshot',)})
+        cache.set_field('#rating', {2:8})
+        expected = data(cache)
+        cache.close()
+        cache = init(True)
+        self.assertEqual(expected, data(cache))
+        # Changes by another connection make the tables stale, so no snapshot
+        # must be saved
+        other = DB(self.library_path)
+        other.execute("UPDATE books SET title='changed' WHERE id=1")
+        other.close()
+        cache.close()
+        cache = init(False)
+        self.assertEqual(cache.field_for('title', 1), 'changed')
+        cache.close()
+        # Nor when the database is changed while it is being closed
+        cache = init(True)
+        orig_close = cache.backend.close
+
+        def close(*a, **kw):
+            other = DB(self.library_path)
+            other.execute("UPDATE books SET title='changed again' WHERE id=1")
+            other.close()
+            return orig_close(*a, **kw)
+        cache.backend.close = close
+        cache.close()
+        cache = init(False)
+        self.assertEqual(cache.field_for('title', 1), 'changed again')
+        cache.close()
+    # }}}
+
+    def test_lazy_tables(self):  # {{{
+        ' Test reading tables only when they are first used '
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        cache = Cache(DB(self.library_path))
+        cache.init(lazy_tables=True)
+        self.objects_to_close.append(cache)
+        tables = cache.backend.tables
+        self.assertFalse(any(t.is_read for t in tables.values() if t.snapshot_attrs))
+        self.assertEqual(cache.field_for('tags', 2), ('Tag One', 'Tag Two'))
+        self.assertTrue(tables['tags'].is_read)
+        self.assertFalse(tables['publisher'].is_read)
+        eager = self.init_cache()
+        for field in eager.fields:
+            if field != 'ondevice':
+                self.assertEqual(
+                    {b: eager.field_for(field, b) for b in eager.all_book_ids()},
+                    {b: cache.field_for(field, b) for b in cache.all_book_ids()}, field)
+        self.assertTrue(all(t.is_read for t in tables.values()))
+
+        # Changes by another connection are seen only by tables read after them,
+        # tables that were already read are not changed
+        cache = Cache(DB(self.library_path))
+        cache.init(lazy_tables=True)
+        self.objects_to_close.append(cache)
+        tables = cache.backend.tables
+        self.assertEqual(cache.field_for('tags', 2), ('Tag One', 'Tag Two'))
+        other = DB(self.library_path)
+        other.execute("UPDATE books SET title='changed' WHERE id=1")
+        other.execute('DELETE FROM books_tags_link WHERE book=2')
+        other.close()
+        self.assertEqual(cache.field_for('title', 1), 'changed')
+        self.assertEqual(cache.field_for('tags', 2), ('Tag One', 'Tag Two'))
+        self.assertFalse(tables['publisher'].is_read)
+
+        # Only the tables that were read are saved in the table snapshot
+        path = os.path.join(self.mkdtemp(), 'snapshot.pickle')
+        cache = Cache(DB(self.library_path))
+        cache.init(table_snapshot=path, lazy_tables=True)
+        cache.field_for('publisher', 1)
+        cache.close()
+        cache = Cache(DB(self.library_path))
+        cache.init(table_snapshot=path, lazy_tables=True)
+        self.assertTrue(cache.table_snapshot['loaded'])
+        self.assertIn('publisher', cache.table_snapshot['tables'])
+        self.assertNotIn('tags', cache.table_snapshot['tables'])
+        tables = cache.backend.tables
+        self.assertTrue(tables['publisher'].is_read)
+        self.assertFalse(tables['tags'].is_read)
+        cache.field_for('tags', 1)
+        cache.close()
+        cache = Cache(DB(self.library_path))
+        cache.init(table_snapshot=path)
+        self.objects_to_close.append(cache)
+        self.assertLessEqual({'publisher', 'tags'}, cache.table_snapshot['tables'])
+        eager = self.init_cache()
+        for field in ('title', 'publisher', 'tags', 'rating'):
+            self.assertEqual(
+                {b: eager.field_for(field, b) for b in eager.all_book_ids()},
+                {b: cache.field_for(field, b) for b in cache.all_book_ids()}, field)
+
+        # Reloading reads all tables
+        cache = Cache(DB(self.library_path))
+        cache.init(lazy_tables=True)
+        self.objects_to_close.append(cache)
+        cache.reload_from_db()
+        self.assertTrue(all(t.is_read for t in cache.backend.tables.values()))
+    # }}}
+
+    def test_compact_tables(self):  # {{{
+        ' Test the compact representation of many-to-many tables '
+        import pickle
+
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        from calibre.db.compact_maps import BookItemsMap, ItemBooksMap
+        cache = Cache(DB(self.library_path))
+        cache.init(compact_tables=True)
+        self.objects_to_close.append(cache)
+        tables = cache.backend.tables
+        self.assertIsInstance(tables['tags'].book_col_map, BookItemsMap)
+        self.assertIsInstance(tables['authors'].col_book_map, ItemBooksMap)
+        self.assertIsInstance(tables['formats'].book_col_map, dict)
+
+        def compare(cache):
+            eager = self.init_cache()
+            for field in eager.fields:
+                if field != 'ondevice':
+                    self.assertEqual(
+                        {b: eager.field_for(field, b) for b in eager.all_book_ids()},
+                        {b: cache.field_for(field, b) for b in cache.all_book_ids()}, field)
+            for field in ('tags', 'authors', '#tags'):
+                et, t = eager.fields[field].table, cache.fields[field].table
+                self.assertEqual(dict(et.book_col_map), dict(t.book_col_map), field)
+                self.assertEqual({k: v for k, v in et.col_book_map.items() if v}, {k: v for k, v in t.col_book_map.items() if v}, field)
+                self.assertEqual(eager.get_usage_count_by_id(field), cache.get_usage_count_by_id(field), field)
+            eager.close()
+
+        compare(cache)
+        cache.set_field('tags', {1: ('Tag One', 'New Tag'), 2: (), 3: ('Tag Two',)})
+        cache.set_field('authors', {1: ('Author One', 'Author Two')})
+        cache.rename_items('tags', {cache.get_item_id('tags', 'Tag Two'): 'Tag One'})
+        cache.remove_items('#tags', (cache.get_item_id('#tags', 'My Tag One'),))
+        cache.remove_books((3,))
+        compare(cache)
+        bcm = tables['tags'].book_col_map
+        self.assertEqual(dict(pickle.loads(pickle.dumps(bcm)).items()), dict(bcm.items()))
+
+        # Changes are merged into the compact form once there are enough of them
+        import random
+        from collections import defaultdict
+
+        from calibre.db import compact_maps
+        orig, compact_maps.MIN_CHANGES_TO_COMPACT = compact_maps.MIN_CHANGES_TO_COMPACT, 4
+        try:
+            m, d = ItemBooksMap({1: {1, 2}, 5: {3}}), defaultdict(set, {1: {1, 2}, 5: {3}})
+            for i in range(1000):
+                k, b = random.randint(0, 100), random.randint(1, 100)
+                if random.random() < 0.7:
+                    m[k].add(b), d[k].add(b)
+                elif k in m:
+                    m[k].discard(b), d[k].discard(b)
+                self.assertLessEqual(len(m.changed), 7)
+            self.assertEqual({k: v for k, v in m.items() if v}, {k: v for k, v in d.items() if v})
+            self.assertEqual({k: len(v) for k, v in m.raw_items() if v}, {k: len(v) for k, v in d.items() if v})
+        finally:
+            compact_maps.MIN_CHANGES_TO_COMPACT = orig
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -910,6 +1166,79 @@ def test_template_db_functions(self):  # {{{
         self.assertEqual(set(v.split(',')), {'4', '6'})
     # }}}
 
+    def test_compiled_templates(self):  # {{{
+        'Test that compiled templates give the same results as the interpreter'
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        db = self.init_legacy(self.library_path)
+        mi = db.get_metadata(1)
+        templates = (
+            'program: x = "a"; strcat(x, "b", $title, $$authors)',
+            'program: if $series then "yes" elif $tags then "tags" else "no" fi',
+            'program: r = ""; for t in $tags: if t == "News" then continue fi; r = r & t rof; r',
+            'program: r = ""; for t in "a,b,c": if t == "b" then break fi; r = strcat(r, t) rof; r',
+            'program: 1 + 2 * 3 - 4 / 8; -(1 + $$rating); 3 ==# 3.0 && !("c" == "d") || 0',
+            'program: "one" inlist_field "tags"; "Tag" in $tags; "News" inlist $tags',
+            'program: switch($title, "foo", 1, "Two", 2, 3) & switch_if("", 1, "x", 2, 3)',
+            'program: first_non_empty("", $#genre, "z") & contains($title, "tit", "y", "n")',
+            'program: character("newline"); list_count_field("tags"); raw_field("#genre", "def")',
+            'program: def f(a, b="q"): return strcat(a, b); "no" fed; f("x") & f("x", "y")',
+            'program: globals(g="d"); set_globals(h=strcat(g, "e")); globals(h); uppercase(h)',
+            'program: for i in range(0, 5): if i ==# 3 then break fi; i rof',
+            'program: f_string("a{$title}b")',
+            # Errors
+            'program: character("nope")',
+            'program: list_count_field("title")',
+            'program: field("nosuch")',
+            'program: unknown_variable',
+            'program: "[" in "abc"',
+            'program: 1 + "x"',
+            'program: def f(a): a fed; f(1, 2)',
+            'program: break',
+        )
+        for template in templates:
+            expected = SafeFormat().safe_format(template, mi, 'TEMPLATE ERROR', mi, break_reporter=lambda *a: None)
+            formatter, template_cache = SafeFormat(), {}
+            for i in range(3):
+                # The program is compiled on its second evaluation
+                self.assertEqual(formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, column_name='x', template_cache=template_cache),
+                                 expected, template)
+            self.assertIsNotNone(template_cache['x'].compiled, template)
+    # }}}
+
+    def test_batch_template_evaluation(self):  # {{{
+        'Test that evaluating a template for many books gives the same results as for one book at a time'
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        cache = self.init_cache()
+        cache.create_custom_column('ccomp', 'CComp', 'composite', False, display={'composite_template': '{title}:{#tags}'})
+        cache = self.init_cache()
+        book_ids = sorted(cache.all_book_ids())
+        templates = (
+            '{title} - {authors} [{series}:{series_index}] {#tags} {timestamp:format_date(yyyy)}',
+            'program: strcat($title, $#ccomp, $$rating, $isbn, list_count_field("tags"))',
+            'program: if "News" in $tags then "red" else $#genre fi',
+            "{:'approximate_formats()'} {languages} {#float}",
+            'program: field("nosuch")',
+        )
+        for template in templates:
+            expected = {book_id: SafeFormat().safe_format(template, mi, 'TEMPLATE ERROR', mi) for book_id, mi in (
+                (book_id, cache.get_proxy_metadata(book_id)) for book_id in book_ids)}
+            self.assertEqual(cache.evaluate_template_for_books(template, book_ids, 'TEMPLATE ERROR'), expected, template)
+            template_cache = {}
+            for i in range(2):
+                self.assertEqual(cache.evaluate_template_for_books(
+                    template, book_ids, 'TEMPLATE ERROR', column_name='x', template_cache=template_cache), expected, template)
+
+        # Composite columns are rendered for all books at once
+        f = cache.fields['#ccomp']
+        expected = {book_id: cache.field_for('#ccomp', book_id) for book_id in book_ids}
+        f.clear_caches()
+        cache.multisort([('#ccomp', True)])
+        self.assertEqual(f.cached_values(), expected)
+        f.clear_caches()
+        self.assertEqual(cache.search('#ccomp:true'), set(book_ids))
+        self.assertEqual(f.cached_values(), expected)
+    # }}}
+
     @unittest.skipIf(os.environ.get('CALIBRE_ALLOW_PYTHON_TEMPLATES', '1') != '1', 'Python templates disallowed')
     def test_python_templates(self):  # {{{
         from calibre.ebooks.metadata.book.formatter import SafeFormat
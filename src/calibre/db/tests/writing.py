@@ -354,6 +354,52 @@ def test_dirtied(self):  # {{{
             c.nowf = onowf
     # }}}
 
+    def test_bulk_update(self):  # {{{
+        'Test setting many fields for many books at once'
+        changes = {
+            'title': {1: 'New title', 2: 'Another title'},
+            'authors': {1: ('Bulk Author',), 3: ('Author One', 'Bulk Author')},
+            'tags': {1: ('a', 'b'), 2: (), 3: ('Tag One',)},
+            'series': {2: 'A series [3]'},
+            '#tags': {1: ('x',), 3: ('My Tag Two', 'y')},
+            'rating': {3: 6},
+        }
+        expected = self.init_cache(self.cloned_library)
+        for field, val_map in changes.items():
+            expected.set_field(field, val_map)
+        cache = self.init_cache(self.library_path)
+        self.assertEqual(cache.bulk_update(changes), {1, 2, 3})
+        self.assertEqual(cache.bulk_update(changes), set())
+        for c in (cache, self.init_cache(self.library_path)):
+            for field in expected.fields:
+                if field not in ('ondevice', 'last_modified', 'path', 'formats'):
+                    self.assertEqual(
+                        {b: expected.field_for(field, b) for b in (1, 2, 3)},
+                        {b: c.field_for(field, b) for b in (1, 2, 3)}, field)
+        self.assertEqual(cache.search('authors:"=Bulk Author"'), {1, 3})
+        self.assertEqual(cache.search('series:"=A series"'), {2})
+        self.assertLessEqual({1, 2, 3}, set(cache.dirtied_cache))
+        self.assertEqual(cache.field_for('title', 1), 'New title')
+        self.assertIn('New title', cache.field_for('path', 1))
+
+        # A failure part way through changes neither the db nor the in-memory
+        # tables
+        cl = self.cloned_library
+        cache = self.init_cache(cl)
+        before = {field: {b: cache.field_for(field, b) for b in (1, 2, 3)} for field in changes}
+        self.assertEqual(cache.search('tags:"=a"'), set())
+
+        def fail(*a, **kw):
+            raise OSError('failed')
+        cache.fields['series'].writer.set_books = fail
+        self.assertRaises(OSError, cache.bulk_update, changes)
+        del cache.fields['series'].writer.set_books
+        for c in (cache, self.init_cache(cl)):
+            self.assertEqual(before, {field: {b: c.field_for(field, b) for b in (1, 2, 3)} for field in changes})
+        self.assertEqual(cache.search('tags:"=a"'), set())
+        self.assertIsNone(cache.get_item_id('tags', 'a'))
+    # }}}
+
     def test_backup(self):  # {{{
         'Test the automatic backup of changed metadata'
         cl = self.cloned_library
@@ -755,6 +801,60 @@ def test_invalidate():
         cache.close()
     # }}}
 
+    def test_composite_dependencies(self):  # {{{
+        ' Test that composite columns are cleared only when the fields they read change and are saved across restarts '
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        cache = self.init_cache()
+        for label, template in (
+                ('ctags', '{tags}'), ('ctitle', 'program: uppercase($title)'), ('ccomp', '{#ctags} {#ctitle}'),
+                ('cdyn', "program: field(strcat('ta', 'gs'))"), ('cseries', '{series}')):
+            cache.create_custom_column(label, label, 'composite', False, display={'composite_template': template})
+        cache.close()
+        path = os.path.join(self.mkdtemp(), 'composites.pickle')
+        cache = Cache(DB(self.library_path))
+        cache.init(composite_cache=path)
+        deps = cache._composite_dependencies()
+        self.assertEqual(deps['#ctags'], {'tags'})
+        self.assertEqual(deps['#ccomp'], {'tags', 'title', '#ctags', '#ctitle'})
+        self.assertEqual(deps['#cseries'], {'series', 'series_index'})
+        self.assertIsNone(deps['#cdyn'])
+        columns = ('#ctags', '#ctitle', '#ccomp', '#cdyn', '#cseries')
+
+        def cached(book_id):
+            return {col for col in columns if book_id in cache.fields[col].cached_values()}
+
+        def render():
+            return {col: {book_id: cache.field_for(col, book_id) for book_id in cache.all_book_ids()} for col in columns}
+
+        expected = render()
+        cache.set_field('title', {1: 'changed'})
+        self.assertEqual(cached(1), {'#ctags', '#cseries'})
+        self.assertEqual(cached(2), set(columns))
+        self.assertEqual(cache.field_for('#ccomp', 1), expected['#ctags'][1] + ' CHANGED')
+        cache.set_field('series_index', {1: 3})
+        self.assertEqual(cached(1), {'#ctags', '#ctitle', '#ccomp'})
+        cache.clear_caches()
+        self.assertEqual(cached(2), {'#ctags', '#ctitle', '#ccomp', '#cseries'})
+        expected = render()
+        cache.close()
+
+        cache = Cache(DB(self.library_path))
+        cache.init(composite_cache=path)
+        self.assertEqual(cached(1), {'#ctags', '#ctitle', '#ccomp', '#cseries'})
+        self.assertEqual(expected, render())
+        cache.close()
+        # Books modified by another connection are rendered again
+        other = DB(self.library_path)
+        other.execute("UPDATE books SET last_modified='2000-01-01 00:00:00+00:00' WHERE id=1")
+        other.close()
+        cache = Cache(DB(self.library_path))
+        cache.init(composite_cache=path)
+        self.assertEqual(cached(1), set())
+        self.assertEqual(cached(2), {'#ctags', '#ctitle', '#ccomp', '#cseries'})
+        cache.close()
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         try:
@@ -1087,3 +1187,47 @@ def test_link_maps(self):
         self.assertEqual({}, cache.get_link_map('publisher'), 'links on publisher were not deleted')
         self.assertEqual({}, cache.get_all_link_maps_for_book(1), 'Not all links for book were deleted')
     # }}}
+
+    def test_categories_cache(self):  # {{{
+        'Test that get_categories() re-uses the categories of fields that have not changed'
+        cache = self.init_cache(self.cloned_library)
+        cc = cache.categories_cache
+
+        def names(categories, field):
+            return {t.name: t.count for t in categories[field]}
+
+        c1 = cache.get_categories()
+        misses = cc.misses
+        self.assertGreater(misses, 0)
+        c2 = cache.get_categories()
+        self.assertEqual(cc.misses, misses)
+        for field in c1:
+            self.assertEqual(names(c1, field), names(c2, field))
+        # The returned Tags are copies, so callers can modify them
+        c2['tags'][0].state = 1
+        self.assertEqual(cache.get_categories()['tags'][0].state, 0)
+
+        # Only the changed field and fields whose categories use it are re-computed
+        composites = {k for k in c1 if k in cache.composites}
+        self.assertTrue(composites)
+        before = cc.items.copy()
+        cache.set_field('tags', {1: ('Tag One', 'Tag Three')})
+        c3 = cache.get_categories()
+        self.assertEqual({k[0] for k, v in cc.items.items() if before.get(k) is not v}, {'tags', 'news'} | composites)
+        self.assertIn('Tag Three', names(c3, 'tags'))
+        self.assertEqual(names(c3, 'tags')['Tag One'], names(c1, 'tags')['Tag One'])
+        self.assertEqual(names(c1, 'authors'), names(c3, 'authors'))
+        misses = cc.misses
+        cache.set_field('rating', {1: 8})
+        cache.get_categories()
+        self.assertGreater(cc.misses - misses, 2)
+
+        # Results for different sets of books are cached separately
+        self.assertEqual(names(cache.get_categories(book_ids={1}), 'tags'), {'Tag One': 1, 'Tag Three': 1})
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'Author One'): 'Zzz'}, update_books=False)
+        self.assertEqual({t.name: t.sort for t in cache.get_categories()['authors']}['Author One'], 'Zzz')
+        cache.add_format(1, 'NEWFMT', BytesIO(b'xxx'))
+        self.assertIn('NEWFMT', names(cache.get_categories(), 'formats'))
+        cache.remove_books((1,))
+        self.assertNotIn('Tag Three', names(cache.get_categories(), 'tags'))
+    # }}}
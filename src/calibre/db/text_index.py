@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+'''
+An in-memory trigram index of the values of text fields, used to narrow down
+the set of books that have to be checked by the (slow, ICU based) matching
+code for contains searches.
+
+Values are folded to lowercase ASCII with accents, whitespace and punctuation
+removed. If a query matches a value, then the folded query is a substring of
+the folded value, so the index never misses a book that matches, it can only
+return extra books, which are then rejected by the normal matching code.
+Values that cannot be reliably folded to ASCII, and the values of books that
+have changed since the index was built, are not indexed and are always
+returned as candidates.
+'''
+
+import re
+import unicodedata
+from array import array
+from collections import defaultdict
+from functools import partial
+from threading import Lock
+
+non_alnum = re.compile(r'[^a-z0-9]+')
+
+
+def fold(text):
+    ''' Return text folded to lowercase ASCII letters and digits, or None if
+    text contains characters that cannot be folded to ASCII. '''
+    text = text.casefold()
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+        if not text.isascii():
+            return None
+    return non_alnum.sub('', text)
+
+
+def trigrams(text):
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+class TextIndex:
+
+    # Once this many books have changed since the index was built, the index
+    # is discarded and rebuilt on next use.
+    MAX_UNINDEXED = 1000
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.values = self.postings = self.offsets = self.book_ids = None
+        self.unindexed = set()
+
+    @property
+    def is_built(self):
+        return self.values is not None
+
+    def build(self, field, dbcache):
+        value_map = defaultdict(list)
+        unindexed = set()
+        for val, book_ids in field.iter_searchable_values(dbcache._get_proxy_metadata, dbcache._all_book_ids(type=set)):
+            if not val:
+                continue
+            for v in ((val,) if isinstance(val, (str, bytes)) else val):
+                fv = fold(v) if isinstance(v, str) else None
+                if fv is None:
+                    unindexed |= book_ids
+                elif len(fv) > 2:
+                    # Shorter values can never contain an indexed query
+                    value_map[fv].extend(book_ids)
+        values, postings = [], defaultdict(partial(array, 'I'))
+        offsets, all_ids = array('I', (0,)), array('I')
+        for fv, book_ids in value_map.items():
+            vi = len(values)
+            values.append(fv)
+            for tg in trigrams(fv):
+                postings[tg].append(vi)
+            all_ids.extend(book_ids)
+            offsets.append(len(all_ids))
+        self.values, self.postings = values, dict(postings)
+        self.offsets, self.book_ids = offsets, all_ids
+        self.unindexed = unindexed
+
+    def narrow(self, query, candidates, field, dbcache):
+        '''
+        Return the subset of candidates that could match a contains search for
+        query. Returns candidates itself if the index cannot be used for query.
+        '''
+        fq = fold(query)
+        if fq is None or len(fq) < 3:
+            return candidates
+        with self.lock:
+            if not self.is_built:
+                self.build(field, dbcache)
+            postings, values, offsets, book_ids = self.postings, self.values, self.offsets, self.book_ids
+            ans = set(self.unindexed)
+        best = None
+        for tg in trigrams(fq):
+            p = postings.get(tg)
+            if p is None:
+                best = ()
+                break
+            if best is None or len(p) < len(best):
+                best = p
+        for vi in best:
+            if fq in values[vi]:
+                ans.update(book_ids[offsets[vi]:offsets[vi+1]])
+        ans.intersection_update(candidates)
+        return ans
+
+    def invalidate(self, book_ids):
+        with self.lock:
+            if self.is_built:
+                self.unindexed.update(book_ids)
+                if len(self.unindexed) > self.MAX_UNINDEXED:
+                    self.clear()
+
+
+class TextIndexes:
+
+    '''
+    The text indexes for all searchable text fields. Indexes are built lazily,
+    the first time a contains search on a field is run over at least
+    min_candidates books, and are updated when books are changed.
+    '''
+
+    min_candidates = 1000
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = Lock()
+
+    def is_indexable(self, field):
+        # On device values can change without the database being changed and
+        # the values of comments are too large to index
+        return field.has_text_data and field.name != 'ondevice' and field.metadata['datatype'] != 'comments'
+
+    def narrow(self, field, query, candidates, dbcache):
+        if len(candidates) < self.min_candidates or not self.is_indexable(field):
+            return candidates
+        with self.lock:
+            idx = self.indexes.get(field.name)
+            if idx is None:
+                idx = self.indexes[field.name] = TextIndex(field.name)
+        return idx.narrow(query, candidates, field, dbcache)
+
+    def invalidate(self, book_ids, fields=None):
+        ''' Mark the specified books as changed for the specified fields (all
+        fields if None). '''
+        with self.lock:
+            indexes = tuple(self.indexes.values()) if fields is None else tuple(
+                filter(None, map(self.indexes.get, fields)))
+        for idx in indexes:
+            idx.invalidate(book_ids)
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
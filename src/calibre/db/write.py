@@ -311,7 +311,7 @@ def change_case(case_changes, dirtied, db, table, m, is_authors=False):
         'UPDATE {} SET {}=? WHERE id=?'.format(m['table'], m['column']), vals)
     for item_id, val in case_changes.items():
         table.id_map[item_id] = val
-        dirtied.update(table.col_book_map[item_id])
+        dirtied.update(table.col_book_map.get(item_id, ()))
         if is_authors:
             table.asort_map[item_id] = author_to_author_sort(val)
 
@@ -376,7 +376,7 @@ def many_one(book_id_val_map, db, field, allow_case_change, *args):
             ((book_id, book_id, item_id) for book_id, item_id in updated.items()))
 
     # Remove no longer used items
-    remove = {item_id:item_val for item_id, item_val in table.id_map.items() if not table.col_book_map.get(item_id, False)}
+    remove = {item_id:item_val for item_id, item_val in table.id_map.items() if not table.item_has_books(item_id)}
     if remove:
         if table.supports_notes:
             db.clear_notes_for_category_items(table.name, remove)
@@ -428,7 +428,7 @@ def many_many(book_id_val_map, db, field, allow_case_change, *args):
         change_case(case_changes, dirtied, db, table, m, is_authors=is_authors)
         if is_authors:
             for item_id, val in case_changes.items():
-                for book_id in table.col_book_map[item_id]:
+                for book_id in table.col_book_map.get(item_id, ()):
                     current_sort = field.db_author_sort_for_book(book_id)
                     new_sort = field.author_sort_for_book(book_id)
                     if strcmp(current_sort, new_sort) == 0:
@@ -481,7 +481,7 @@ def many_many(book_id_val_map, db, field, allow_case_change, *args):
             field.author_sort_field.writer.set_books(aus_map, db)
 
     # Remove no longer used items
-    remove = {item_id:item_val for item_id, item_val in table.id_map.items() if not table.col_book_map.get(item_id, False)}
+    remove = {item_id:item_val for item_id, item_val in table.id_map.items() if not table.item_has_books(item_id)}
     if remove:
         if table.supports_notes:
             db.clear_notes_for_category_items(table.name, remove)
@@ -19,7 +19,8 @@
 from css_parser import log as css_parser_log
 from css_parser import profile as cssprofiles
 from css_parser.css import CSSFontFaceRule, CSSPageRule, CSSStyleRule, cssproperties
-from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select, SelectorError
+from css_selectors import INAPPROPRIATE_PSEUDO_CLASSES, Select, SelectorError, parse
+from css_selectors.parser import Class, CombinedSelector, Element, Hash, ascii_lower
 from tinycss.media3 import CSSMedia3Parser
 
 from calibre import as_unicode, force_unicode
@@ -31,6 +32,8 @@
 css_parser_log.setLevel(logging.WARN)
 
 _html_css_stylesheet = None
+# The number of distinct sets of stylesheets for which StylizerRules are kept
+STYLIZER_RULES_CACHE_SIZE = 8
 
 
 def validate_color(col):
@@ -135,6 +138,38 @@ def cleanup_epub_prefixed_properties(style: dict[str, str]) -> None:
                 style[key] = val
 
 
+def selector_key(text):
+    '''
+    Return (map_name, name) where name is an id, class or tag name that an
+    element must have to match the CSS selector text and map_name is the
+    corresponding map of :class:`css_selectors.Select`, or None if there is no
+    such name. Like the rule hash of browsers, this allows skipping selectors
+    that cannot match anything in a document without running them.
+    '''
+    try:
+        selectors = parse(text)
+    except Exception:
+        return None
+    if len(selectors) != 1:
+        return None
+    node = selectors[0].parsed_tree
+    while isinstance(node, CombinedSelector):
+        node = node.subselector
+    ans = None
+    while node is not None:
+        if isinstance(node, Hash):
+            return 'id_map', ascii_lower(node.id)
+        if isinstance(node, Class):
+            if ans is None:
+                ans = 'class_map', ascii_lower(node.class_name)
+        elif isinstance(node, Element):
+            if ans is None and node.element and node.element != '*':
+                ans = 'element_map', ascii_lower(node.element)
+            break
+        node = getattr(node, 'selector', None)
+    return ans
+
+
 class StylizerRules:
 
     def __init__(self, opts, profile, stylesheets):
@@ -156,6 +191,13 @@ def __init__(self, opts, profile, stylesheets):
                     self.rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
                     index = index + 1
         self.rules.sort(key=itemgetter(0))  # sort by specificity
+        # The pseudo class and key for every rule, see selector_key()
+        pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
+        self.rule_index = []
+        for _, _, _, text, _ in self.rules:
+            fl = pseudo_pat.search(text)
+            self.rule_index.append((None if fl is None else fl.group(1), selector_key(text)))
+        self.style_attr_cache = {}
 
     def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
         results = []
@@ -208,6 +250,28 @@ def flatten_style(self, cssstyle):
         cleanup_epub_prefixed_properties(style)
         return style
 
+    def flatten_style_attr(self, css, url_replacer=None):
+        ''' Return the flattened style for the contents of a style attribute or
+        None if it is invalid. Many elements have the same style attribute,
+        so the results are cached. '''
+        key = css
+        if url_replacer is not None and ('url' in css.lower() or '\\' in css):
+            key = css, url_replacer
+        try:
+            return self.style_attr_cache[key]
+        except KeyError:
+            pass
+        try:
+            style = parseStyle(css, validate=False)
+        except CSSSyntaxError:
+            ans = None
+        else:
+            if url_replacer is not None:
+                replaceUrls(style, url_replacer, ignoreImportRules=True)
+            ans = self.flatten_style(style)
+        self.style_attr_cache[key] = ans
+        return ans
+
     def _apply_text_align(self, text):
         if text in ('left', 'justify') and self.opts.change_justification in ('left', 'justify'):
             text = self.opts.change_justification
@@ -227,6 +291,26 @@ def same_rules(self, opts, profile, stylesheets):
         return True
 
 
+def cached_stylizer_rules(oeb, opts, profile, stylesheets):
+    '''
+    Return the StylizerRules for stylesheets, re-using the ones created for
+    other files with the same stylesheets. The cache is keyed on object ids,
+    which stay unique as the cached StylizerRules keep references to the
+    objects.
+    '''
+    cache = getattr(oeb, 'stylizer_rules_cache', None)
+    if cache is None:
+        cache = oeb.stylizer_rules_cache = {}
+    key = id(opts), id(profile), tuple(map(id, stylesheets))
+    ans = cache.pop(key, None)
+    if ans is None or not ans.same_rules(opts, profile, stylesheets):
+        ans = StylizerRules(opts, profile, stylesheets)
+    cache[key] = ans
+    if len(cache) > STYLIZER_RULES_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    return ans
+
+
 class Stylizer:
     STYLESHEETS = WeakKeyDictionary()
 
@@ -329,22 +413,22 @@ def __init__(self, tree, path, oeb, opts, profile=None,
                     self.logger.debug('Bad css: ')
                     self.logger.debug(x)
 
-        # using oeb to store the rules, page rule and font face rules
-        # and generating them again if opts, profile or stylesheets are different
-        if (not hasattr(self.oeb, 'stylizer_rules')) \
-            or not self.oeb.stylizer_rules.same_rules(self.opts, self.profile, stylesheets):
-            self.oeb.stylizer_rules = StylizerRules(self.opts, self.profile, stylesheets)
-        self.rules = self.oeb.stylizer_rules.rules
-        self.page_rule = self.oeb.stylizer_rules.page_rule
-        self.font_face_rules = self.oeb.stylizer_rules.font_face_rules
-        self.flatten_style = self.oeb.stylizer_rules.flatten_style
+        # The rules, page rule and font face rules are stored on oeb and
+        # shared by all files that use the same opts, profile and stylesheets
+        self.stylizer_rules = cached_stylizer_rules(self.oeb, self.opts, self.profile, stylesheets)
+        self.rules = self.stylizer_rules.rules
+        self.page_rule = self.stylizer_rules.page_rule
+        self.font_face_rules = self.stylizer_rules.font_face_rules
+        self.flatten_style = self.stylizer_rules.flatten_style
 
         self._styles = {}
-        pseudo_pat = re.compile(':{{1,2}}({})'.format('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
 
-        for _, _, cssdict, text, _ in self.rules:
-            fl = pseudo_pat.search(text)
+        for (_, _, cssdict, text, _), (fl, key) in zip(self.rules, self.stylizer_rules.rule_index):
+            if key is not None and key[1] not in getattr(select, key[0]):
+                # No element in this document has the id, class or tag
+                # this rule needs
+                continue
             try:
                 matches = tuple(select(text))
             except SelectorError as err:
@@ -352,7 +436,6 @@ def __init__(self, tree, path, oeb, opts, profile=None,
                 continue
 
             if fl is not None:
-                fl = fl.group(1)
                 if fl == 'first-letter' and getattr(self.oeb,
                         'plumber_output_format', '').lower() in {'mobi', 'docx'}:
                     # Fake first-letter
@@ -518,13 +601,9 @@ def _apply_style_attr(self, url_replacer=None):
         css = [y.strip() for y in css]
         css = [y for y in css if self.MS_PAT.match(y) is None]
         css = '; '.join(css)
-        try:
-            style = parseStyle(css, validate=False)
-        except CSSSyntaxError:
-            return
-        if url_replacer is not None:
-            replaceUrls(style, url_replacer, ignoreImportRules=True)
-        self._update_style(self._stylizer.flatten_style(style))
+        style = self._stylizer.stylizer_rules.flatten_style_attr(css, url_replacer)
+        if style is not None:
+            self._update_style(style)
 
     def _has_parent(self):
         try:
@@ -887,3 +966,68 @@ def pseudo_classes(self, filter_css):
     @property
     def is_hidden(self):
         return self._style.get('display') == 'none' or self._style.get('visibility') == 'hidden'
+
+
+def find_tests():
+    import unittest
+    from types import SimpleNamespace
+    from unittest.mock import patch
+
+    class TestStylizer(unittest.TestCase):
+
+        def test_rule_index(self):
+            from calibre.customize.profiles import OutputProfile
+            from calibre.ebooks.oeb.base import XHTML_MIME, OEBBook
+            from calibre.utils.logging import default_log
+            from calibre.utils.xml_parse import safe_xml_fromstring
+
+            for text, key in (
+                ('p', ('element_map', 'p')), ('DIV.Note', ('class_map', 'note')), ('.a#Main', ('id_map', 'main')),
+                ('div > p.x', ('class_map', 'x')), ('h1 + p ~ SPAN', ('element_map', 'span')),
+                ('a:not(.x)', ('element_map', 'a')), (':not(.x)', None), ('*', None), ('svg|rect', ('element_map', 'rect')),
+                ('p, div', None), ('[title]', None),
+            ):
+                self.assertEqual(selector_key(text), key, text)
+
+            css = '''
+            @namespace svg url(http://www.w3.org/2000/svg);
+            p { margin-top: 1px }
+            P.NOTE { margin-left: 2px }
+            p.note.Important { color: red }
+            #MAIN p, .absent { margin-right: 3px }
+            div#main > p { margin-bottom: 4px }
+            h1 + p { font-weight: bold }
+            h1 ~ p.note { font-style: italic }
+            .INTRO span { text-indent: 5px }
+            p:not(.note) { text-align: center }
+            :not(#nothing) > span { padding-left: 6px }
+            span:not(.Absent) { padding-right: 7px }
+            svg|rect.box { fill: blue }
+            *|rect { stroke: green }
+            #absent p, .absent, table td, P.Missing { color: yellow }
+            '''
+            html = f'''<html xmlns="http://www.w3.org/1999/xhtml"><head><style>{css}</style></head><body>
+            <div id="Main"><h1 class="Intro">Title</h1><p class="Note Important">One <span>a</span></p>
+            <p>Two</p><p class="note">Three</p></div>
+            <div class="intro"><p><span class="ABSENT">b</span></p></div>
+            <svg xmlns="http://www.w3.org/2000/svg"><rect class="Box"/></svg>
+            </body></html>'''
+            profile = OutputProfile(None)
+            opts = SimpleNamespace(output_profile=profile, change_justification='original')
+
+            def styles():
+                oeb = OEBBook(default_log, html_preprocessor=None)
+                root = safe_xml_fromstring(html)
+                oeb.manifest.add('index', 'index.html', XHTML_MIME, data=root)
+                stylizer = Stylizer(root, 'index.html', oeb, opts, profile)
+                return stylizer, [stylizer.style(elem).cssdict() for elem in root.iter('*')]
+
+            stylizer, indexed = styles()
+            self.assertTrue(any(key is not None for fl, key in stylizer.stylizer_rules.rule_index))
+            self.assertIn('fill', indexed[-1])
+            with patch(__name__ + '.selector_key', lambda text: None):
+                stylizer, unindexed = styles()
+            self.assertTrue(all(key is None for fl, key in stylizer.stylizer_rules.rule_index))
+            self.assertEqual(indexed, unindexed)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestStylizer)
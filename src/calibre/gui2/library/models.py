@@ -85,27 +85,21 @@ def group_numbers(numbers):
 
 class ColumnColor:  # {{{
 
-    def __init__(self, formatter):
-        self.mi = None
+    def __init__(self, formatter, model):
         self.formatter = formatter
+        self.model = model
 
     def __call__(self, id_, key, fmt, db, color_cache, template_cache):
         key += str(hash(fmt))
         if id_ in color_cache and key in color_cache[id_]:
-            self.mi = None
             color = color_cache[id_][key]
             if color.isValid():
                 return color
             return None
         try:
-            if self.mi is None:
-                self.mi = db.new_api.get_proxy_metadata(id_)
-            color = QColor(self.formatter.safe_format(fmt, self.mi, '', self.mi,
-                                                  column_name=key,
-                                                  template_cache=template_cache))
+            color = QColor(self.model.template_value(id_, fmt, key, template_cache))
             color_cache[id_][key] = color
             if color.isValid():
-                self.mi = None
                 return color
         except Exception:
             pass
@@ -129,7 +123,6 @@ def themed_icon_name(icon_dir, icon_name):
 class ColumnIcon:  # {{{
 
     def __init__(self, formatter, model):
-        self.mi = None
         self.formatter = formatter
         self.model = model
         self.dpr = QApplication.instance().devicePixelRatio()
@@ -137,16 +130,11 @@ def __init__(self, formatter, model):
     def __call__(self, id_, fmts, cache_index, db, icon_cache, icon_bitmap_cache,
              template_cache):
         if id_ in icon_cache and cache_index in icon_cache[id_]:
-            self.mi = None
             return icon_cache[id_][cache_index]
         try:
-            if self.mi is None:
-                self.mi = db.new_api.get_proxy_metadata(id_)
             icons = []
             for dex, (kind, fmt) in enumerate(fmts):
-                rule_icons = self.formatter.safe_format(fmt, self.mi, '', self.mi,
-                                    column_name=cache_index+str(dex),
-                                    template_cache=template_cache)
+                rule_icons = self.model.template_value(id_, fmt, cache_index+str(dex), template_cache)
                 if not rule_icons:
                     continue
                 icon_list = [ic.strip() for ic in rule_icons.split(':') if ic.strip()]
@@ -192,7 +180,6 @@ def __call__(self, id_, fmts, cache_index, db, icon_cache, icon_bitmap_cache,
 
                 icon_cache[id_][cache_index] = result
                 icon_bitmap_cache[icon_string] = result
-                self.mi = None
                 return result
         except Exception:
             pass
@@ -209,6 +196,9 @@ class BooksModel(QAbstractTableModel):  # {{{
     searched             = pyqtSignal(object)
     search_done          = pyqtSignal()
 
+    # Number of rows for which column coloring and icon templates are evaluated at a time
+    TEMPLATE_BATCH_SIZE = 50
+
     def __init__(self, parent=None, buffer=40):
         QAbstractTableModel.__init__(self, parent)
         base_font = parent.font() if parent else QApplication.instance().font()
@@ -244,7 +234,7 @@ def __init__(self, parent=None, buffer=40):
 
         self.formatter = SafeFormat()
         self._clear_caches()
-        self.column_color = ColumnColor(self.formatter)
+        self.column_color = ColumnColor(self.formatter, self)
         self.column_icon = ColumnIcon(self.formatter, self)
 
         self.book_on_device = None
@@ -323,6 +313,26 @@ def _clear_caches(self):
         self.icon_template_cache = {}
         self.cover_grid_template_cache = {}
         self.bookshelf_template_cache = {}
+        self.template_values_cache = defaultdict(dict)
+
+    def template_value(self, book_id, fmt, column_name, template_cache):
+        ''' Return the value of the column coloring or icon template fmt for
+        book_id. The template is evaluated for the books in the rows after
+        book_id at the same time, as those are usually the next ones to be
+        painted, which is much faster than evaluating it one book at a time. '''
+        vals = self.template_values_cache[(column_name, fmt)]
+        try:
+            return vals[book_id]
+        except KeyError:
+            pass
+        book_ids = [book_id]
+        row = self.db.data.safe_id_to_index(book_id)
+        if row > -1:
+            id_map = self.db.data.index_to_id_map()
+            book_ids.extend(x for x in id_map[row+1:row+self.TEMPLATE_BATCH_SIZE] if x not in vals)
+        vals.update(self.db.new_api.evaluate_template_for_books(
+            fmt, book_ids, '', column_name=column_name, template_cache=template_cache, formatter=self.formatter))
+        return vals[book_id]
 
     def set_row_height(self, height):
         self.row_height = height
@@ -1134,7 +1144,6 @@ def actual_data(self, index, role, col):
                     if k == key and kind in {'icon_only', 'icon_only_composed'}:
                         if id_ is None:
                             id_ = self.id(index)
-                            self.column_icon.mi = None
                         fmts.append((kind, fmt))
 
                 if fmts:
@@ -1156,7 +1165,6 @@ def actual_data(self, index, role, col):
         elif role == Qt.ItemDataRole.ForegroundRole:
             key = self.column_map[col]
             id_ = self.id(index)
-            self.column_color.mi = None
 
             for k, fmt in self.db_prefs['column_color_rules']:
                 if k == key:
@@ -1175,7 +1183,6 @@ def actual_data(self, index, role, col):
                     try:
                         color = QColor(colors[values.index(txt)])
                         if color.isValid():
-                            self.column_color.mi = None
                             return (color)
                     except Exception:
                         pass
@@ -1189,7 +1196,6 @@ def actual_data(self, index, role, col):
                 if ccol is not None:
                     return ccol
 
-            self.column_color.mi = None
             return None
         elif role == Qt.ItemDataRole.DecorationRole:
             default_icon = None
@@ -1205,7 +1211,6 @@ def actual_data(self, index, role, col):
                     if k == key and kind.startswith('icon'):
                         if id_ is None:
                             id_ = self.id(index)
-                            self.column_icon.mi = None
                         fmts.append((kind, fmt))
                         if kind in ('icon', 'icon_composed'):
                             need_icon_with_text = True
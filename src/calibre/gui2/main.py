@@ -295,7 +295,7 @@ def initialize_db_stage2(self, db, tb):
 
             try:
                 self.library_path = candidate
-                db = LibraryDatabase(candidate)
+                db = LibraryDatabase(candidate, composite_cache=True)
             except Exception:
                 self.show_error(_('Bad database location'), _(
                     'Bad database location %r. calibre will now quit.')%self.library_path,
@@ -319,7 +319,7 @@ def initialize_db(self):
         db = None
         timed_print('Initializing db...')
         try:
-            db = LibraryDatabase(self.library_path)
+            db = LibraryDatabase(self.library_path, composite_cache=True)
         except apsw.Error:
             with self.app:
                 self.hide_splash_screen()
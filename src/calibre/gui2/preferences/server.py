@@ -1418,6 +1418,13 @@ def save_changes(self):
                 error_dialog(
                     self, _('Invalid trusted IPs'), str(e), show=True)
                 return False
+        if settings['trusted_proxies']:
+            try:
+                tuple(parse_trusted_ips(settings['trusted_proxies']))
+            except Exception as e:
+                error_dialog(
+                    self, _('Invalid reverse proxy IPs'), str(e), show=True)
+                return False
 
         if not self.custom_list_tab.commit():
             return False
@@ -959,7 +959,7 @@ def library_moved(self, newloc, copy_structure=False, allow_rebuild=False):
             db = self.library_broker.prepare_for_gui_library_change(newloc)
             if db is None:
                 try:
-                    db = LibraryDatabase(newloc, default_prefs=default_prefs)
+                    db = LibraryDatabase(newloc, default_prefs=default_prefs, composite_cache=True)
                 except apsw.Error:
                     if not allow_rebuild:
                         raise
@@ -9,17 +9,19 @@
 import time
 from functools import partial
 from hashlib import sha256
-from threading import Lock, RLock
+from threading import Event, Lock, RLock
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
 from calibre.ebooks.metadata import authors_to_string
 from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.file_cache import FileCache, folder_size
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
-from calibre.srv.render_book import RENDER_VERSION
+from calibre.srv.render_book import RENDER_VERSION, ResourceCache
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
+from calibre.utils.config import prefs
 from calibre.utils.filenames import rmtree
 from calibre.utils.localization import _
 from calibre.utils.resources import get_path as P
@@ -46,7 +48,7 @@ def books_cache_dir():
     if _books_cache_dir:
         return _books_cache_dir
     base = abspath(os.path.join(cache_dir(), 'srvb'))
-    for d in 'sf':
+    for d in 'sfr':
         try:
             os.makedirs(os.path.join(base, d))
         except OSError as e:
@@ -61,6 +63,11 @@ def book_hash(library_uuid, book_id, fmt, size, mtime):
     return as_unicode(sha256(raw).hexdigest())
 
 
+def format_hash(db, book_id, fmt, fm):
+    size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+    return size, mtime, book_hash(db.library_id, book_id, fmt, size, mtime)
+
+
 staging_cleaned = False
 
 
@@ -73,8 +80,10 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, max_workers=0):
     global staging_cleaned
+    # job_done() has no ctx, so ensure the size limit is set before it is called
+    rendered_books(ctx)
     tdir = os.path.join(books_cache_dir(), 's')
     if not staging_cleaned:
         staging_cleaned = True
@@ -85,30 +94,47 @@ def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
     job_id = ctx.start_job(f'Render book {book_id} ({fmt})', 'calibre.srv.render_book', 'render', args=(
-        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
+        pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}), kwargs={
+            'max_workers': max_workers, 'resource_cache_dir': os.path.join(books_cache_dir(), 'r')},
         job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
     queued_jobs[bhash] = job_id
     return job_id
 
 
-last_final_clean_time = 0
+def remove_rendered_book(path):
+    keys = ResourceCache.keys_for_rendered_book(path)
+    safe_remove(path, False)
+    if keys:
+        ResourceCache(os.path.join(books_cache_dir(), 'r')).release(keys)
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
-        try:
-            tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
-        except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+_rendered_books = None
+
+
+def rendered_books(ctx=None):
+    ' The size limited index of rendered books, must be called with cache_lock held '
+    global _rendered_books
+    if _rendered_books is None:
+        fdir = os.path.join(books_cache_dir(), 'f')
+        ans = FileCache(lambda bhash: remove_rendered_book(os.path.join(fdir, bhash)))
+        # Remove processed files left over from failed or interrupted renders
+        ResourceCache(os.path.join(books_cache_dir(), 'r')).release_unused()
+        # Index the books rendered by previous runs, in order of last access
+        existing = []
+        for x in os.listdir(fdir):
+            path = os.path.join(fdir, x)
+            try:
+                tm = os.path.getmtime(os.path.join(path, 'calibre-book-manifest.json'))
+            except OSError:
+                tm = 0
+            existing.append((tm, x, folder_size(path)))
+        for tm, x, size in sorted(existing):
+            ans.entries[x] = size
+            ans.total_size += size
+        _rendered_books = ans
+    if ctx is not None:
+        _rendered_books.max_size = int(ctx.opts.max_book_cache_size * 1024 * 1024)
+    return _rendered_books
 
 
 def rename_with_retry(a, b, sleep_time=1):
@@ -132,15 +158,110 @@ def job_done(job):
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
-                safe_remove(dest, False)
+                remove_rendered_book(dest)
                 rename_with_retry(tdir, dest)
+                rendered_books().add(bhash, folder_size(dest))
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
 
 
+# Pre-rendering of books likely to be read {{{
+
+# Same as FORMAT_PRIORITIES in book_details.pyj
+READ_FORMAT_PRIORITIES = ('EPUB', 'AZW3', 'DOCX', 'LIT', 'MOBI', 'ODT', 'RTF', 'MD', 'MARKDOWN', 'TXT', 'PDF')
+
+
+def preferred_read_format(formats):
+    ' The format the browser viewer will use to read a book with the specified formats, or None '
+    formats = {f.upper() for f in formats}
+    fmt = prefs['output_format'].upper()
+    if fmt == 'PDF':
+        fmt = 'EPUB'
+    if fmt in formats:
+        return fmt
+    for q in sorted(formats, key=lambda x: READ_FORMAT_PRIORITIES.index(x) if x in READ_FORMAT_PRIORITIES else len(READ_FORMAT_PRIORITIES)):
+        if plugin_for_input_format(q) is not None:
+            return q
+
+
+def prerender_book(ctx, db, book_id, fmt, max_workers=1):
+    ''' Queue a job to render the specified book, unless it has already been
+    rendered or is being rendered. Returns the job id or None. '''
+    fm = db.format_metadata(book_id, fmt, allow_cache=False)
+    if not fm:
+        return
+    size, mtime, bhash = format_hash(db, book_id, fmt, fm)
+    with cache_lock:
+        mpath = os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json')
+        if os.path.exists(mpath) or bhash in queued_jobs or bhash in failed_jobs:
+            return
+        return queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, max_workers=max_workers)
+
+
+class BookPrerenderer:
+
+    '''
+    A server plugin that prepares the most recently added and recently read
+    books in every open library for reading in the browser, so that they open
+    instantly. Books are rendered one at a time, using a single worker process,
+    so as not to delay rendering of the books users actually open. The
+    libraries are checked again for new books every interval seconds.
+    Libraries that no client has opened yet are skipped, so as not to keep
+    them all loaded.
+    '''
+
+    def __init__(self, ctx, num_books, interval=3600):
+        self.ctx, self.num_books, self.interval = ctx, num_books, interval
+        self.shutdown = Event()
+        self.stop = self.shutdown.set
+
+    def start(self, loop):
+        self.log = loop.log
+        while not self.shutdown.is_set():
+            for library_id, db in self.open_libraries():
+                if self.shutdown.is_set():
+                    return
+                try:
+                    self.prerender_library(library_id, db)
+                except Exception:
+                    self.log.exception('Failed to prepare books for reading in library:', library_id)
+            self.shutdown.wait(self.interval)
+
+    def open_libraries(self):
+        broker = self.ctx.library_broker
+        with broker:
+            loaded = tuple(broker.loaded_dbs.items())
+        for library_id, db in loaded:
+            db = getattr(db, 'new_api', db)
+            if db is not None:
+                yield library_id, db
+
+    def books_to_render(self, db, library_id):
+        seen = set()
+        candidates = last_read_cache().get_recently_read_books(library_id, self.num_books)
+        for book_id in db.multisort([('timestamp', False)])[:self.num_books]:
+            fmt = preferred_read_format(db.formats(book_id))
+            if fmt is not None:
+                candidates.append((book_id, fmt))
+        for book_id, fmt in candidates:
+            if (book_id, fmt) not in seen and db.has_format(book_id, fmt):
+                seen.add((book_id, fmt))
+                yield book_id, fmt
+
+    def prerender_library(self, library_id, db):
+        for book_id, fmt in self.books_to_render(db, library_id):
+            if self.shutdown.is_set():
+                break
+            job_id = prerender_book(self.ctx, db, book_id, fmt)
+            if job_id is not None:
+                # Wait for the job to finish before starting the next one
+                while not self.shutdown.wait(0.5) and self.ctx.job_status(job_id)[0] in ('waiting', 'running'):
+                    pass
+# }}}
+
+
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
 def book_manifest(ctx, rd, book_id, fmt):
     db, library_id = get_library_data(ctx, rd)[:2]
@@ -153,9 +274,9 @@ def book_manifest(ctx, rd, book_id, fmt):
         fm = db.format_metadata(book_id, fmt, allow_cache=False)
         if not fm:
             raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
-        bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+        size, mtime, bhash = format_hash(db, book_id, fmt, fm)
         with cache_lock:
+            cache = rendered_books(ctx)
             mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
             if force_reload:
                 safe_remove(mpath, True)
@@ -167,6 +288,7 @@ def book_manifest(ctx, rd, book_id, fmt):
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
                 ans['annotations_map'] = db.annotations_map_for_book(book_id, fmt, user_type='web', user=user or '*')
+                cache.hit(bhash)
                 return ans
             except OSError as e:
                 if e.errno != errno.ENOENT:
@@ -176,6 +298,7 @@ def book_manifest(ctx, rd, book_id, fmt):
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
             if job_id is None:
+                cache.miss()
                 job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
@@ -192,11 +315,15 @@ def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     if not mpath.startswith(base):
         raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
     try:
-        return rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
+        ans = rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
     except OSError as e:
         if e.errno != errno.ENOENT:
             raise
         raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
+    # Keep the book from being evicted while it is being read
+    with cache_lock:
+        rendered_books(ctx).hit(bhash)
+    return ans
 
 
 @endpoint('/book-get-last-read-position/{library_id}/{+which}', postprocess=json)
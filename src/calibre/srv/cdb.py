@@ -210,13 +210,13 @@ def cdb_set_fields(ctx, rd, book_id, library_id):
         db.remove_formats({book_id: list(removed_formats)})
         dirtied.add(book_id)
 
-    for field, value in changes.items():
-        if field == 'languages' and value:
-            rmap = reverse_lang_map_for_ui()
-            def to_lang_code(x):
-                return rmap.get(x, canonicalize_lang(x))
-            value = list(filter(None, map(to_lang_code, value)))
-        dirtied |= db.set_field(field, {book_id: value})
+    if changes.get('languages'):
+        rmap = reverse_lang_map_for_ui()
+        def to_lang_code(x):
+            return rmap.get(x, canonicalize_lang(x))
+        changes['languages'] = list(filter(None, map(to_lang_code, changes['languages'])))
+    if changes:
+        dirtied |= db.bulk_update({field: {book_id: value} for field, value in changes.items()})
     ctx.notify_changes(db.backend.library_path, metadata(dirtied))
     all_ids = dirtied if all_dirtied else (dirtied & loaded_book_ids)
     all_ids |= {book_id}
@@ -30,6 +30,10 @@
 from calibre.utils.serialize import json_dumps
 
 POSTABLE = frozenset({'GET', 'POST', 'HEAD'})
+# The data generation of a library starts from zero whenever the library is
+# opened, so it is combined with this and the identity of the opened library
+# to create unique ETags
+DATA_GENERATION_SALT = random.getrandbits(64)
 
 
 @endpoint('', auth_required=True)  # auth_required=True needed for Chrome: https://bugs.launchpad.net/calibre/+bug/1982060
@@ -453,7 +457,8 @@ def tag_browser(ctx, rd):
     db, library_id = get_library_data(ctx, rd)[:2]
     opts = categories_settings(rd.query, db, gst_container=tuple)
     vl = rd.query.get('vl') or ''
-    etag = json_dumps([db.last_modified().isoformat(), rd.username, library_id, vl, list(opts)])
+    etag = json_dumps([
+        DATA_GENERATION_SALT, id(db), db.data_generation(), rd.username, ctx.restriction_for(rd, db), library_id, vl, list(opts)])
     etag = hashlib.sha256(etag).hexdigest()
 
     def generate():
@@ -8,9 +8,10 @@
 import errno
 import os
 import re
-from contextlib import suppress
+from contextlib import contextmanager, suppress
 from functools import partial
 from io import BytesIO
+from itertools import count
 from json import load as load_json_file
 from threading import Lock
 from urllib.parse import quote
@@ -24,7 +25,8 @@
 from calibre.ebooks.metadata.meta import set_metadata
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
-from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
+from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound
+from calibre.srv.file_cache import FileCache
 from calibre.srv.metadata import encode_stat_result
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_use_roman, http_date
@@ -42,17 +44,86 @@
 plugboard_content_server_value = 'content_server'
 plugboard_content_server_formats = ['epub', 'mobi', 'azw3', 'pdf']
 update_metadata_in_fmts = frozenset(plugboard_content_server_formats)
-lock = Lock()
+
+
+class FileLocks:
+
+    '''
+    Locks for individual cached files, so that different files, for example
+    the thumbnails for a grid of books, are generated in parallel, while
+    requests for a file that is being generated wait for it to be ready,
+    instead of generating it again.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.locks = {}
+
+    @contextmanager
+    def __call__(self, key):
+        with self.lock:
+            lock, users = self.locks.get(key, (None, 0))
+            if lock is None:
+                lock = Lock()
+            self.locks[key] = lock, users + 1
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                users = self.locks[key][1] - 1
+                if users:
+                    self.locks[key] = lock, users
+                else:
+                    del self.locks[key]
+
+    def is_locked(self, key):
+        return key in self.locks
+
+
+file_locks = FileLocks()
+# Text rendering is not guaranteed to be thread safe on all platforms
+generate_cover_lock = Lock()
 
 # Get book formats/cover as a cached filesystem file {{{
 
-rename_counter = 0
+rename_counter = count(1)
+file_caches = {}
+file_caches_lock = Lock()
 
 
 def reset_caches():
     pass
 
 
+def remove_cached_file(fname):
+    # The file may be open, so we cannot change its contents, as that would
+    # lead to corrupted downloads in any clients that are currently
+    # downloading the file.
+    try:
+        if iswindows:
+            # On windows in order to re-use the file name, we have to rename
+            # it before deleting it
+            dname = os.path.join(os.path.dirname(fname), f'_{next(rename_counter):x}')
+            atomic_rename(fname, dname)
+            os.remove(dname)
+        else:
+            os.remove(fname)
+    except FileNotFoundError:
+        pass
+
+
+def file_cache(ctx, tdir):
+    ' The size limited index of the cached files in the server temp folder tdir '
+    base = os.path.join(tdir, 'fcache')
+    with file_caches_lock:
+        ans = file_caches.get(base)
+        if ans is None:
+            ans = file_caches[base] = FileCache(remove_cached_file)
+    ans.max_size = int(ctx.opts.max_file_cache_size * 1024 * 1024)
+    return ans
+
+
 def open_for_write(fname):
     try:
         return share_open(fname, 'w+b')
@@ -64,63 +135,70 @@ def open_for_write(fname):
     return share_open(fname, 'w+b')
 
 
-def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func, extra_etag_data=''):
-    ''' We cannot copy files directly from the library folder to the output
-    socket, as this can potentially lock the library for an extended period. So
-    instead we copy out the data from the library folder into a temp folder. We
-    make sure to only do this copy once, using the previous copy, if there have
-    been no changes to the data for the file since the last copy. '''
-    global rename_counter
-
+def cached_file_path(tdir, prefix, library_id, book_id, ext):
     # Avoid too many items in a single directory for performance
-    base = os.path.join(rd.tdir, 'fcache', ((f'{book_id:x}')[-3:]))
+    base = os.path.join(tdir, 'fcache', ((f'{book_id:x}')[-3:]))
     if iswindows:
         base = '\\\\?\\' + os.path.abspath(base)  # Ensure fname is not too long for windows' API
 
     bname = f'{prefix}-{library_id}-{book_id:x}.{ext}'
     if '\\' in bname or '/' in bname:
         raise ValueError('File components must not contain path separators')
-    fname = os.path.join(base, bname)
+    return os.path.join(base, bname)
+
+
+def cached_file_mtime(fname):
+    with suppress(OSError):
+        return os.path.getmtime(fname)
+
+
+def copy_to_file_cache(ctx, tdir, fname, mtime, copy_func):
+    ''' Return an open file containing the data written by copy_func to fname
+    and whether an existing copy was re-used. The existing copy is re-used if it
+    is not older than mtime (a timestamp). '''
     used_cache = 'no'
+    cache = file_cache(ctx, tdir)
 
-    def safe_mtime():
-        with suppress(OSError):
-            return os.path.getmtime(fname)
+    def create():
+        ans = open_for_write(fname)
+        copy_func(ans)
+        cache.miss()
+        cache.add(fname, ans.tell(), in_use=file_locks.is_locked)
+        ans.seek(0)
+        return ans
 
-    mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
-    with lock:
-        previous_mtime = safe_mtime()
-        if previous_mtime is None or previous_mtime < mt:
+    with file_locks(fname):
+        previous_mtime = cached_file_mtime(fname)
+        if previous_mtime is None or previous_mtime < mtime:
             if previous_mtime is not None:
-                # File exists and may be open, so we cannot change its
-                # contents, as that would lead to corrupted downloads in any
-                # clients that are currently downloading the file.
-                if iswindows:
-                    # On windows in order to re-use bname, we have to rename it
-                    # before deleting it
-                    rename_counter += 1
-                    dname = os.path.join(base, f'_{rename_counter:x}')
-                    atomic_rename(fname, dname)
-                    os.remove(dname)
-                else:
-                    os.remove(fname)
-            ans = open_for_write(fname)
-            copy_func(ans)
-            ans.seek(0)
+                remove_cached_file(fname)
+            ans = create()
         else:
             try:
                 ans = share_open(fname, 'rb')
                 used_cache = 'yes'
+                cache.hit(fname)
             except OSError as err:
                 if err.errno != errno.ENOENT:
                     raise
-                ans = open_for_write(fname)
-                copy_func(ans)
-                ans.seek(0)
-        if ctx.testing:
-            rd.outheaders['Used-Cache'] = used_cache
-            rd.outheaders['Tempfile'] = as_hex_unicode(fname)
-        return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mt, extra_etag_data)
+                ans = create()
+    return ans, used_cache
+
+
+def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func, extra_etag_data=''):
+    ''' We cannot copy files directly from the library folder to the output
+    socket, as this can potentially lock the library for an extended period. So
+    instead we copy out the data from the library folder into a temp folder. We
+    make sure to only do this copy once, using the previous copy, if there have
+    been no changes to the data for the file since the last copy. '''
+
+    fname = cached_file_path(rd.tdir, prefix, library_id, book_id, ext)
+    mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
+    ans, used_cache = copy_to_file_cache(ctx, rd.tdir, fname, mt, copy_func)
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+        rd.outheaders['Tempfile'] = as_hex_unicode(fname)
+    return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mt, extra_etag_data)
 
 
 def write_generated_cover(db, book_id, width, height, destf):
@@ -132,7 +210,8 @@ def write_generated_cover(db, book_id, width, height, destf):
         ratio = height / float(cprefs['cover_height'])
         prefs = override_prefs(cprefs)
         scale_cover(prefs, ratio)
-    cdata = generate_cover(mi, prefs=prefs)
+    with generate_cover_lock:
+        cdata = generate_cover(mi, prefs=prefs)
     destf.write(cdata)
 
 
@@ -145,6 +224,10 @@ def generated_cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, partial(write_generated_cover, db, book_id, width, height))
 
 
+def thumbnail_quality():
+    return min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+
+
 def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     mtime = db.cover_last_modified(book_id)
     if mtime is None:
@@ -159,8 +242,7 @@ def copy_func(dest):
         def copy_func(dest):
             buf = BytesIO()
             db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
+            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=thumbnail_quality())[-1]
             dest.write(data)
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
 
@@ -255,6 +337,27 @@ def apple_touch_icon(ctx, rd):
     return share_open(I('apple-touch-icon.png'), 'rb')
 
 
+@endpoint('/cache-stats', postprocess=json)
+def cache_stats(ctx, rd):
+    ''' Sizes and hit/miss counts for the caches of generated files, useful for
+    tuning the cache size limits. Only available to connections from the local
+    computer or from trusted IP addresses, as the statistics are server wide. '''
+    import ipaddress
+
+    from calibre.srv.books import cache_lock, rendered_books
+    from calibre.srv.loop import is_local_address
+    if not rd.is_trusted_ip:
+        try:
+            addr = ipaddress.ip_address(rd.remote_addr)
+        except Exception:
+            addr = None
+        if not is_local_address(addr):
+            raise HTTPForbidden('Cache statistics are only available to local or trusted connections')
+    with cache_lock:
+        books = rendered_books().stats()
+    return {'files': file_cache(ctx, rd.tdir).stats(), 'books': books}
+
+
 @endpoint('/icon/{+which}', auth_required=False, cache_control=24)
 def icon(ctx, rd, which):
     sz = rd.query.get('sz')
@@ -282,8 +385,8 @@ def icon(ctx, rd, which):
             return share_open(path, 'rb')
         except OSError:
             raise HTTPNotFound()
-    with lock:
-        cached = os.path.join(rd.tdir, 'icons', f'{sz}-{which}.png')
+    cached = os.path.join(rd.tdir, 'icons', f'{sz}-{which}.png')
+    with file_locks(cached):
         try:
             return share_open(cached, 'rb')
         except OSError:
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+from collections import OrderedDict
+from threading import Lock
+
+
+class FileCache:
+
+    '''
+    An in-memory index of the entries (files or folders) in an on-disk cache,
+    with their sizes, in least recently used order. When the total size of the
+    entries exceeds max_size bytes, the least recently used entries are
+    removed by calling remove(key). A max_size of zero means no limit.
+    '''
+
+    def __init__(self, remove, max_size=0):
+        self.remove = remove
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.total_size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit(self, key):
+        ' Record a use of the cached entry for key '
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def add(self, key, size, in_use=None):
+        '''
+        Add (or update) the entry for key, evicting least recently used
+        entries, other than key and entries for which in_use(key) is True, if
+        the cache is too large.
+        '''
+        with self.lock:
+            self.total_size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            evicted = self.find_evictable(key, in_use)
+        for k in evicted:
+            self.remove(k)
+        return evicted
+
+    def discard(self, key):
+        with self.lock:
+            self.total_size -= self.entries.pop(key, 0)
+
+    def find_evictable(self, keep, in_use):
+        ans = []
+        if self.max_size > 0 and self.total_size > self.max_size:
+            for key, size in tuple(self.entries.items()):
+                if self.total_size <= self.max_size:
+                    break
+                if key == keep or (in_use is not None and in_use(key)):
+                    continue
+                del self.entries[key]
+                self.total_size -= size
+                ans.append(key)
+            self.evictions += len(ans)
+        return ans
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries), 'size': self.total_size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            }
+
+
+def folder_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                ans += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return ans
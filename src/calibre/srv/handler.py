@@ -12,7 +12,6 @@
 from calibre.srv.library_broker import LibraryBroker, path_for_db
 from calibre.srv.routes import Router
 from calibre.srv.users import UserManager
-from calibre.utils.date import utcnow
 from calibre.utils.search_query_parser import ParseException
 
 
@@ -127,40 +126,43 @@ def get_effective_book_ids(self, db, request_data, vl, report_parse_errors=False
                 raise
             return frozenset()
 
+    def cached(self, caches, db, key, create, max_size):
+        # The cached values are discarded when the data in the library
+        # changes. The lock is not held while creating the value as that can
+        # be slow.
+        generation = db.data_generation()
+        with self.lock:
+            cache = caches[db.server_library_id]
+            old = cache.get(key)
+            if old is not None and old[0] == generation:
+                cache.move_to_end(key)
+                return old[1]
+        ans = create()
+        with self.lock:
+            cache[key] = generation, ans
+            cache.move_to_end(key)
+            while len(cache) > max_size:
+                cache.popitem(last=False)
+        return ans
+
     def get_categories(self, request_data, db, sort='name', first_letter_sort=True,
                        vl='', report_parse_errors=False):
         restrict_to_ids = self.get_effective_book_ids(db, request_data, vl,
                                           report_parse_errors=report_parse_errors)
-        key = restrict_to_ids, sort, first_letter_sort
-        with self.lock:
-            cache = self.library_broker.category_caches[db.server_library_id]
-            old = cache.pop(key, None)
-            if old is None or old[0] <= db.last_modified():
-                categories = db.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
-                cache[key] = old = (utcnow(), categories)
-                if len(cache) > self.CATEGORY_CACHE_SIZE:
-                    cache.popitem(last=False)
-            else:
-                cache[key] = old
-            return old[1]
+        return self.cached(
+            self.library_broker.category_caches, db, (restrict_to_ids, sort, first_letter_sort),
+            partial(db.get_categories, book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort), self.CATEGORY_CACHE_SIZE)
 
     def get_tag_browser(self, request_data, db, opts, render, vl=''):
         restrict_to_ids = self.get_effective_book_ids(db, request_data, vl)
-        key = restrict_to_ids, opts
-        with self.lock:
-            cache = self.library_broker.category_caches[db.server_library_id]
-            old = cache.pop(key, None)
-            if old is None or old[0] <= db.last_modified():
-                categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
-                data = json.dumps(render(db, categories), ensure_ascii=False)
-                if isinstance(data, str):
-                    data = data.encode('utf-8')
-                cache[key] = old = (utcnow(), data)
-                if len(cache) > self.CATEGORY_CACHE_SIZE:
-                    cache.popitem(last=False)
-            else:
-                cache[key] = old
-            return old[1]
+
+        def create():
+            categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
+            data = json.dumps(render(db, categories), ensure_ascii=False)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            return data
+        return self.cached(self.library_broker.tag_browser_caches, db, (restrict_to_ids, opts), create, self.CATEGORY_CACHE_SIZE)
 
     def search(self, request_data, db, query, vl='', report_restriction_errors=False):
         try:
@@ -12,7 +12,7 @@
 from calibre import as_unicode, force_unicode
 from calibre.ptempfile import SpooledTemporaryFile
 from calibre.srv.errors import HTTPSimpleResponse
-from calibre.srv.loop import READ, WRITE, Connection
+from calibre.srv.loop import READ, WRITE, Connection, is_ip_trusted, is_local_address, parsed_trusted_ips
 from calibre.srv.utils import HTTP1, HTTP11, Accumulator, MultiDict
 from polyglot.builtins import error_message
 from polyglot.urllib import unquote
@@ -213,6 +213,23 @@ def __init__(self, *args, **kwargs):
         self.forwarded_for = None
         self.request_original_uri = None
 
+    @property
+    def client_id(self):
+        # X-Forwarded-For can be set to anything by the client, so only use it
+        # when the connection is from a trusted reverse proxy. The last entry
+        # is the one added by the proxy nearest to us.
+        if self.forwarded_for and self.is_from_trusted_proxy:
+            return self.forwarded_for.rpartition(',')[2].strip() or self.remote_addr
+        return self.remote_addr
+
+    @property
+    def is_from_trusted_proxy(self):
+        addr = self.parsed_remote_addr
+        if is_local_address(addr):
+            return True
+        return bool(addr is not None and self.opts.trusted_proxies and is_ip_trusted(
+            addr, parsed_trusted_ips(self.opts.trusted_proxies)))
+
     def read(self, buf, endpos):
         size = endpos - buf.tell()
         if size > 0:
@@ -12,9 +12,9 @@
 import struct
 import time
 import uuid
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from compression import zlib
-from functools import wraps
+from functools import lru_cache, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from itertools import chain, repeat, zip_longest
 from operator import itemgetter
@@ -24,16 +24,29 @@
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.loop import WRITE
-from calibre.srv.utils import HTTP1, HTTP11, Cookie, MultiDict, get_translator_for_lang, http_date, socket_errors_socket_closed, sort_q_values
+from calibre.srv.utils import HTTP1, HTTP11, Cookie, MultiDict, get_translator_for_lang, http_date, q_values, socket_errors_socket_closed, sort_q_values
 from calibre.utils.monotonic import monotonic
 from calibre.utils.speedups import ReadOnlyFileBuffer
 from polyglot.builtins import error_message, reraise
 
+try:
+    from compression.zstd import ZstdCompressor
+except ImportError:
+    ZstdCompressor = None
+
 Range = namedtuple('Range', 'start stop size')
 MULTIPART_SEPARATOR = uuid.uuid4().hex
 if isinstance(MULTIPART_SEPARATOR, bytes):
     MULTIPART_SEPARATOR = MULTIPART_SEPARATOR.decode('ascii')
 COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
+# Supported content encodings, in order of preference
+CONTENT_ENCODINGS = ('zstd', 'gzip') if ZstdCompressor is not None else ('gzip',)
+# Requests for files, such as book formats, covers and thumbnails. These are
+# scheduled behind requests for data, which the user is waiting on.
+BULK_REQUESTS = frozenset((
+    'get', 'book-file', 'data-files', 'get-note-resource', 'static', 'icon', 'mathjax',
+    'reader-background', 'favicon.png', 'apple-touch-icon.png',
+))
 
 
 def file_metadata(fileobj):
@@ -92,11 +105,34 @@ def parse_if_none_match(val):  # {{{
 # }}}
 
 
-def acceptable_encoding(val, allowed=frozenset({'gzip'})):  # {{{
-    for x in sort_q_values(val):
+def acceptable_encoding(val, allowed=CONTENT_ENCODINGS):  # {{{
+    ''' Return the encoding with the highest q-value from allowed, breaking ties
+    by the order of the encodings in allowed. '''
+    allowed = tuple(allowed)
+    ans = None
+    for x, q in q_values(val):
         x = x.lower()
-        if x in allowed:
-            return x
+        if x in allowed and q > 0:
+            if ans is None:
+                ans = x, q
+            elif q < ans[1]:
+                break
+            elif allowed.index(x) < allowed.index(ans[0]):
+                ans = x, q
+    return None if ans is None else ans[0]
+# }}}
+
+
+@lru_cache(maxsize=2)
+def url_prefix_parts(url_prefix):
+    return tuple(filter(None, (url_prefix or '').split('/')))
+
+
+def is_bulk_request(path, url_prefix=None):  # {{{
+    prefix = url_prefix_parts(url_prefix)
+    if prefix and path[:len(prefix)] == prefix:
+        path = path[len(prefix):]
+    return bool(path) and path[0] in BULK_REQUESTS
 # }}}
 
 
@@ -191,6 +227,70 @@ def compress_readable_output(src_file, compress_level=6):
 # }}}
 
 
+def zstd_compress_readable_output(src_file):
+    zobj = ZstdCompressor()
+    while True:
+        data = src_file.read(DEFAULT_BUFFER_SIZE)
+        if not data:
+            break
+        yield zobj.compress(data)
+    yield zobj.flush()
+
+
+def compress_readable_output_as(src_file, encoding):
+    return zstd_compress_readable_output(src_file) if encoding == 'zstd' else compress_readable_output(src_file)
+
+
+class CompressedCache:  # {{{
+
+    ''' Compressed versions of responses that have ETags, so that the same
+    data is not compressed over and over again. Responses are compressed as
+    they are sent and stored once compression is complete. ETags only identify
+    a response for a particular resource, several resources can share an ETag,
+    so responses are keyed by the URI of the request as well. Only used from the
+    server's event loop thread. '''
+
+    max_size = 64 * 1024 * 1024
+    max_item_size = 16 * 1024 * 1024  # uncompressed size
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        ans = self.items.get(key)
+        if ans is not None:
+            self.items.move_to_end(key)
+        return ans
+
+    def set(self, key, data):
+        self.size += len(data) - len(self.items.pop(key, b''))
+        self.items[key] = data
+        while self.size > self.max_size and self.items:
+            self.size -= len(self.items.popitem(last=False)[1])
+
+    def compress(self, key, encoding, src_file):
+        parts = []
+        for data in compress_readable_output_as(src_file, encoding):
+            parts.append(data)
+            yield data
+        self.set(key, b''.join(parts))
+
+    def __call__(self, output, encoding, uri):
+        ''' Return the compressed version of output, which must be a
+        ReadableOutput, for the resource at uri '''
+        if output.etag and output.content_length <= self.max_item_size:
+            key = uri, output.etag, encoding
+            data = self.get(key)
+            if data is None:
+                return GeneratedOutput(self.compress(key, encoding, output.src_file), etag=output.etag)
+            ans = ReadableOutput(ReadOnlyFileBuffer(data), etag=output.etag, content_length=len(data))
+            ans.accept_ranges = False
+            return ans
+        return GeneratedOutput(compress_readable_output_as(output.src_file, encoding), etag=output.etag)
+# }}}
+
+
 def get_range_parts(ranges, content_type, content_length):  # {{{
 
     def part(r):
@@ -308,6 +408,7 @@ def __init__(self, output, etag=None, content_length=None):
         self.etag = etag
         self.accept_ranges = True
         self.use_sendfile = False
+        self.ranges = None
         self.src_file.seek(0)
 
 
@@ -371,6 +472,7 @@ def __init__(self, data):
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    compressed_cache = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -448,7 +550,7 @@ def prepare_response(self, inheaders, request_body_file):
             self.remote_addr, self.remote_port, self.is_trusted_ip,
             self.translator_cache, self.tdir, self.forwarded_for, self.request_original_uri
         )
-        self.queue_job(self.run_request_handler, data)
+        self.queue_job(self.run_request_handler, data, bulk=is_bulk_request(self.path, self.opts.url_prefix))
 
     def run_request_handler(self, data):
         result = self.request_handler(data)
@@ -673,9 +775,10 @@ def finalize_output(self, output, request, is_http1):
             output = GeneratedOutput(output)
         ct = outheaders.get('Content-Type', '').partition(';')[0]
         compressible = (not ct or ct.startswith(('text/', 'image/svg')) or ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == http.client.OK and
+        encoding = (compressible and request.status_code == http.client.OK and
                         (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')))
+        compressible = bool(encoding) and not is_http1
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http.client.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -685,7 +788,7 @@ def finalize_output(self, output, request, is_http1):
         if ranges is not None and not ranges:
             return self.send_range_not_satisfiable(output.content_length)
 
-        for header in ('Accept-Ranges', 'Content-Encoding', 'Transfer-Encoding', 'ETag', 'Content-Length'):
+        for header in ('Accept-Ranges', 'Content-Encoding', 'Transfer-Encoding', 'ETag', 'Content-Length', 'Vary'):
             outheaders.pop(header, all=True)
 
         matched = '*' in none_match or (output.etag and output.etag in none_match)
@@ -703,14 +806,18 @@ def finalize_output(self, output, request, is_http1):
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
         if compressible and not ranges:
-            outheaders.set('Content-Encoding', 'gzip', replace_all=True)
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
+            outheaders.set('Vary', 'Accept-Encoding', replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', f'{output.content_length}')
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
-        if output.content_length is not None and not compressible and not ranges:
+            if self.compressed_cache is None:
+                output = GeneratedOutput(compress_readable_output_as(output.src_file, encoding), etag=output.etag)
+            else:
+                output = self.compressed_cache(output, encoding, self.request_original_uri)
+        if output.content_length is not None and not ranges:
             outheaders.set('Content-Length', f'{output.content_length}', replace_all=True)
 
-        if compressible or output.content_length is None:
+        if output.content_length is None:
             outheaders.set('Transfer-Encoding', 'chunked', replace_all=True)
 
         if ranges:
@@ -733,6 +840,7 @@ def create_http_handler(handler=None, websocket_handler=None):
     from calibre.srv.web_socket import WebSocketConnection
     static_cache = {}
     translator_cache = {}
+    compressed_cache = CompressedCache()
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -744,6 +852,7 @@ def wrapper(*args, **kwargs):
         ans.request_handler = handler
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
+        ans.compressed_cache = compressed_cache
         ans.translator_cache = translator_cache
         return ans
     return wrapper
@@ -74,6 +74,13 @@ def get_recently_read(self, user):
                 })
             return ans
 
+    def get_recently_read_books(self, library_id, limit=5):
+        ' The (book_id, format) pairs most recently read by any user in the specified library '
+        with lock:
+            return [tuple(x) for x in self.execute(
+                'SELECT book,format FROM last_read_positions WHERE library_id=? GROUP BY book,format ORDER BY MAX(epoch) DESC LIMIT ?',
+                (library_id, limit))]
+
 
 path_cache = {}
 
@@ -49,7 +49,7 @@ def init_library(library_path, is_default_library):
     db = Cache(
         create_backend(
             library_path, load_user_formatter_functions=is_default_library))
-    db.init()
+    db.init(table_snapshot=True, compact_tables=True, composite_cache=True)
     return db
 
 
@@ -117,6 +117,8 @@ def __init__(self, libraries):
             self.library_name_map[library_id] = basename(corrected_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
+        # Called with the library id whenever a library is opened
+        self.library_loaded_callbacks = []
         self.category_caches, self.search_caches, self.tag_browser_caches = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
             defaultdict(OrderedDict))
@@ -136,8 +138,16 @@ def get(self, library_id=None):
             except Exception:
                 self.loaded_dbs[library_id] = None
                 raise
+            for callback in self.library_loaded_callbacks:
+                callback(library_id)
             return ans
 
+    def loaded_library(self, library_id=None):
+        ' Return the library if it is already open, without opening it '
+        with self:
+            db = self.loaded_dbs.get(library_id or self.default_library)
+        return getattr(db, 'new_api', db)
+
     def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
         return init_library(library_path, is_default_library)
@@ -5,11 +5,14 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import ipaddress
+import math
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
+from collections import deque
 from contextlib import suppress
 from functools import lru_cache, partial
 from io import BytesIO
@@ -42,6 +45,10 @@
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = b'\0', b'\x01'
 IPPROTO_IPV6 = getattr(socket, 'IPPROTO_IPV6', 41)
+EVENT_MASKS = {
+    READ: selectors.EVENT_READ, WRITE: selectors.EVENT_WRITE,
+    RDWR: selectors.EVENT_READ | selectors.EVENT_WRITE, WAIT: 0,
+}
 
 
 class ReadBuffer:  # {{{
@@ -132,6 +139,44 @@ def readline(self):
     # }}}
 
 
+class TimerWheel:  # {{{
+
+    '''
+    A hashed timer wheel, used to find connections that might have been
+    inactive for too long without having to look at every connection on every
+    tick. Items are returned after their deadline has passed, with a delay of at
+    most one resolution.
+    '''
+
+    def __init__(self, resolution=1.0, num_slots=256):
+        self.resolution = resolution
+        self.slots = [[] for i in range(num_slots)]
+        self.current = int(monotonic() / resolution)
+
+    def add(self, deadline, item):
+        tick = max(math.ceil(deadline / self.resolution), self.current + 1)
+        self.slots[tick % len(self.slots)].append((tick, item))
+
+    def expired(self, now):
+        target = int(now / self.resolution)
+        if target <= self.current:
+            return ()
+        ans, num = [], len(self.slots)
+        for tick in range(self.current + 1, self.current + 1 + min(target - self.current, num)):
+            idx = tick % num
+            slot = self.slots[idx]
+            if slot:
+                self.slots[idx] = [x for x in slot if x[0] > target]
+                ans.extend(x[1] for x in slot if x[0] <= target)
+        self.current = target
+        return ans
+
+    def clear(self):
+        for slot in self.slots:
+            del slot[:]
+# }}}
+
+
 class BadIPSpec(ValueError):
     pass
 
@@ -170,6 +215,10 @@ def is_local_address(addr: ipaddress.IPv4Address | ipaddress.IPv6Address | None)
 
 class Connection:  # {{{
 
+    _wait_for = None
+    # Set by the ServerLoop, called whenever wait_for changes
+    on_wait_for_changed = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -217,6 +266,19 @@ def end_send_optimization(self):
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        # Can be called from threads other than the server thread, for
+        # example, when sending web socket messages
+        if val is not self._wait_for:
+            self._wait_for = val
+            if self.on_wait_for_changed is not None:
+                self.on_wait_for_changed()
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -350,11 +412,16 @@ def close(self):
         except OSError:
             pass
 
-    def queue_job(self, func, *args):
+    @property
+    def client_id(self):
+        ' Used to share the worker threads fairly between clients '
+        return self.remote_addr
+
+    def queue_job(self, func, *args, bulk=False):
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, self.client_id, bulk)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -391,6 +458,7 @@ def parsed_trusted_ips(raw):
 class ServerLoop:
 
     LISTENING_MSG = 'calibre server listening on'
+    MAX_ACCEPTS_PER_TICK = 64
 
     def __init__(
         self,
@@ -418,6 +486,15 @@ def __init__(
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.selector = None
+        # The event masks of the connections registered with the selector
+        self.registered = {}
+        # Connections whose wait_for has changed since the last tick
+        self.changed_connections = deque()
+        # Connections that have data in their read buffers, these are
+        # readable without waiting for the selector
+        self.buffered = {}
+        self.timers = TimerWheel(resolution=max(0.01, min(1.0, self.opts.timeout / 10)))
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -524,9 +601,14 @@ def initialize_socket(self):
     def serve(self):
         from calibre.utils.network import format_addr_for_url
 
-        self.connection_map = {}
+        self.connection_map, self.registered, self.buffered = {}, {}, {}
+        self.changed_connections.clear()
+        self.timers.clear()
         if not self.socket_was_preactivated:
-            self.socket.listen(min(socket.SOMAXCONN, 128))
+            self.socket.listen(min(socket.SOMAXCONN, 1024))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+        self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
         self.bound_address = ba = self.socket.getsockname()
         ba_str = ''
         if isinstance(ba, tuple):
@@ -582,68 +664,47 @@ def bind(self, family, atype, proto=0):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in self.connection_map.items():
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
-                if conn.read_buffer.has_data:
-                    readable.append(s)
-                elif has_ssl:
-                    conn.drain_ssl_buffer()
-                    if conn.ready:
-                        (readable if conn.read_buffer.has_data else read_needed).append(s)
-                    else:
-                        close_needed.append((s, conn))
-                else:
-                    read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
+        self.update_connection_states()
+        for s, conn in self.timed_out_connections(now):
             self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
             self.close(s, conn)
 
-        for x, conn in close_needed:
-            self.close(s, conn)
-
-        if readable:
-            writable = []
+        if self.buffered:
+            readable, writable = list(self.buffered), []
         else:
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
+            if self.socket.fileno() == -1:
                 self.ready = False
                 self.log.error('Listening socket was unexpectedly terminated')
                 return
+            try:
+                events = self.selector.select(self.opts.timeout)
             except OSError as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
                 if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                     return
                 for s, conn in tuple(self.connection_map.items()):
                     try:
                         select.select([s], [], [], 0)
+                    except ValueError:
+                        pass  # larger than FD_SETSIZE
                     except OSError as e:
                         if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
                             self.close(s, conn)  # Bad socket, discard
                 return
+            readable, writable = [], []
+            for key, mask in events:
+                if mask & selectors.EVENT_READ:
+                    readable.append(key.fd)
+                if mask & selectors.EVENT_WRITE:
+                    writable.append(key.fd)
 
         if not self.ready:
             return
 
-        ignore = set()
+        ignore, handled = set(), {}
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
                 continue
+            handled[s] = conn
             try:
                 conn.handle_event(event)
                 if not conn.ready:
@@ -677,6 +738,71 @@ def tick(self):
                     else:
                         self.log.error(f'Error in SSL handshake, terminating connection: {as_unicode(e)}')
                         self.close(s, conn)
+        for s, conn in handled.items():
+            if self.connection_map.get(s) is conn:
+                self.update_buffered(s, conn)
+
+    def update_connection_states(self):
+        # Update the selector registrations of connections whose wait_for has
+        # changed
+        cc, cmap = self.changed_connections, self.connection_map
+        while cc:
+            s, conn = cc.popleft()
+            if cmap.get(s) is conn:
+                mask, old_mask = EVENT_MASKS[conn.wait_for], self.registered.get(s, 0)
+                if mask != old_mask:
+                    try:
+                        if not old_mask:
+                            self.selector.register(s, mask)
+                        elif mask:
+                            self.selector.modify(s, mask)
+                        else:
+                            self.selector.unregister(s)
+                    except (OSError, ValueError, KeyError):
+                        self.close(s, conn)  # Bad socket, discard
+                        continue
+                    if mask:
+                        self.registered[s] = mask
+                    else:
+                        del self.registered[s]
+                self.update_buffered(s, conn)
+
+    def update_buffered(self, s, conn):
+        wf = conn.wait_for
+        if wf is READ or wf is RDWR:
+            if not conn.read_buffer.has_data and self.ssl_context is not None:
+                # Data can be buffered inside the SSL object, where the
+                # selector cannot see it
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    self.close(s, conn)
+                    return
+            if conn.read_buffer.has_data:
+                self.buffered[s] = conn
+                return
+        self.buffered.pop(s, None)
+
+    def timed_out_connections(self, now):
+        timeout, ans = self.opts.timeout, []
+        for s, conn in self.timers.expired(now):
+            if self.connection_map.get(s) is not conn:
+                continue
+            deadline = conn.last_activity + timeout
+            if deadline > now:
+                self.timers.add(deadline, (s, conn))
+            elif conn.handle_timeout():
+                conn.last_activity = now
+                self.timers.add(now + timeout, (s, conn))
+            else:
+                ans.append((s, conn))
+        return ans
+
+    def add_connection(self, s, conn):
+        self.connection_map[s] = conn
+        cc = self.changed_connections
+        conn.on_wait_for_changed = partial(cc.append, (s, conn))
+        cc.append((s, conn))
+        self.timers.add(conn.last_activity + self.opts.timeout, (s, conn))
 
     def write_to_control(self, what):
         if iswindows:
@@ -703,6 +829,11 @@ def dispatch_job_results(self):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.buffered.pop(s, None)
+        conn.on_wait_for_changed = None
+        if self.registered.pop(s, None):
+            with suppress(Exception):
+                self.selector.unregister(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -710,12 +841,17 @@ def get_actions(self, readable, writable):
         control = self.control_out.fileno()
         for s in readable:
             if s == listener:
-                sock, addr = self.accept()
-                if sock is not None:
+                # Accept several pending connections at once, so that bursts
+                # of new connections do not have to wait in the backlog
+                for i in range(self.MAX_ACCEPTS_PER_TICK):
+                    sock, addr = self.accept()
+                    if sock is None:
+                        break
                     s = sock.fileno()
                     if s > -1:
-                        self.connection_map[s] = conn = self.handler(
+                        conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        self.add_connection(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -738,7 +874,9 @@ def get_actions(self, readable, writable):
                     self.log.error('Control connection failed to read after signalling ready')
                     raise Exception('Control connection failed to read, something bad happened')
             else:
-                yield s, self.connection_map[s], READ
+                conn = self.connection_map.get(s)
+                if conn is not None:
+                    yield s, conn, READ
         for s in writable:
             try:
                 conn = self.connection_map[s]
@@ -766,6 +904,9 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(self.connection_map.items()):
             self.close(s, conn)
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -98,6 +98,20 @@ def __new__(cls, *args):
     _('Advertise the OPDS feeds via the BonJour service, so that OPDS based'
     ' reading apps can detect and connect to the server automatically.'),
 
+    _('Generate thumbnails in the background'),
+    'prewarm_thumbnails', False,
+    _('Generate the thumbnails of book covers shown on the first page of books when'
+    ' browsing the library in the background, when the library is opened and whenever a cover is changed.'
+    ' This means users do not have to wait for thumbnails to be generated when they'
+    ' first browse the library, at the cost of some extra work for the server.'),
+
+    _('Number of books to prepare for reading in advance'),
+    'prerender_books', 0,
+    _('Books have to be converted into a special format before they can be read'
+    ' in the browser, which can take a while for large books. The server can do this'
+    ' in advance for the specified number of most recently added and most recently'
+    ' read books in each library, so that they open instantly. Set to zero to disable.'),
+
     _('Maximum number of books in OPDS feeds'),
     'max_opds_items', 30,
     _('The maximum number of books that the server will return in a single'
@@ -131,6 +145,18 @@ def __new__(cls, *args):
     _('The maximum size of log files, generated by the server. When the log becomes larger'
     ' than this size, it is automatically rotated. Set to zero to disable log rotation.'),
 
+    _('Maximum size of the file cache (MB)'),
+    'max_file_cache_size', 500,
+    _('The server keeps copies of covers, thumbnails and book files it sends to clients'
+    ' in a cache. When the cache becomes larger than this size, the least recently used'
+    ' files are removed from it. Set to zero for no limit.'),
+
+    _('Maximum size of the cache of books prepared for reading (MB)'),
+    'max_book_cache_size', 2000,
+    _('Books are converted into a special format for reading in the browser. The converted'
+    ' books are cached, when the cache becomes larger than this size, the least recently'
+    ' read books are removed from it. Set to zero for no limit.'),
+
     _('Log HTTP 404 (Not Found) requests'),
     'log_not_found', True,
     _('Normally, the server logs all HTTP requests for resources that are not found.'
@@ -165,6 +191,16 @@ def __new__(cls, *args):
       ' turning on this option means anyone connecting from the specified IP addresses'
       ' can make changes to your calibre libraries.'),
 
+    _('IP addresses of reverse proxies'),
+    'trusted_proxies', None,
+    _('When the server is behind a reverse proxy, all connections come from the'
+      ' proxy. The server then uses the X-Forwarded-For header set by the proxy to tell'
+      ' its clients apart and share its resources fairly between them. Since clients can set'
+      ' this header to anything, it is only used for connections from the local computer'
+      ' and from the IP addresses specified here. Must be a comma separated list of address'
+      ' or network specifications. Unlike the option above, this does not allow anyone'
+      ' to make changes.'),
+
     _('Path to user database'),
     'userdb', None,
     _('Path to a file in which to store the user and password information. Normally a'
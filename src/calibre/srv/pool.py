@@ -5,8 +5,9 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
+from collections import OrderedDict, deque
 from queue import Full, Queue
-from threading import Thread
+from threading import Condition, Thread
 
 from calibre.utils.monotonic import monotonic
 
@@ -27,7 +28,7 @@ def run(self):
             x = self.request_queue.get()
             if x is None:
                 break
-            job_id, func = x
+            client, (job_id, func) = x
             self.working = True
             try:
                 result = func()
@@ -37,6 +38,7 @@ def run(self):
                 self.result_queue.put((job_id, True, result))
             finally:
                 self.working = False
+                self.request_queue.task_done(client)
             try:
                 self.notify_server()
             except Exception:
@@ -46,28 +48,102 @@ def handle_error(self, job_id):
         self.result_queue.put((job_id, False, sys.exc_info()))
 
 
+class FairQueue:
+
+    '''
+    A queue of jobs that is shared fairly between clients. Every client has its
+    own queue of jobs, and the next job is taken from the client that has the
+    fewest jobs running, in round robin order, so that a client making many
+    requests at once cannot starve other clients. No single client can have
+    more than max_per_client jobs queued. Jobs are either interactive or bulk
+    (such as downloading files), up to interactive_weight interactive jobs are
+    run for every bulk job, when both kinds are waiting.
+    '''
+
+    def __init__(self, maxsize=1000, max_per_client=0, interactive_weight=4):
+        self.maxsize = maxsize
+        self.max_per_client = max_per_client or max(1, maxsize // 10)
+        self.interactive_weight = interactive_weight
+        self.not_empty = Condition()
+        self.queues = {False: OrderedDict(), True: OrderedDict()}
+        self.queued, self.running = {}, {}
+        self.size = self.interactive_run = 0
+        self.shutting_down = False
+
+    def qsize(self):
+        return self.size
+
+    def put_nowait(self, item, client=None, bulk=False):
+        with self.not_empty:
+            queued = self.queued.get(client, 0)
+            if self.size >= self.maxsize or queued >= self.max_per_client:
+                raise Full()
+            q = self.queues[bulk].get(client)
+            if q is None:
+                q = self.queues[bulk][client] = deque()
+            q.append(item)
+            self.queued[client] = queued + 1
+            self.size += 1
+            self.not_empty.notify()
+
+    def get(self):
+        ' Wait for the next job, returning (client, item) or None if the queue has been shutdown '
+        with self.not_empty:
+            while not self.size and not self.shutting_down:
+                self.not_empty.wait()
+            if self.shutting_down:
+                return None
+            queues = self.queues[self.next_job_is_bulk()]
+            # min() returns the first of equals, giving round robin order
+            client = min(queues, key=lambda c: self.running.get(c, 0))
+            q = queues.pop(client)
+            item = q.popleft()
+            if q:
+                queues[client] = q
+            self.queued[client] -= 1
+            if not self.queued[client]:
+                del self.queued[client]
+            self.size -= 1
+            self.running[client] = self.running.get(client, 0) + 1
+            return client, item
+
+    def next_job_is_bulk(self):
+        if self.queues[False] and (not self.queues[True] or self.interactive_run < self.interactive_weight):
+            self.interactive_run += 1
+            return False
+        self.interactive_run = 0
+        return True
+
+    def task_done(self, client):
+        with self.not_empty:
+            self.running[client] -= 1
+            if not self.running[client]:
+                del self.running[client]
+
+    def shutdown(self):
+        with self.not_empty:
+            self.shutting_down = True
+            self.not_empty.notify_all()
+
+
 class ThreadPool:
 
     def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
+        self.request_queue, self.result_queue = FairQueue(queue_size), Queue(queue_size)
         self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
 
     def start(self):
         for w in self.workers:
             w.start()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def put_nowait(self, job_id, func, client=None, bulk=False):
+        self.request_queue.put_nowait((job_id, func), client, bulk)
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
+        self.request_queue.shutdown()
         for w in self.workers:
             now = monotonic()
             if now >= wait_till:
@@ -7,8 +7,10 @@
 import sys
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import datetime
 from functools import partial
+from hashlib import sha256
 from itertools import count
 from urllib.parse import urlparse
 
@@ -28,7 +30,7 @@
 from calibre.utils.date import EPOCH
 from calibre.utils.forked_map import forked_map, forked_map_is_supported
 from calibre.utils.logging import default_log
-from calibre.utils.serialize import json_dumps, json_loads, msgpack_loads
+from calibre.utils.serialize import json_dumps, json_loads, msgpack_loads, pickle_dumps, pickle_loads
 from calibre.utils.short_uuid import uuid4
 from calibre_extensions.fast_css_transform import transform_properties
 from polyglot.binary import as_base64_unicode as encode_component
@@ -553,9 +555,108 @@ def process_book_file(virtualize_resources, link_uid, container, present_names,
     return link_to_map, html_data, virtualized_names, smil_map
 
 
+class ResourceCache:  # {{{
+
+    '''
+    A cache of the results of processing the individual files in books, keyed
+    by a hash of the contents of the file and everything else that affects the
+    result of processing it. This means that when a book is re-rendered after
+    a small change, such as its metadata being embedded, only the files that
+    actually changed need to be processed again. The processed files are
+    hardlinked between the cache and the rendered books, so they take no extra
+    space. Entries are released once no rendered book links to them any more.
+    '''
+
+    KEYS_FILE = 'calibre-resource-keys.json'
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.link_uid = self.read_link_uid()
+
+    def read_link_uid(self):
+        # The link uid is embedded in processed files, so it must be the same
+        # for all renders that share the cache
+        path = os.path.join(self.path, 'link_uid')
+        with suppress(FileNotFoundError), open(path) as f:
+            return f.read()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(uuid4())
+        os.replace(tmp, path)
+        with open(path) as f:
+            return f.read()
+
+    def key(self, context, virtualize_resources, name, mt, path):
+        h = sha256(json_dumps((RENDER_VERSION, self.link_uid, virtualize_resources, context, name, mt)))
+        with open(path, 'rb') as f:
+            while chunk := f.read(64 * 1024):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def get(self, key, dest):
+        ' Replace dest with a hardlink to the cached processed file for key, returning the cached result or None '
+        base = os.path.join(self.path, key)
+        try:
+            with open(base + '.result', 'rb') as f:
+                result = pickle_loads(f.read())
+            tmp = f'{dest}.{os.getpid()}.tmp'
+            os.link(base + '.data', tmp)
+            os.replace(tmp, dest)
+        except OSError:
+            return None
+        return result
+
+    def set(self, key, src, result):
+        base = os.path.join(self.path, key)
+        tmp = f'{base}.{os.getpid()}.tmp'
+        try:
+            # If the filesystem does not support hardlinks, we dont cache
+            os.link(src, tmp)
+            os.replace(tmp, base + '.data')
+            with open(tmp, 'wb') as f:
+                f.write(result)
+            os.replace(tmp, base + '.result')
+        except OSError:
+            with suppress(OSError):
+                os.remove(tmp)
+
+    def release(self, keys):
+        ' Remove the entries for keys that are no longer linked to from any rendered book '
+        for key in keys:
+            base = os.path.join(self.path, key)
+            with suppress(OSError):
+                if os.stat(base + '.data').st_nlink > 1:
+                    continue
+            for ext in ('.data', '.result'):
+                with suppress(OSError):
+                    os.remove(base + ext)
+
+    def release_unused(self):
+        ' Remove all entries not linked to from any rendered book '
+        keys = set()
+        for x in os.listdir(self.path):
+            key, ext = os.path.splitext(x)
+            if ext == '.tmp':
+                with suppress(OSError):
+                    os.remove(os.path.join(self.path, x))
+            elif ext in ('.data', '.result'):
+                keys.add(key)
+        self.release(keys)
+
+    @classmethod
+    def keys_for_rendered_book(cls, book_dir):
+        try:
+            with open(os.path.join(book_dir, cls.KEYS_FILE), 'rb') as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return []
+# }}}
+
+
 def process_exploded_book(
     book_fmt, opfpath, input_fmt, tdir, log=None, book_hash=None, save_bookmark_data=False,
-    book_metadata=None, virtualize_resources=True, max_workers=1
+    book_metadata=None, virtualize_resources=True, max_workers=1, resource_cache=None
 ):
     log = log or default_log
     container = SimpleContainer(tdir, opfpath, log)
@@ -610,7 +711,7 @@ def needs_work(mt):
         'toc':toc,
         'book_format': book_fmt,
         'spine':spine,
-        'link_uid': uuid4(),
+        'link_uid': uuid4() if resource_cache is None else resource_cache.link_uid,
         'book_hash': book_hash,
         'is_comic': is_comic,
         'raster_cover_name': raster_cover_name,
@@ -627,8 +728,24 @@ def needs_work(mt):
     }
 
     names_that_need_work = tuple(n for n, mt in container.mime_map.items() if needs_work(mt))
-    num_workers = calculate_number_of_workers(names_that_need_work, container, max_workers)
     results = []
+    cache_misses = {}
+    if resource_cache is not None:
+        # Ensure the files on disk are up to date before hashing them
+        container.commit(keep_parsed=True)
+        # How links are processed depends on which files are present in the book
+        context = sha256(json_dumps(sorted((n, container.mime_map[n]) for n in present_names))).hexdigest()
+        resource_keys = {}
+        for name in names_that_need_work:
+            path = container.name_path_map[name]
+            resource_keys[name] = key = resource_cache.key(context, virtualize_resources, name, container.mime_map[name], path)
+            result = resource_cache.get(key, path)
+            if result is None:
+                cache_misses[name] = key
+            else:
+                results.append(result)
+        names_that_need_work = tuple(cache_misses)
+    num_workers = calculate_number_of_workers(names_that_need_work, container, max_workers)
     f = partial(process_book_file, virtualize_resources, book_render_data['link_uid'], container, present_names)
     if num_workers < 2:
         results.extend(map(f, names_that_need_work))
@@ -637,6 +754,8 @@ def needs_work(mt):
     else:
         with ThreadPoolExecutor(max_workers=num_workers) as executor:
             results.extend(executor.map(f, names_that_need_work))
+    # Serialize the results now as merging them below modifies them
+    to_cache = {name: pickle_dumps(result) for name, result in zip(cache_misses, results[len(results) - len(cache_misses):])}
 
     ltm = book_render_data['link_to_map']
     html_data = {}
@@ -696,6 +815,9 @@ def manifest_data(name):
 
     book_render_data['files'] = {name:manifest_data(name) for name in set(container.name_path_map) - excluded_names}
     container.commit()
+    if resource_cache is not None:
+        for name, result in to_cache.items():
+            resource_cache.set(cache_misses[name], container.name_path_map[name], result)
 
     for name in excluded_names:
         os.remove(container.name_path_map[name])
@@ -709,6 +831,10 @@ def manifest_data(name):
     with open(os.path.join(container.root, 'calibre-book-manifest.json'), 'wb') as f:
         f.write(data)
 
+    if resource_cache is not None:
+        with open(os.path.join(container.root, resource_cache.KEYS_FILE), 'wb') as f:
+            f.write(json_dumps(sorted(set(resource_keys.values()))))
+
     return container, bookmark_data
 
 
@@ -785,7 +911,10 @@ def get_stored_annotations(container, bookmark_data):
                 yield {'type': 'last-read', 'pos': epubcfi, 'pos_type': 'epubcfi', 'timestamp': EPOCH}
 
 
-def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0):
+def render(
+    pathtoebook, output_dir, book_hash=None, serialize_metadata=False, extract_annotations=False, virtualize_resources=True, max_workers=0,
+    resource_cache_dir=None
+):
     pathtoebook = os.path.abspath(pathtoebook)
     mi = None
     if serialize_metadata:
@@ -797,7 +926,8 @@ def render(pathtoebook, output_dir, book_hash=None, serialize_metadata=False, ex
     container, bookmark_data = process_exploded_book(
         book_fmt, opfpath, input_fmt, output_dir, max_workers=max_workers,
         book_hash=book_hash, save_bookmark_data=extract_annotations,
-        book_metadata=mi, virtualize_resources=virtualize_resources
+        book_metadata=mi, virtualize_resources=virtualize_resources,
+        resource_cache=None if resource_cache_dir is None else ResourceCache(resource_cache_dir)
     )
     if serialize_metadata:
         from calibre.ebooks.metadata.book.serialize import metadata_as_dict
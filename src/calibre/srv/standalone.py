@@ -11,12 +11,14 @@
 from calibre.constants import is_running_from_develop, ismacos, iswindows
 from calibre.db.legacy import LibraryDatabase
 from calibre.srv.bonjour import BonJour
+from calibre.srv.books import BookPrerenderer
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
 from calibre.srv.library_broker import load_gui_libraries
 from calibre.srv.loop import BadIPSpec, ServerLoop
 from calibre.srv.manage_users_cli import manage_users_cli
 from calibre.srv.opts import opts_to_parser
+from calibre.srv.thumbnails import ThumbnailPrewarmer
 from calibre.srv.users import connect
 from calibre.srv.utils import HandleInterrupt, RotatingLog
 from calibre.utils.config import prefs
@@ -73,6 +75,10 @@ def __init__(self, libraries, opts):
         plugins = []
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
+        if opts.prewarm_thumbnails:
+            plugins.append(ThumbnailPrewarmer(self.handler.router.ctx))
+        if opts.prerender_books > 0:
+            plugins.append(BookPrerenderer(self.handler.router.ctx, opts.prerender_books))
         self.loop = ServerLoop(
             create_http_handler(self.handler.dispatch),
             opts=opts,
@@ -87,6 +87,35 @@ def test_ajax_categories(self):  # {{{
             self.ae(r.status, 400)
     # }}}
 
+    def test_tag_browser_cache(self):  # {{{
+        'Test caching of the Tag browser'
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            db = ctx.library_broker.get(None)
+            conn = server.connect()
+
+            def request(etag=None):
+                r, data = make_request(conn, '/interface-data/tag-browser', prefix='', headers={'If-None-Match': etag} if etag else {})
+                return r.status, r.getheader('ETag'), json.dumps(data)
+
+            status, etag, data = request()
+            self.ae(status, OK)
+            self.assertNotIn('Tag Three', data)
+            self.ae(len(ctx.library_broker.tag_browser_caches[db.server_library_id]), 1)
+            self.ae(request(etag)[0], 304)
+            # Reading positions do not change the Tag browser
+            db.set_last_read_position(1, 'EPUB', cfi='epubcfi(/2/4)', pos_frac=0.5)
+            self.ae(request(etag)[0], 304)
+            db.set_field('tags', {1: 'Tag Three'})
+            status, etag2, data = request(etag)
+            self.ae(status, OK)
+            self.assertNotEqual(etag, etag2)
+            self.assertIn('Tag Three', data)
+            self.ae(request(etag2)[0], 304)
+            db.set_pref('virtual_libraries', {'1':'title:"=Title One"'})
+            self.ae(request(etag2)[0], OK)
+    # }}}
+
     def test_srv_restrictions(self):  # {{{
         ' Test that virtual lib. + search restriction works on all end points'
         with self.create_server(auth=True, auth_mode='basic') as server:
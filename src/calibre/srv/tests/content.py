@@ -9,11 +9,13 @@
 import os
 import time
 from compression import zlib
+from datetime import timedelta
 from io import BytesIO
 
 from calibre.ebooks.metadata.epub import get_metadata
 from calibre.ebooks.metadata.opf2 import OPF
 from calibre.srv.tests.base import LibraryBaseTest
+from calibre.utils.date import now
 from calibre.utils.imghdr import identify
 from calibre.utils.resources import get_image_path as I
 from calibre.utils.resources import get_path as P
@@ -75,6 +77,86 @@ def test(src, url, sz=None):
             test('images/lt.png', '/icon/lt.png?sz=16', sz=16)
     # }}}
 
+    def test_file_locks(self):  # {{{
+        'Test that different cached files are generated in parallel'
+        from threading import Barrier, Thread
+
+        from calibre.srv.content import FileLocks
+        locks = FileLocks()
+        barrier = Barrier(3, timeout=5)
+        generated = []
+
+        def generate(key):
+            with locks(key):
+                if key not in generated:
+                    generated.append(key)
+                    if key != 'same':
+                        # Fails unless all the different keys are being
+                        # generated at the same time
+                        barrier.wait()
+                    else:
+                        time.sleep(0.05)
+
+        threads = [Thread(target=generate, args=(k,)) for k in ('a', 'b', 'c', 'same', 'same', 'same')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(barrier.broken)
+        self.ae(sorted(generated), ['a', 'b', 'c', 'same'])
+        self.assertFalse(locks.locks)
+    # }}}
+
+    def test_file_cache(self):  # {{{
+        'Test size limited eviction of cached files'
+        from calibre.srv.file_cache import FileCache
+        removed = []
+        cache = FileCache(removed.append, max_size=100)
+        cache.miss(), cache.add('a', 40), cache.miss(), cache.add('b', 40)
+        self.ae(cache.stats()['size'], 80)
+        cache.hit('a')
+        self.ae(cache.add('c', 40), ['b'])
+        self.ae(removed, ['b'])
+        self.ae(cache.add('d', 40, in_use=lambda k: k == 'a'), ['c'])
+        self.ae(cache.add('d', 200), ['a'])
+        self.ae(list(cache.entries), ['d'])
+        cache.discard('d')
+        self.ae(cache.stats(), {'entries': 0, 'size': 0, 'max_size': 100, 'hits': 1, 'misses': 2, 'evictions': 3})
+        cache.max_size = 0
+        self.assertFalse(cache.add('e', 1000))
+    # }}}
+
+    def test_resource_cache(self):  # {{{
+        'Test re-use of processed book files when re-rendering'
+        from calibre.srv.render_book import ResourceCache
+        from calibre.utils.serialize import pickle_dumps
+        cdir, bdir = os.path.join(self.library_path, 'rc'), os.path.join(self.library_path, 'rb')
+        os.mkdir(bdir)
+        cache = ResourceCache(cdir)
+        self.ae(ResourceCache(cdir).link_uid, cache.link_uid)
+        src = os.path.join(bdir, 'a.html')
+        with open(src, 'wb') as f:
+            f.write(b'input')
+        key = cache.key('ctx', True, 'a.html', 'text/html', src)
+        self.assertNotEqual(key, cache.key('ctx', False, 'a.html', 'text/html', src))
+        self.assertIsNone(cache.get(key, src))
+        with open(src, 'wb') as f:
+            f.write(b'output')
+        cache.set(key, src, pickle_dumps({'a.html': 1}))
+        dest = os.path.join(bdir, 'b.html')
+        with open(dest, 'wb') as f:
+            f.write(b'input')
+        self.ae(cache.get(key, dest), {'a.html': 1})
+        with open(dest, 'rb') as f:
+            self.ae(f.read(), b'output')
+        cache.release([key])
+        os.remove(src), os.remove(dest)
+        self.assertIsNotNone(cache.get(key, src))
+        os.remove(src)
+        cache.release_unused()
+        self.assertIsNone(cache.get(key, src))
+    # }}}
+
     def test_get(self):  # {{{
         'Test /get'
         with self.create_server() as server:
@@ -230,6 +312,72 @@ def change_cover(count, book_id=2):
 
     # }}}
 
+    def test_thumbnail_prewarm(self):  # {{{
+        'Test generation of thumbnails in the background'
+        from calibre.srv.thumbnails import ThumbnailPrewarmer
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            broker = ctx.library_broker
+            # Libraries are not opened by the prewarmer, they are queued when
+            # clients open them
+            p = ThumbnailPrewarmer(ctx, sizes=((30, 40),))
+            p.prewarm(broker.default_library, None)
+            self.assertNotIn(broker.default_library, broker.loaded_dbs)
+            broker.library_loaded_callbacks.append(p.library_loaded)
+            db = broker.get(None)
+            broker.library_loaded_callbacks.remove(p.library_loaded)
+            self.ae(p.queue.get_nowait(), (db.server_library_id, None))
+            conn = server.connect()
+
+            def get_thumb(book_id):
+                conn.request('GET', f'/get/thumb/{book_id}?sz=30x40')
+                r = conn.getresponse()
+                data = r.read()
+                self.ae(r.status, http.client.OK)
+                return r.getheader('Used-Cache'), data
+
+            p.tdir, p.log = server.loop.tdir, server.loop.log
+            try:
+                p.prewarm(db.server_library_id, None)
+                self.ae(p.generated, 2)
+                used_cache, data = get_thumb(1)
+                self.ae(used_cache, 'yes')
+                self.ae(identify(data)[0], 'jpeg')
+                # Thumbnails that already exist are not re-generated
+                p.prewarm(db.server_library_id, None)
+                self.ae(p.generated, 2)
+                # Changing a cover queues the book for thumbnail generation
+                db.set_cover({1: I('lt.png', data=True)})
+                t = time.time() + 10
+                os.utime(db.format_abspath(1, '__COVER_INTERNAL__'), (t, t))
+                x = p.queue.get_nowait()
+                self.ae(x, (db.server_library_id, (1,)))
+                p.prewarm(*x)
+                self.ae(p.generated, 3)
+                self.ae(get_thumb(1)[0], 'yes')
+            finally:
+                if p.pool is not None:
+                    p.pool.shutdown()
+            # Only the first page of books is prewarmed and changed covers
+            # are only re-generated for that page or if already cached
+            p = ThumbnailPrewarmer(ctx, sizes=((20, 30),), num_books=1)
+            p.tdir, p.log = server.loop.tdir, server.loop.log
+            try:
+                newest, older = 2, 1
+                db.set_field('timestamp', {newest: now(), older: now() - timedelta(days=1), 3: now() - timedelta(days=2)})
+                p.prewarm(db.server_library_id, None)
+                self.ae(p.generated, 1)
+                p.prewarm(db.server_library_id, (older,))
+                self.ae(p.generated, 1)
+                t = time.time() + 20
+                os.utime(db.format_abspath(newest, '__COVER_INTERNAL__'), (t, t))
+                p.prewarm(db.server_library_id, (newest,))
+                self.ae(p.generated, 2)
+            finally:
+                if p.pool is not None:
+                    p.pool.shutdown()
+    # }}}
+
     def test_html_as_json(self):  # {{{
         from calibre.ebooks.oeb.parse_utils import html5_parse
         from calibre.srv.render_book import html_as_json
@@ -269,4 +417,7 @@ def test_last_read_cache(self):  # {{{
         for book_id in range(2, 7):
             lrc.add_last_read_position('lib', book_id, 'FMT', 'user', 'epubcfi(/)', 0.1, 'tt')
         self.ae(len(lrc.get_recently_read('user')), lrc.limit)
+        lrc.add_last_read_position('lib', 2, 'FMT', 'other', 'epubcfi(/)', 0.1, 'tt')
+        lrc.add_last_read_position('other', 7, 'FMT', 'user', 'epubcfi(/)', 0.1, 'tt')
+        self.ae(lrc.get_recently_read_books('lib', 3), [(2, 'FMT'), (6, 'FMT'), (5, 'FMT')])
     # }}}
@@ -70,6 +70,9 @@ def test(name, val, ans, allowed={'gzip'}):
         test('Case insensitive', 'GZIp', 'gzip')
         test('Multiple', 'gzip, identity', 'gzip')
         test('Priority', '1;q=0.5, 2;q=0.75, 3;q=1.0', '3', {'1', '2', '3'})
+        test('Not acceptable', 'gzip;q=0', None)
+        test('Server preference', 'gzip, deflate, br, zstd', 'zstd', ('zstd', 'gzip'))
+        test('Client preference', 'gzip, zstd;q=0.5', 'gzip', ('zstd', 'gzip'))
     # }}}
 
     def test_accept_language(self):  # {{{
@@ -234,6 +237,18 @@ def handler(data):
             self.ae(r.status, http.client.OK)
             self.ae(r.read(), b'testbody')
 
+            # Test pipelined requests are responded to in order
+            conn = server.connect(timeout=base_timeout * 5)
+            conn.connect()
+            conn.sock.sendall(b'GET /one HTTP/1.1\r\n\r\nPOST /two HTTP/1.1\r\nContent-Length: 4\r\n\r\nbodyGET /three HTTP/1.1\r\n\r\n')
+            raw = data = b''
+            while not raw.endswith(b'three'):
+                data = eintr_retry_call(conn.sock.recv, 4096)
+                if not data:
+                    break
+                raw += data
+            self.ae([x.rpartition(b'\r\n\r\n')[2] for x in raw.split(b'HTTP/1.1 200 OK')[1:]], [b'one', b'twobody', b'three'])
+
             # Test POST with chunked transfer encoding
             conn.request('POST', '/test', headers={'Transfer-Encoding': 'chunked'})
             conn.send(b'4\r\nbody\r\na\r\n1234567890\r\n0\r\n\r\n')
@@ -334,6 +349,48 @@ def handler(conn):
             self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
             self.ae(r.status, http.client.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
 
+            # Test caching of compressed responses with ETags
+            num_calls = [0]
+
+            def cfunc():
+                num_calls[0] += 1
+                return raw
+            server.change_handler(lambda conn: conn.etagged_dynamic_response('compressed', cfunc))
+            conn = server.connect()
+            for i in range(2):
+                conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, http.client.OK), self.ae(r.getheader('Content-Encoding'), 'gzip')
+                self.ae(r.getheader('Vary'), 'Accept-Encoding')
+                if i:
+                    self.assertIsNone(r.getheader('Transfer-Encoding'))
+                    self.assertIsNotNone(r.getheader('Content-Length'))
+                self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
+            self.ae(num_calls[0], 2)
+            from calibre.srv.http_response import ZstdCompressor
+            if ZstdCompressor is not None:
+                from compression.zstd import decompress
+                for i in range(2):
+                    conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip, deflate, br, zstd'})
+                    r = conn.getresponse()
+                    self.ae(r.status, http.client.OK), self.ae(r.getheader('Content-Encoding'), 'zstd')
+                    self.ae(decompress(r.read()), raw)
+
+            # Different resources with the same ETag are cached separately
+            with NamedTemporaryFile(suffix='.js') as a, NamedTemporaryFile(suffix='.js') as b:
+                files = {'a': (a, b'a' * 5000), 'b': (b, b'b' * 5000)}
+                for tf, data in files.values():
+                    tf.write(data), tf.flush()
+                server.change_handler(lambda conn: conn.filesystem_file_with_constant_etag(
+                    open(files[conn.path[0]][0].name, 'rb'), 'constant'))
+                conn = server.connect()
+                for i in range(2):
+                    for name, (tf, data) in files.items():
+                        conn.request('GET', '/' + name, headers={'Accept-Encoding':'gzip'})
+                        r = conn.getresponse()
+                        self.ae(r.status, http.client.OK), self.ae(r.getheader('ETag'), '"constant"')
+                        self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), data)
+
             # Test dynamic etagged content
             num_calls = [0]
 
@@ -11,9 +11,11 @@
 import time
 from collections import namedtuple
 from glob import glob
+from queue import Full
 from threading import Event
 from unittest import skipIf
 
+from calibre.constants import iswindows
 from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.pre_activated import has_preactivated_support
 from calibre.srv.tests.base import BaseTest, TestServer
@@ -101,6 +103,46 @@ def test_workers(self):
             w.join()
         self.ae(0, sum(int(w.is_alive()) for w in server.loop.pool.workers))
 
+    def test_fair_queue(self):
+        ' Test sharing of worker threads between clients '
+        from calibre.srv.pool import FairQueue
+        q = FairQueue(maxsize=10, max_per_client=4, interactive_weight=2)
+        for i in range(4):
+            q.put_nowait(f'a{i}', 'a', bulk=True)
+        with self.assertRaises(Full):
+            q.put_nowait('a4', 'a')
+        q.put_nowait('b0', 'b', bulk=True), q.put_nowait('b1', 'b', bulk=True)
+        self.ae(q.get(), ('a', 'a0'))
+        self.ae(q.get(), ('b', 'b0'))
+        q.task_done('b')
+        # b has fewer running jobs than a
+        self.ae(q.get(), ('b', 'b1'))
+        for i in range(3):
+            q.put_nowait(f'c{i}', 'c')
+        self.ae([q.get()[1] for i in range(5)], ['c0', 'c1', 'a1', 'c2', 'a2'])
+        self.ae(q.qsize(), 1)
+        q.shutdown()
+        self.assertIsNone(q.get())
+
+        # X-Forwarded-For is only used to identify clients behind a trusted
+        # proxy, which does not need to be allowed to make changes
+        import ipaddress
+        from types import SimpleNamespace
+
+        from calibre.srv.http_request import HTTPRequest
+        r = HTTPRequest.__new__(HTTPRequest)
+        r.forwarded_for, r.is_trusted_ip = '10.0.0.1, 10.0.0.2', True
+        r.opts = SimpleNamespace(trusted_proxies=None)
+        for trusted_proxies, addr, client_id in (
+            (None, '192.168.1.1', '192.168.1.1'), (None, '127.0.0.1', '10.0.0.2'), ('192.168.2.0/24', '192.168.1.1', '192.168.1.1'),
+            ('192.168.1.0/24', '192.168.1.1', '10.0.0.2'), ('192.168.1.1, 192.168.3.3', '192.168.1.1', '10.0.0.2'),
+        ):
+            r.opts.trusted_proxies = trusted_proxies
+            r.remote_addr, r.parsed_remote_addr = addr, ipaddress.ip_address(addr)
+            self.ae(r.client_id, client_id)
+        r.forwarded_for = None
+        self.ae(r.client_id, '192.168.1.1')
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         with TestServer(lambda data:(data.path[0] + data.read()), listen_on='1.1.1.1', fallback_to_detected_interface=True) as server:
@@ -244,6 +286,60 @@ def test_monotonic(self):
         self.assertGreaterEqual(b - a, 0.09)
         self.assertLessEqual(b - a, 0.4)
 
+    def test_timer_wheel(self):
+        'Test the timer wheel used for inactivity timeouts'
+        from calibre.srv.loop import TimerWheel
+        w = TimerWheel(resolution=1, num_slots=8)
+        now = w.current
+        for i in range(1, 30):
+            w.add(now + i + 0.5, i)
+        w.add(now - 5, 0)
+        self.ae(w.expired(now), ())
+        self.ae(sorted(w.expired(now + 1)), [0])
+        self.ae(sorted(w.expired(now + 3.9)), [1, 2])
+        self.ae(sorted(w.expired(now + 20)), list(range(3, 20)))
+        self.ae(sorted(w.expired(now + 100)), list(range(20, 30)))
+
+    def test_many_connections(self):
+        'Test that many idle connections do not slow down the server'
+        n = 1000
+        if not iswindows:
+            import resource
+            soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            # Both ends of every connection are in this process
+            n = min(n, (soft - 100) // 2)
+
+        def request(server):
+            conn = server.connect()
+            conn.request('GET', '/')
+            res = conn.getresponse()
+            self.ae(res.read(), b'ok')
+            conn.close()
+
+        with TestServer(lambda data: 'ok', timeout=3) as server:
+            request(server)
+            st = monotonic()
+            request(server)
+            base_time = monotonic() - st
+            idle = [socket.create_connection(server.address) for i in range(n)]
+            try:
+                st = monotonic()
+                while server.loop.num_active_connections < n and monotonic() - st < 2:
+                    time.sleep(0.01)
+                self.ae(server.loop.num_active_connections, n)
+                st = monotonic()
+                for i in range(10):
+                    request(server)
+                self.assertLess((monotonic() - st) / 10, max(0.1, 10 * base_time))
+                # The idle connections must be closed because of inactivity
+                st = monotonic()
+                while server.loop.num_active_connections and monotonic() - st < 10:
+                    time.sleep(0.05)
+                self.ae(server.loop.num_active_connections, 0)
+            finally:
+                for s in idle:
+                    s.close()
+
     def test_jobs_manager(self):
         'Test the jobs manager'
         from calibre.srv.jobs import JobsManager
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from queue import Empty, Queue
+from threading import Event
+
+# The sizes of the thumbnails requested by the book list in the browser, for
+# the cover grid and the details list, on normal and high DPI screens.
+THUMBNAIL_SIZES = ((300, 400), (600, 800), (105, 140), (210, 280))
+
+
+def scale_cover(data, sizes, compression_quality):
+    ' Runs in a worker process '
+    from calibre.utils.img import scale_image
+    return [scale_image(data, width=width, height=height, compression_quality=compression_quality)[-1] for width, height in sizes]
+
+
+class CoverChanges:
+
+    def __init__(self, library_id, queue):
+        self.library_id, self.queue = library_id, queue
+
+    def invalidate(self, book_ids):
+        self.queue.put((self.library_id, tuple(book_ids)))
+
+
+class ThumbnailPrewarmer:  # {{{
+
+    '''
+    A server plugin that generates the thumbnails shown when browsing the
+    library in the background, using a pool of worker processes. When a
+    library is opened, thumbnails are generated for the books on the first
+    page of the book list in its default sort order, newest first. When covers
+    are changed, the thumbnails of books on that page and any thumbnails
+    already in the cache are re-generated. Thumbnails are written into the
+    same cache that is used when serving thumbnails and thumbnails that are
+    already present in the cache are skipped. So as not to evict files that
+    clients are using, no new thumbnails are generated once the cache is more
+    than half full. To avoid starving the server of resources only a few
+    covers are processed at a time, with a pause between batches.
+    '''
+
+    def __init__(self, ctx, sizes=THUMBNAIL_SIZES, num_books=None, max_workers=2, batch_size=8, delay=0.1):
+        self.ctx = ctx
+        self.sizes = sizes
+        self.num_books = ctx.opts.num_per_page if num_books is None else num_books
+        self.max_workers, self.batch_size, self.delay = max_workers, batch_size, delay
+        self.queue = Queue()
+        self.shutdown = Event()
+        self.cover_changes = {}
+        self.pool = None
+        self.generated = 0
+
+    def stop(self):
+        self.shutdown.set()
+        self.queue.put(None)
+
+    def library_loaded(self, library_id):
+        self.queue.put((library_id, None))
+
+    def start(self, loop):
+        self.tdir, self.log = loop.tdir, loop.log
+        broker = self.ctx.library_broker
+        # Only libraries that clients have opened are processed, so as not to
+        # load and keep open every library
+        with broker:
+            broker.library_loaded_callbacks.append(self.library_loaded)
+            for library_id, db in broker.loaded_dbs.items():
+                if db is not None:
+                    self.queue.put((library_id, None))
+        try:
+            while not self.shutdown.is_set():
+                x = self.queue.get()
+                if x is None:
+                    break
+                try:
+                    self.prewarm(*x)
+                except Exception:
+                    self.log.exception('Failed to generate thumbnails for library:', x[0])
+        finally:
+            with broker:
+                broker.library_loaded_callbacks.remove(self.library_loaded)
+            for library_id, cc in self.cover_changes.items():
+                db = broker.loaded_library(library_id)
+                if db is not None:
+                    db.remove_cover_cache(cc)
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def prewarm(self, library_id, book_ids):
+        db = self.ctx.library_broker.loaded_library(library_id)
+        if db is None:
+            return
+        if library_id not in self.cover_changes:
+            self.cover_changes[library_id] = cc = CoverChanges(library_id, self.queue)
+            db.add_cover_cache(cc)
+        # Newest books first, as that is the default sort order for the book list
+        first_page = db.multisort([('timestamp', False)])[:self.num_books]
+        if book_ids is None:
+            book_ids = first_page
+        first_page = frozenset(first_page)
+        for i in range(0, len(book_ids), self.batch_size):
+            if self.shutdown.is_set():
+                break
+            if self.process_batch(db, book_ids[i:i+self.batch_size], first_page) and self.shutdown.wait(self.delay):
+                break
+
+    def cache_is_full(self):
+        from calibre.srv.content import file_cache
+        cache = file_cache(self.ctx, self.tdir)
+        return cache.max_size > 0 and cache.total_size * 2 > cache.max_size
+
+    def process_batch(self, db, book_ids, first_page):
+        from calibre.srv.content import cached_file_mtime, cached_file_path, copy_to_file_cache, thumbnail_quality
+        from calibre.utils.date import timestampfromdt
+        from calibre.utils.ipc.pool import Failure, Pool
+        library_id = db.server_library_id
+        cache_is_full = self.cache_is_full()
+        jobs = {}
+        for book_id in book_ids:
+            mtime = db.cover_last_modified(book_id)
+            if mtime is None:
+                continue
+            mtime = timestampfromdt(mtime)
+            needed = []
+            for width, height in self.sizes:
+                fname = cached_file_path(self.tdir, f'cover-{width}x{height}', library_id, book_id, 'jpg')
+                previous_mtime = cached_file_mtime(fname)
+                if previous_mtime is None:
+                    if book_id in first_page and not cache_is_full:
+                        needed.append((width, height, fname))
+                elif previous_mtime < mtime:
+                    needed.append((width, height, fname))
+            if not needed:
+                continue
+            data = db.cover(book_id)
+            if not data:
+                continue
+            if self.pool is None:
+                self.pool = Pool(max_workers=self.max_workers, name='ThumbnailPool')
+            try:
+                self.pool(book_id, 'calibre.srv.thumbnails', 'scale_cover', data, [x[:2] for x in needed], thumbnail_quality())
+            except Failure as err:
+                # The pool died after the results of the previous batch were
+                # collected, start a new one for the next batch
+                self.log.error('Thumbnail generation failed:', err.failure_message)
+                self.pool.shutdown()
+                self.pool = None
+                return True
+            jobs[book_id] = mtime, needed
+        submitted = bool(jobs)
+        while jobs and not self.shutdown.is_set():
+            if self.pool.failed:
+                self.log.error('Thumbnail generation failed:', self.pool.terminal_failure.message)
+                self.pool.shutdown()
+                self.pool = None
+                break
+            try:
+                wr = self.pool.results.get(timeout=0.1)
+            except Empty:
+                continue
+            mtime, needed = jobs.pop(wr.id)
+            if wr.is_terminal_failure or wr.result.err:
+                self.log.error(f'Failed to generate thumbnails for book: {wr.id} with error: {wr.result.err}')
+                continue
+            for (width, height, fname), thumbnail in zip(needed, wr.result.value):
+                f = copy_to_file_cache(self.ctx, self.tdir, fname, mtime, lambda dest: dest.write(thumbnail))[0]
+                f.close()
+                self.generated += 1
+        return submitted
+# }}}
@@ -214,8 +214,8 @@ def parse_http_dict(header_val):
     return ans
 
 
-def sort_q_values(header_val):
-    'Get sorted items from an HTTP header of type: a;q=0.5, b;q=0.7...'
+def q_values(header_val):
+    'Get (item, q-value) pairs sorted by q-value from an HTTP header of type: a;q=0.5, b;q=0.7...'
     if not header_val:
         return []
 
@@ -229,7 +229,12 @@ def item(x):
             except Exception:
                 pass
         return e.strip(), q
-    return tuple(map(itemgetter(0), sorted(map(item, parse_http_list(header_val)), key=itemgetter(1), reverse=True)))
+    return sorted(map(item, parse_http_list(header_val)), key=itemgetter(1), reverse=True)
+
+
+def sort_q_values(header_val):
+    'Get sorted items from an HTTP header of type: a;q=0.5, b;q=0.7...'
+    return tuple(map(itemgetter(0), q_values(header_val)))
 
 
 def eintr_retry_call(func, *args, **kwargs):
@@ -374,6 +374,21 @@ def __init__(self, line_number, string):
         self.string = string
 
 
+class Program(list):
+    '''
+    The tree created by _Parser for a template program: the list of nodes of
+    its top level expression list. Also caches the compiled form of the
+    program, see _Compiler.
+    '''
+
+    __slots__ = ('compiled', 'evaluated')
+
+    def __init__(self, nodes=()):
+        super().__init__(nodes)
+        self.compiled = None
+        self.evaluated = False
+
+
 class _Parser:
     LEX_OP = 1
     LEX_ID = 2
@@ -498,7 +513,7 @@ def program(self, parent, funcs, prog, local_functions=None):
         self.local_functions = local_functions if local_functions is not None else set()
         if prog[1] != '':
             self.error(_("Failed to scan program. Invalid input '{0}'").format(prog[1]))
-        tree = self.expression_list()
+        tree = Program(self.expression_list())
         if not self.token_is_eof():
             self.error(_("Expected end of program, found '{0}'").format(self.token_text()))
         return tree
@@ -1042,7 +1057,13 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None,
             if is_call:
                 # prog is an instance of the function definition class
                 ret = self.do_node_stored_template_call(StoredTemplateCallNode(1, prog.name, prog, None), args=args)
+            elif self.break_reporter is None and prog.evaluated:
+                # Compile programs that are evaluated more than once, such as
+                # the cached templates of columns. The break reporter needs
+                # the interpreter.
+                ret = compiled_program(prog, funcs)(self)
             else:
+                prog.evaluated = True
                 ret = self.expression_list(prog)
         except ReturnExecuted as e:
             ret = e.get_value()
@@ -1107,10 +1128,10 @@ def do_node_for(self, prog):
             v = prog.variable
             f = self.expr(prog.list_field_expr)
             res = getattr(self.parent_book, f, f)
+            ret = ''
             if res is not None:
                 if isinstance(res, str):
                     res = [r.strip() for r in res.split(separator) if r.strip()]
-                ret = ''
                 if self.break_reporter:
                     self.break_reporter("'for' list value", separator.join(res), line_number)
                 try:
@@ -1127,7 +1148,6 @@ def do_node_for(self, prog):
             elif self.break_reporter:
                 # Shouldn't get here
                 self.break_reporter("'for' list value", '', line_number)
-                ret = ''
             return ret
         except (StopException, ValueError, ReturnExecuted) as e:
             raise e
@@ -1229,7 +1249,10 @@ def do_node_stored_template_call(self, prog, args=None):
             saved_line_number = None
         try:
             if function_object_type(prog.function.program_text) is StoredObjectType.StoredGPMTemplate:
-                val = self.expression_list(prog.function.cached_compiled_text)
+                if self.break_reporter is None:
+                    val = compiled_program(prog.function.cached_compiled_text, self.funcs)(self)
+                else:
+                    val = self.expression_list(prog.function.cached_compiled_text)
             else:
                 val = self.parent._run_python_template(prog.function.cached_compiled_text, args)
         except ReturnExecuted as e:
@@ -1698,6 +1721,761 @@ def expr(self, prog):
                        prog.line_number)
 
 
+def is_constant(compiled):
+    return hasattr(compiled, 'constant_value')
+
+
+def constant(value):
+    def f(interp):
+        return value
+    f.constant_value = value
+    return f
+
+
+class _Compiler:
+    '''
+    Compiles the tree created by _Parser into nested Python closures, one per
+    node, each of which takes the _Interpreter that holds the state of the
+    evaluation (locals, the book, etc.) and returns the value of the node.
+    Compared to walking the tree in the interpreter this avoids the dispatch
+    and break reporter checks per node, resolves formatter functions and field
+    names once and folds expressions whose operands are constants. The
+    behavior, including error messages, must be the same as that of the
+    interpreter, which is still used when a break reporter is set. Rarely used
+    nodes are evaluated by the interpreter.
+    '''
+
+    def __init__(self, funcs):
+        self.funcs = funcs
+        # The compiled arguments and blocks of the local functions defined in
+        # the program, keyed by the id of their define node
+        self.local_functions = {}
+
+    def compile(self, prog):
+        if isinstance(prog, list):
+            return self.expression_list(prog)
+        compiler = self.NODE_COMPILERS.get(prog.node_type)
+        if compiler is None:
+            return self.interpreted(prog)
+        return compiler(self, prog)
+
+    def fold(self, f, *children):
+        # Evaluate f now if all its operands are constants. Failures are left
+        # to happen, and be reported, when the template is evaluated.
+        if all(is_constant(c) for c in children):
+            try:
+                return constant(f(None))
+            except Exception:
+                pass
+        return f
+
+    def interpreted(self, prog):
+        def f(interp):
+            return interp.expr(prog)
+        return f
+
+    def internal_error(self, interp, e, line_number):
+        if DEBUG:
+            traceback.print_exc()
+        interp.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), line_number)
+
+    def expression_list(self, prog):
+        exprs = tuple(self.compile(p) for p in prog)
+        if not exprs:
+            return constant('')
+        if len(exprs) == 1:
+            expr = exprs[0]
+            if is_constant(expr):
+                return expr
+
+            def f(interp):
+                try:
+                    return expr(interp)
+                except (BreakExecuted, ContinueExecuted) as e:
+                    e.set_value('')
+                    raise e
+            return f
+
+        def f(interp):
+            val = ''
+            try:
+                for expr in exprs:
+                    val = expr(interp)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+        return f
+
+    def compile_if(self, prog):
+        condition = self.compile(prog.condition)
+        then_part = self.expression_list(prog.then_part)
+        else_part = self.expression_list(prog.else_part) if prog.else_part else constant('')
+        if is_constant(condition):
+            return then_part if condition.constant_value else else_part
+
+        def f(interp):
+            if condition(interp):
+                return then_part(interp)
+            return else_part(interp)
+        return f
+
+    def compile_for(self, prog):
+        line_number = prog.line_number
+        separator = constant(',') if prog.separator is None else self.compile(prog.separator)
+        v = prog.variable
+        list_field_expr = self.compile(prog.list_field_expr)
+        block = self.expression_list(prog.block)
+
+        def f(interp):
+            try:
+                sep = separator(interp)
+                fld = list_field_expr(interp)
+                res = getattr(interp.parent_book, fld, fld)
+                ret = ''
+                if res is not None:
+                    if isinstance(res, str):
+                        res = [r.strip() for r in res.split(sep) if r.strip()]
+                    try:
+                        for x in res:
+                            try:
+                                interp.locals[v] = x
+                                ret = block(interp)
+                            except ContinueExecuted as e:
+                                ret = e.get_value()
+                    except BreakExecuted as e:
+                        ret = e.get_value()
+                return ret
+            except (StopException, ValueError, ReturnExecuted) as e:
+                raise e
+            except Exception as e:
+                interp.error(_("Unhandled exception '{0}'").format(e), line_number)
+        return f
+
+    def compile_rvalue(self, prog):
+        name, line_number = prog.name, prog.line_number
+
+        def f(interp):
+            try:
+                return interp.locals[name]
+            except Exception:
+                interp.error(_("Unknown identifier '{0}'").format(name), line_number)
+        return f
+
+    def compile_assign(self, prog):
+        left, right = prog.left, self.compile(prog.right)
+
+        def f(interp):
+            interp.locals[left] = t = right(interp)
+            return t
+        return f
+
+    def compile_func(self, prog):
+        args = tuple(self.compile(arg) for arg in prog.expression_list)
+        eval_ = self.funcs[prog.name.strip()].eval_
+        line_number = prog.line_number
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                return eval_(interp.parent, interp.parent_kwargs, interp.parent_book, interp.locals, *[a(interp) for a in args])
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return f
+
+    def compile_stored_template_call(self, prog):
+        args = tuple(self.compile(arg) for arg in prog.expression_list)
+        function = prog.function
+        is_gpm = function_object_type(function.program_text) is StoredObjectType.StoredGPMTemplate
+        funcs = self.funcs
+        line_number = prog.line_number
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                vals = [a(interp) for a in args]
+                saved_locals, saved_local_functions = interp.locals, interp.local_functions
+                interp.locals = {'*arg_' + str(dex): v for dex, v in enumerate(vals)}
+                interp.local_functions = {}
+                try:
+                    if is_gpm:
+                        val = compiled_program(function.cached_compiled_text, funcs)(interp)
+                    else:
+                        val = interp.parent._run_python_template(function.cached_compiled_text, vals)
+                except ReturnExecuted as e:
+                    val = e.get_value()
+                interp.locals, interp.local_functions = saved_locals, saved_local_functions
+                return val
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return f
+
+    def compile_local_function_define(self, prog):
+        self.local_functions[id(prog)] = (
+            tuple((arg.left, self.compile(arg.right)) for arg in prog.argument_list), self.expression_list(prog.block))
+        name = prog.name
+
+        def f(interp):
+            interp.local_functions[name] = prog
+            return ''
+        return f
+
+    def compile_local_function_call(self, prog):
+        name, line_number = prog.name, prog.line_number
+        args = tuple(self.compile(arg) for arg in prog.arguments)
+        local_functions = self.local_functions
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                defn = interp.local_functions[name]
+                compiled = local_functions.get(id(defn))
+                if compiled is None:
+                    # Defined outside this program, in an f-string
+                    argument_list = tuple((arg.left, partial(interp.expr, arg.right)) for arg in defn.argument_list)
+                    block = partial(interp.expr, defn.block)
+                else:
+                    argument_list, block = compiled
+                if len(args) > len(argument_list):
+                    interp.error(_('Function {0}: argument count mismatch -- '
+                                   '{1} given, at most {2} required').format(name, len(args), len(argument_list)), line_number)
+                new_locals = {}
+                for i, (left, right) in enumerate(argument_list):
+                    new_locals[left] = args[i](interp) if i < len(args) else right(interp)
+                saved_locals = interp.locals
+                interp.locals = new_locals
+                try:
+                    return block(interp)
+                except ReturnExecuted as e:
+                    return e.get_value()
+                finally:
+                    interp.locals = saved_locals
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return f
+
+    def compile_arguments(self, prog):
+        args = tuple(('*arg_' + str(dex), arg.left, self.compile(arg.right)) for dex, arg in enumerate(prog.expression_list))
+
+        def f(interp):
+            lcls = interp.locals
+            for key, left, right in args:
+                lcls[left] = lcls.get(key, right(interp))
+            return ''
+        return f
+
+    def compile_globals(self, prog):
+        args = tuple((arg.left, self.compile(arg.right)) for arg in prog.expression_list)
+
+        def f(interp):
+            res = ''
+            for left, right in args:
+                res = interp.locals[left] = interp.global_vars.get(left, right(interp))
+            return res
+        return f
+
+    def compile_set_globals(self, prog):
+        args = tuple((arg.left, self.compile(arg.right)) for arg in prog.expression_list)
+
+        def f(interp):
+            res = ''
+            for left, right in args:
+                res = interp.global_vars[left] = interp.locals.get(left, right(interp))
+            return res
+        return f
+
+    def compile_constant(self, prog):
+        return constant(prog.value)
+
+    def compile_field(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+
+        def f(interp):
+            try:
+                name = expression(interp)
+                try:
+                    return interp.parent.get_value(name, [], interp.parent_kwargs)
+                except StopException:
+                    raise
+                except Exception:
+                    interp.error(_("Unknown field '{0}'").format(name), line_number)
+            except (StopException, ValueError):
+                raise
+            except Exception:
+                interp.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return f
+
+    def compile_raw_field(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+        default = None if prog.default is None else self.compile(prog.default)
+        if is_constant(expression):
+            try:
+                key = field_metadata.search_term_to_field_key(expression.constant_value)
+            except Exception:
+                return self.interpreted(prog)
+            expression = None
+
+        def f(interp):
+            try:
+                name = key if expression is None else field_metadata.search_term_to_field_key(expression(interp))
+                res = getattr(interp.parent_book, name, None)
+                if res is None:
+                    if default is not None:
+                        return default(interp)
+                    return 'None'
+                if isinstance(res, list):
+                    fm = interp.parent_book.metadata_for_field(name)
+                    return ', '.join(res) if fm is None else fm['is_multiple']['list_to_ui'].join(res)
+                return str(res)
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+        return f
+
+    def compile_first_non_empty(self, prog):
+        exprs = tuple(self.compile(e) for e in prog.expression_list)
+
+        def f(interp):
+            for expr in exprs:
+                v = expr(interp)
+                if v:
+                    return v
+            return ''
+        return f
+
+    def compile_switch(self, prog):
+        exprs = tuple(self.compile(e) for e in prog.expression_list)
+        value, cases, default = exprs[0], tuple(zip(exprs[1:-1:2], exprs[2:-1:2])), exprs[-1]
+        line_number = prog.line_number
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                val = value(interp)
+                for pat, res in cases:
+                    if re.search(pat(interp), val, flags=re.I):
+                        return res(interp)
+                return default(interp)
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return f
+
+    def compile_switch_if(self, prog):
+        exprs = tuple(self.compile(e) for e in prog.expression_list)
+        cases, default = tuple(zip(exprs[0:-1:2], exprs[1:-1:2])), exprs[-1]
+
+        def f(interp):
+            for test, res in cases:
+                if test(interp):
+                    return res(interp)
+            return default(interp)
+        return f
+
+    def compile_contains(self, prog):
+        value, test = self.compile(prog.value_expression), self.compile(prog.test_expression)
+        match, not_match = self.compile(prog.match_expression), self.compile(prog.not_match_expression)
+        line_number = prog.line_number
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                v = value(interp)
+                if re.search(test(interp), v, flags=re.I):
+                    return match(interp)
+                return not_match(interp)
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return f
+
+    def compile_strcat(self, prog):
+        exprs = tuple(self.compile(e) for e in prog.expression_list)
+        line_number = prog.line_number
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                return ''.join([expr(interp) for expr in exprs])
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return self.fold(f, *exprs)
+
+    def compile_list_count_field(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                name = field_metadata.search_term_to_field_key(expression(interp))
+                res = getattr(interp.parent_book, name, None)
+                if res is None or not isinstance(res, (list, tuple, set, dict)):
+                    interp.error(_("Field '{0}' is either not a field or not a list").format(name), line_number)
+                return str(len(res))
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return f
+
+    def compile_break(self, prog):
+        def f(interp):
+            raise BreakExecuted()
+        return f
+
+    def compile_continue(self, prog):
+        def f(interp):
+            raise ContinueExecuted()
+        return f
+
+    def compile_return(self, prog):
+        expr = self.compile(prog.expr)
+
+        def f(interp):
+            e = ReturnExecuted()
+            e.set_value(expr(interp))
+            raise e
+        return f
+
+    def compile_string_infix(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        op = _Interpreter.INFIX_STRING_COMPARE_OPS.get(operator)
+
+        def f(interp):
+            try:
+                lval, rval = left(interp), right(interp)
+                if op is None:
+                    if operator == 'inlist_field':
+                        return interp.do_inlist_field(lval, rval, prog)
+                    raise KeyError(operator)
+                return '1' if op(lval, rval) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_('Error during string comparison: '
+                               "operator '{0}'").format(operator), line_number)
+        return f if op is None else self.fold(f, left, right)
+
+    def compile_numeric_infix(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        op = _Interpreter.INFIX_NUMERIC_COMPARE_OPS.get(operator)
+        float_deal_with_none = _Interpreter.float_deal_with_none
+
+        def f(interp):
+            try:
+                return '1' if op(float_deal_with_none(None, left(interp)), float_deal_with_none(None, right(interp))) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_('Value used in comparison is not a number: '
+                               "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    def compile_logop(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        is_and = operator == 'and'
+        if not is_and and operator != 'or':
+            return self.interpreted(prog)
+
+        def f(interp):
+            try:
+                if is_and:
+                    return '1' if left(interp) and right(interp) else ''
+                return '1' if left(interp) or right(interp) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_('Error during operator evaluation: '
+                               "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    def compile_logop_unary(self, prog):
+        expr, operator, line_number = self.compile(prog.expr), prog.operator, prog.line_number
+        if operator != 'not':
+            return self.interpreted(prog)
+
+        def f(interp):
+            try:
+                return '' if expr(interp) else '1'
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_('Error during operator evaluation: '
+                               "operator '{0}'").format(operator), line_number)
+        return self.fold(f, expr)
+
+    def compile_binary_arithop(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+        op = _Interpreter.ARITHMETIC_BINARY_OPS.get(operator)
+        float_deal_with_none = _Interpreter.float_deal_with_none
+
+        def f(interp):
+            try:
+                answer = op(float_deal_with_none(None, left(interp)), float_deal_with_none(None, right(interp)))
+                return str(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_('Error during operator evaluation: '
+                               "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    def compile_unary_arithop(self, prog):
+        expr, operator, line_number = self.compile(prog.expr), prog.operator, prog.line_number
+        op = _Interpreter.ARITHMETIC_UNARY_OPS.get(operator)
+
+        def f(interp):
+            try:
+                val = op(float(expr(interp)))
+                return str(val if modf(val)[0] != 0 else int(val))
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_('Error during operator evaluation: '
+                               "operator '{0}'").format(operator), line_number)
+        return self.fold(f, expr)
+
+    def compile_stringops(self, prog):
+        left, right, operator, line_number = self.compile(prog.left), self.compile(prog.right), prog.operator, prog.line_number
+
+        def f(interp):
+            try:
+                return left(interp) + right(interp)
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                interp.error(_('Error during operator evaluation: '
+                               "operator '{0}'").format(operator), line_number)
+        return self.fold(f, left, right)
+
+    def compile_character(self, prog):
+        expression, line_number = self.compile(prog.expression), prog.line_number
+        characters = _Interpreter.characters
+        internal_error = self.internal_error
+
+        def f(interp):
+            try:
+                key = expression(interp)
+                ret = characters.get(key, None)
+                if ret is None:
+                    interp.error(_("Function {0}: invalid character name '{1}")
+                                 .format('character', key), line_number)
+                return ret
+            except (ValueError, ExecutionBase, StopException) as e:
+                raise e
+            except Exception as e:
+                internal_error(interp, e, line_number)
+        return self.fold(f, expression)
+
+    NODE_COMPILERS = {
+        Node.NODE_IF:                    compile_if,
+        Node.NODE_ASSIGN:                compile_assign,
+        Node.NODE_CONSTANT:              compile_constant,
+        Node.NODE_RVALUE:                compile_rvalue,
+        Node.NODE_FUNC:                  compile_func,
+        Node.NODE_FIELD:                 compile_field,
+        Node.NODE_RAW_FIELD:             compile_raw_field,
+        Node.NODE_COMPARE_STRING:        compile_string_infix,
+        Node.NODE_COMPARE_NUMERIC:       compile_numeric_infix,
+        Node.NODE_ARGUMENTS:             compile_arguments,
+        Node.NODE_CALL_STORED_TEMPLATE:  compile_stored_template_call,
+        Node.NODE_FIRST_NON_EMPTY:       compile_first_non_empty,
+        Node.NODE_SWITCH:                compile_switch,
+        Node.NODE_SWITCH_IF:             compile_switch_if,
+        Node.NODE_FOR:                   compile_for,
+        Node.NODE_GLOBALS:               compile_globals,
+        Node.NODE_SET_GLOBALS:           compile_set_globals,
+        Node.NODE_CONTAINS:              compile_contains,
+        Node.NODE_BINARY_LOGOP:          compile_logop,
+        Node.NODE_UNARY_LOGOP:           compile_logop_unary,
+        Node.NODE_BINARY_ARITHOP:        compile_binary_arithop,
+        Node.NODE_UNARY_ARITHOP:         compile_unary_arithop,
+        Node.NODE_BREAK:                 compile_break,
+        Node.NODE_CONTINUE:              compile_continue,
+        Node.NODE_RETURN:                compile_return,
+        Node.NODE_CHARACTER:             compile_character,
+        Node.NODE_STRCAT:                compile_strcat,
+        Node.NODE_BINARY_STRINGOP:       compile_stringops,
+        Node.NODE_LOCAL_FUNCTION_DEFINE: compile_local_function_define,
+        Node.NODE_LOCAL_FUNCTION_CALL:   compile_local_function_call,
+        Node.NODE_LIST_COUNT_FIELD:      compile_list_count_field,
+        # with, for ... in range, print and f-strings are interpreted
+    }
+
+
+def compiled_program(tree, funcs):
+    '''
+    Return the compiled form of the program tree created by _Parser, compiling
+    it if needed. The compiled program is cached on the tree.
+    '''
+    c = tree.compiled
+    if c is None or c[0] is not funcs:
+        tree.compiled = c = funcs, _Compiler(funcs).expression_list(tree)
+    return c[1]
+
+
+# Builtin functions whose result depends only on their arguments
+FUNCTIONS_USING_ONLY_ARGUMENTS = frozenset((
+    'add', 'and', 'capitalize', 'ceiling', 'cmp', 'contains', 'divide',
+    'encode_for_url', 'first_matching_cmp', 'first_non_empty', 'floor',
+    'format_date', 'format_duration', 'format_number', 'fractional_part',
+    'human_readable', 'identifier_in_list', 'ifempty', 'language_codes',
+    'language_strings', 'list_contains', 'list_count', 'list_count_matching',
+    'list_difference', 'list_equals', 'list_intersection', 'list_item',
+    'list_join', 'list_re', 'list_remove_duplicates', 'list_sort',
+    'list_split', 'list_union', 'lowercase', 'mod', 'multiply', 'not', 'or',
+    'query_string', 'rating_to_stars', 're', 'round', 'select', 'shorten',
+    'str_in_list', 'strcat', 'strcat_max', 'strcmp', 'strcmpcase', 'strlen',
+    'sublist', 'subitems', 'substr', 'subtract', 'swap_around_articles',
+    'swap_around_comma', 'switch', 'switch_if', 'test', 'titlecase', 'to_hex',
+    'transliterate', 'uppercase', 'urls_from_identifiers',
+))
+
+# Builtin functions that read the field named by their first argument
+FUNCTIONS_WITH_FIELD_ARGUMENT = frozenset((
+    'check_yes_no', 'field', 'format_date_field', 'list_count_field',
+    'raw_field', 'raw_list',
+))
+
+# Builtin functions that read fixed fields
+FUNCTIONS_USING_FIELDS = {
+    'approximate_formats': ('db_approx_formats',),
+    'author_sorts': ('authors', 'author_sort_map'),
+    'booksize': ('book_size',),
+    'has_cover': ('has_cover',),
+    'series_sort': ('series', 'languages'),
+}
+
+
+class DynamicFieldReference(Exception):
+    pass
+
+
+def _constant_field_name(expr):
+    if isinstance(expr, list):
+        if len(expr) != 1:
+            raise DynamicFieldReference()
+        expr = expr[0]
+    if expr.node_type != Node.NODE_CONSTANT:
+        raise DynamicFieldReference()
+    return expr.value.lower()
+
+
+def _check_builtin(name, funcs):
+    if funcs.get(name) is not formatter_functions().get_builtins_and_aliases().get(name):
+        # A user defined function, possibly replacing a builtin
+        raise DynamicFieldReference()
+
+
+def _program_field_references(tree, funcs, ans):
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (list, tuple)):
+            stack.extend(node)
+            continue
+        if not isinstance(node, Node):
+            continue
+        nt = node.node_type
+        if nt in (Node.NODE_FIELD, Node.NODE_RAW_FIELD, Node.NODE_LIST_COUNT_FIELD):
+            ans.add(_constant_field_name(node.expression))
+            stack.append(getattr(node, 'default', None))
+        elif nt == Node.NODE_FOR:
+            # The expression is either the name of a field or a list of values
+            name = _constant_field_name(node.list_field_expr)
+            if re.match(r'#?\w+$', name) is not None:
+                ans.add(name)
+            stack.extend((node.separator, node.block))
+        elif nt == Node.NODE_COMPARE_STRING and node.operator == 'inlist_field':
+            ans.add(_constant_field_name(node.right))
+            stack.append(node.left)
+        elif nt == Node.NODE_FUNC:
+            name = node.name.strip()
+            _check_builtin(name, funcs)
+            args = node.expression_list
+            if name in FUNCTIONS_WITH_FIELD_ARGUMENT:
+                if not args:
+                    raise DynamicFieldReference()
+                ans.add(_constant_field_name(args[0]))
+                args = args[1:]
+            elif name in FUNCTIONS_USING_FIELDS:
+                ans.update(FUNCTIONS_USING_FIELDS[name])
+            elif name not in FUNCTIONS_USING_ONLY_ARGUMENTS:
+                raise DynamicFieldReference()
+            stack.extend(args)
+        elif nt in (Node.NODE_CALL_STORED_TEMPLATE, Node.NODE_WITH, Node.NODE_FSTRING):
+            raise DynamicFieldReference()
+        else:
+            stack.extend(v for v in vars(node).values() if isinstance(v, (Node, list, tuple)))
+
+
+def _single_function_mode_field_references(template, funcs, ans):
+    for literal, name, fmt, conversion in string.Formatter().parse(template):
+        if name is None:
+            continue
+        if '.' in name or '[' in name or '{' in (fmt or ''):
+            raise DynamicFieldReference()
+        if name and not name.isdigit():
+            ans.add(name.lower())
+        fmt = fmt or ''
+        m = TemplateFormatter.format_string_re.match(fmt)
+        if m is not None:
+            fmt = m.group(1)
+        if "'" in fmt:
+            # Template program mode
+            p = 0 if fmt.startswith("'") else fmt.find(":'") + 1
+            if fmt[-1] != "'" or (p == 0 and fmt[0] != "'"):
+                raise DynamicFieldReference()
+            tree = _Parser().program(TemplateFormatter(), funcs, cached_lex_scanner().scan(fmt[p+1:-1]))
+            _program_field_references(tree, funcs, ans)
+            continue
+        p = fmt.find('(')
+        if p >= 0 and fmt[-1] == ')':
+            fname = fmt[fmt.find(':', 0, p) + 1:p].strip()
+            if fname in funcs:
+                _check_builtin(fname, funcs)
+                if fname in FUNCTIONS_USING_FIELDS:
+                    ans.update(FUNCTIONS_USING_FIELDS[fname])
+                elif fname not in FUNCTIONS_USING_ONLY_ARGUMENTS:
+                    raise DynamicFieldReference()
+
+
+def template_field_references(template, funcs=None):
+    '''
+    Return the set of the lookup names of the fields read by the template,
+    in lower case and as written in the template, or None if they cannot be
+    determined without evaluating the template, for example, if it is a
+    python template, if field names are computed or if it calls stored
+    templates or functions that can read any field. Templates that fail to
+    parse also return None.
+    '''
+    if funcs is None:
+        funcs = formatter_functions().get_functions()
+    if template.startswith('python:'):
+        return None
+    ans = set()
+    try:
+        if template.startswith('program:'):
+            tree = _Parser().program(TemplateFormatter(), funcs, cached_lex_scanner().scan(template[8:]))
+            _program_field_references(tree, funcs, ans)
+        else:
+            _single_function_mode_field_references(template, funcs, ans)
+    except (DynamicFieldReference, ValueError):
+        return None
+    return frozenset(ans)
+
+
 @lru_cache(maxsize=2)
 def args_scanner() -> re.Scanner:
     return re.Scanner([
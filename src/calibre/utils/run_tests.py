@@ -247,6 +247,8 @@ def ok(x):
         a(test(return_tests=True))
         from css_selectors.tests import find_tests
         a(find_tests())
+        from calibre.ebooks.oeb.stylizer import find_tests
+        a(find_tests())
     if ok('docx'):
         from calibre.ebooks.docx.fields import test_parse_fields
         a(test_parse_fields(return_tests=True))
@@ -331,16 +331,19 @@ def run_tests(parser, result, tests):
                 failed.append(test[0])
         return failed
 
-    def __init__(self, locations, test=False, optimize=False, lookup_saved_search=None, parse_cache=None):
+    def __init__(self, locations, test=False, optimize=False, lookup_saved_search=None, parse_cache=None, plan_cache=None):
         self.sqp_initialize(locations, test=test, optimize=optimize)
         self.parser = Parser()
         self.lookup_saved_search = global_lookup_saved_search if lookup_saved_search is None else lookup_saved_search
         self.sqp_parse_cache = parse_cache
+        self.sqp_plan_cache = plan_cache
 
     def sqp_change_locations(self, locations):
         self.sqp_initialize(locations, optimize=self.optimize)
         if self.sqp_parse_cache is not None:
             self.sqp_parse_cache.clear()
+        if self.sqp_plan_cache is not None:
+            self.sqp_plan_cache.clear()
 
     def sqp_initialize(self, locations, test=False, optimize=False):
         self.locations = locations
@@ -348,10 +351,7 @@ def sqp_initialize(self, locations, test=False, optimize=False):
         self.optimize = optimize
 
     def get_queried_fields(self, query):
-        # empty the list of searches used for recursion testing
-        self.searches_seen = set()
-        tree = self._get_tree(query)
-        yield from self._walk_expr(tree)
+        yield from self._walk_expr(self._get_plan(query))
 
     def _walk_expr(self, tree):
         if tree[0] in ('or', 'and'):
@@ -359,18 +359,45 @@ def _walk_expr(self, tree):
             yield from self._walk_expr(tree[2])
         elif tree[0] == 'not':
             yield from self._walk_expr(tree[1])
-        elif tree[1] == 'search':
-            query, search_name_lower = self._check_saved_search_recursion(tree[2])
-            yield from self._walk_expr(self._get_tree(query))
-            self.searches_seen.discard(search_name_lower)
         else:
             yield tree[1], tree[2]
 
     def parse(self, query, candidates=None):
+        candidates = self.universal_set()
+        return self.evaluate(self._get_plan(query), candidates)
+
+    def _get_plan(self, query):
+        '''
+        Return the parse tree for query with all references to saved searches
+        replaced by the parse trees of the saved searches. Since plans are
+        cached, the plan cache must be cleared whenever saved searches change.
+        '''
+        cache = self.sqp_plan_cache
+        if cache is not None:
+            res = cache.get(query)
+            if res is not None:
+                return res
         # empty the list of searches used for recursion testing
         self.searches_seen = set()
-        candidates = self.universal_set()
-        return self._parse(query, candidates=candidates)
+        res = self._inline_saved_searches(self._get_tree(query))
+        if cache is not None:
+            cache[query] = res
+        return res
+
+    def _inline_saved_searches(self, tree):
+        # Trees in the parse cache are shared, so build a new tree instead of
+        # modifying them
+        if tree[0] in ('or', 'and'):
+            return [tree[0], self._inline_saved_searches(tree[1]), self._inline_saved_searches(tree[2])]
+        if tree[0] == 'not':
+            return ['not', self._inline_saved_searches(tree[1])]
+        if tree[1].lower() == 'search':
+            query, search_name_lower = self._check_saved_search_recursion(tree[2])
+            try:
+                return self._inline_saved_searches(self._get_tree(query))
+            finally:
+                self.searches_seen.discard(search_name_lower)
+        return tree
 
     def _get_tree(self, query):
         try: